@@ -7,27 +7,27 @@ load_dotenv(BASE_DIR / ".env")
 from datetime import datetime, timedelta, date as dt_date, date
 from enum import Enum
 import os, secrets
-from typing import Optional, List, Iterable, Tuple
+from typing import Optional, List, Iterable, Tuple, Dict
 from fastapi.responses import PlainTextResponse
 
-from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Form, Query, Body, Request
+from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Form, Query, Body, Request, WebSocket, WebSocketDisconnect
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, Response
+from fastapi.responses import FileResponse, JSONResponse, Response
 from livekit import api as lk_api
 import datetime as dt
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi.staticfiles import StaticFiles
 from jose import jwt
-from passlib.context import CryptContext
 from pydantic import BaseModel, EmailStr
 from sqlalchemy import (
     Column, Integer, String, DateTime, Date, Enum as SAEnum, ForeignKey, Text, Boolean, Float,
-    create_engine, or_, and_, text
+    Index, UniqueConstraint, create_engine, event, inspect, update, or_, and_, text
 )
 from fastapi import Depends, HTTPException
 from sqlalchemy.orm import Session
 from firebase_admin import messaging
-from sqlalchemy.orm import declarative_base, relationship, sessionmaker, Session
+from sqlalchemy.orm import declarative_base, relationship, sessionmaker, Session, contains_eager
 from io import BytesIO
 from sqlalchemy import func
 
@@ -40,7 +40,8 @@ from sqlalchemy import func
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./smart_gateway.db")
 JWT_SECRET = os.getenv("JWT_SECRET", "change_me")
 JWT_ALG = os.getenv("JWT_ALG", "HS256")
-ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "240"))
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "240"))   # shorten once the app uses /auth/refresh
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "30"))
 HOSPITAL_HOTLINE = os.getenv("HOSPITAL_HOTLINE", "+88000000000")
 
 LIVEKIT_URL = os.getenv("LIVEKIT_URL", "ws://192.168.0.102:7880")
@@ -48,14 +49,33 @@ LIVEKIT_API_KEY = os.getenv("LIVEKIT_API_KEY", "devkey")
 LIVEKIT_API_SECRET = os.getenv("LIVEKIT_API_SECRET", "devsecret_1234567890_1234567890_ABCDEFG")
 
 from sqlalchemy.pool import NullPool, StaticPool
+from sqlalchemy.exc import IntegrityError
 
 import json
 import os
 import firebase_admin
 from firebase_admin import credentials, messaging
 
+import anyio
+import asyncio
+import hashlib
+import mimetypes
+import multiprocessing
 import threading
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import quote
+from starlette.concurrency import run_in_threadpool
+
+import fanout
+import passwords
+import thumbnails
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from heapq import heappush, heappop
 
 
 FIREBASE_CREDENTIAL_PATH = os.getenv("FIREBASE_CREDENTIAL_PATH", "D:\\SmartGateway\\firebase-service-account.json")
@@ -133,7 +153,7 @@ SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False, expi
 Base = declarative_base()
 
 
-pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
+pwd_context = passwords.pwd_context
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
 
 # -----------------------------------------------------------------------------
@@ -179,6 +199,7 @@ class User(Base):
     password_hash = Column(String, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
     photo_path = Column(String, nullable=True)
+    token_version = Column(Integer, default=0)   # bumped to void every access token issued before
 
     doctor_profile = relationship("Doctor", back_populates="user", uselist=False)
     patient_profile = relationship("Patient", back_populates="user", uselist=False)
@@ -195,7 +216,7 @@ class Doctor(Base):
     rating = Column(Integer, default=5)
     address = Column(String, default="")
     visiting_fee = Column(Float, default=0.0)
-
+    schedule_version = Column(Integer, default=0)   # changed by every rule edit, see ScheduleCache
 
     user = relationship("User", back_populates="doctor_profile")
     appointments = relationship("Appointment", back_populates="doctor")
@@ -280,6 +301,11 @@ class Appointment(Base):
     changes = relationship("AppointmentChangeLog", back_populates="appointment", cascade="all, delete-orphan")
     notes_thread = relationship("AppointmentNote", back_populates="appointment", cascade="all, delete-orphan")
 
+    __table_args__ = (
+        Index("ix_appointments_doctor_start_status", "doctor_id", "start_time", "status"),
+        Index("ix_appointments_patient_start", "patient_id", "start_time"),
+    )
+
 class AppointmentChangeLog(Base):
     __tablename__ = "appointment_change_logs"
     id = Column(Integer, primary_key=True)
@@ -335,6 +361,8 @@ class Availability(Base):
     mode = Column(String, default="offline")       # online/offline
     created_at = Column(DateTime, default=datetime.utcnow)
 
+    __table_args__ = (Index("ix_availabilities_doctor_dow", "doctor_id", "day_of_week"),)
+
 class DateRule(Base):
     __tablename__ = "date_rules"
     id = Column(Integer, primary_key=True)
@@ -348,6 +376,8 @@ class DateRule(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     doctor = relationship("Doctor", back_populates="date_rules")
 
+    __table_args__ = (Index("ix_date_rules_doctor_target_date", "doctor_id", "target_date"),)
+
 class DoctorRating(Base):
     __tablename__ = "doctor_ratings"
     id = Column(Integer, primary_key=True)
@@ -393,6 +423,9 @@ class CallLog(Base):
     ended_at = Column(DateTime, nullable=True)
     duration = Column(Integer, nullable=True)  # seconds
     status = Column(String, default="ringing")  
+    timeout_at = Column(DateTime, nullable=True, index=True)  # ring deadline while unanswered
+
+    __table_args__ = (Index("ix_call_logs_status_started", "status", "started_at"),)
 
 class Message(Base):
     __tablename__ = "messages"
@@ -405,9 +438,109 @@ class Message(Base):
     read = Column(Boolean, default=False)
     created_at = Column(DateTime, default=datetime.utcnow, index=True)
 
+    __table_args__ = (Index("ix_messages_appt_id", "appointment_id", "id"),)
+
     # Relationship (optional)
     appointment = relationship("Appointment")
 
+class AvailabilityCalendar(Base):
+    """Materialized per-hour availability (one row per schedule block hour)."""
+    __tablename__ = "availability_calendar"
+    id = Column(Integer, primary_key=True)
+    doctor_id = Column(Integer, ForeignKey("doctors.id"), nullable=False)
+    day = Column(Date, nullable=False)
+    hour = Column(Integer, nullable=False)                 # 0..23
+    mode = Column(String, nullable=True)                   # mode of the owning block
+    block_start = Column(Integer, nullable=False)
+    block_end = Column(Integer, nullable=False)
+    block_capacity_left = Column(Integer, nullable=False, default=0)
+    slot_capacity_left = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (Index("ix_availability_calendar_doctor_day", "doctor_id", "day"),)
+
+class AvailabilityCalendarDay(Base):
+    """Marks a (doctor, day) whose calendar rows are materialized."""
+    __tablename__ = "availability_calendar_days"
+    id = Column(Integer, primary_key=True)
+    doctor_id = Column(Integer, ForeignKey("doctors.id"), nullable=False)
+    day = Column(Date, nullable=False)
+    built_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (UniqueConstraint("doctor_id", "day", name="uq_availability_calendar_day"),)
+
+class SlotReservation(Base):
+    """Remaining capacity of an exact (doctor, start, end) slot; seeded lazily from rules + bookings."""
+    __tablename__ = "slot_reservations"
+    id = Column(Integer, primary_key=True)
+    doctor_id = Column(Integer, ForeignKey("doctors.id"), nullable=False)
+    start_time = Column(DateTime, nullable=False)
+    end_time = Column(DateTime, nullable=False)
+    remaining = Column(Integer, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (UniqueConstraint("doctor_id", "start_time", "end_time", name="uq_slot_reservation"),)
+
+class SerialSequence(Base):
+    """Last serial handed out per (doctor, schedule window start); seeded from max(serial_number)."""
+    __tablename__ = "serial_sequences"
+    id = Column(Integer, primary_key=True)
+    doctor_id = Column(Integer, ForeignKey("doctors.id"), nullable=False)
+    window_start = Column(DateTime, nullable=False)
+    last_serial = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (UniqueConstraint("doctor_id", "window_start", name="uq_serial_sequence"),)
+
+class RefreshToken(Base):
+    """Opaque refresh token (stored as sha256). Each use rotates it within its family."""
+    __tablename__ = "refresh_tokens"
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    family = Column(String, nullable=False, index=True)    # one login = one family
+    token_hash = Column(String, nullable=False, unique=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False)
+    used_at = Column(DateTime, nullable=True)               # set when rotated
+    revoked_at = Column(DateTime, nullable=True)
+
+class NotificationOutbox(Base):
+    """Queued push notification; written in the request transaction, delivered by the dispatcher."""
+    __tablename__ = "notification_outbox"
+    id = Column(Integer, primary_key=True)
+    kind = Column(String, default="")
+    user_ids = Column(Text, nullable=False, default="[]")          # JSON list of recipient user ids
+    exclude_user_ids = Column(Text, nullable=False, default="[]")  # their tokens are never notified
+    tokens = Column(Text, nullable=True)                           # JSON; resolved on first attempt, then only retries
+    title = Column(String, nullable=True)                          # None = data-only push
+    body = Column(Text, nullable=True)
+    data = Column(Text, nullable=False, default="{}")
+    options = Column(Text, nullable=False, default="{}")           # ttl, android_channel, apns_sound
+    status = Column(String, nullable=False, default="pending")     # pending | sending | sent | failed
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, default=datetime.utcnow)
+    claimed_by = Column(String, nullable=True)
+    claimed_at = Column(DateTime, nullable=True)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    sent_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (Index("ix_notification_outbox_status_next", "status", "next_attempt_at"),)
+
+class UploadBlob(Base):
+    """
+    One stored file per distinct upload content (uploads/blobs/ab/cd/<sha256><ext>).
+    refcount = rows whose path columns point at it; kept up to date by a flush hook.
+    """
+    __tablename__ = "upload_blobs"
+    sha256 = Column(String(64), primary_key=True)
+    path = Column(String, nullable=False, unique=True)
+    size = Column(Integer, nullable=False, default=0)
+    refcount = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    released_at = Column(DateTime, nullable=True)    # last drop of a reference; GC grace starts here
+
+    __table_args__ = (Index("ix_upload_blobs_refcount_released", "refcount", "released_at"),)
+
 # -----------------------------------------------------------------------------
 # SQLite additive auto-migrations (adds columns safely)
 # -----------------------------------------------------------------------------
@@ -424,6 +557,7 @@ def ensure_sqlite_schema(engine):
     with engine.begin() as conn:
         # users
         if not _has_column(conn, "users", "photo_path"): _add_column(conn, "users", "photo_path TEXT")
+        if not _has_column(conn, "users", "token_version"): _add_column(conn, "users", "token_version INTEGER DEFAULT 0")
         # doctors
         if not _has_column(conn, "doctors", "category"): _add_column(conn, "doctors", "category TEXT DEFAULT 'General'")
         if not _has_column(conn, "doctors", "keywords"): _add_column(conn, "doctors", "keywords TEXT DEFAULT ''")
@@ -431,6 +565,7 @@ def ensure_sqlite_schema(engine):
         if not _has_column(conn, "doctors", "rating"): _add_column(conn, "doctors", "rating INTEGER DEFAULT 5")
         if not _has_column(conn, "doctors", "address"): _add_column(conn, "doctors", "address TEXT DEFAULT ''")
         if not _has_column(conn, "doctors", "visiting_fee"): _add_column(conn, "doctors", "visiting_fee REAL DEFAULT 0")
+        if not _has_column(conn, "doctors", "schedule_version"): _add_column(conn, "doctors", "schedule_version INTEGER DEFAULT 0")
         # patients
         for col, ddl in [
             ("age", "age INTEGER"), ("weight", "weight INTEGER"), ("height", "height INTEGER"),
@@ -470,6 +605,9 @@ def ensure_sqlite_schema(engine):
                 conn.execute(text("UPDATE date_rules SET target_date = date"))
         if not _has_column(conn, "date_rules", "created_at"):
             _add_column(conn, "date_rules", "created_at TEXT")
+        # call_logs
+        if not _has_column(conn, "call_logs", "timeout_at"):
+            _add_column(conn, "call_logs", "timeout_at TEXT")
         # prescriptions
         if not _has_column(conn, "prescriptions", "file_path"):
             _add_column(conn, "prescriptions", "file_path TEXT")
@@ -481,6 +619,29 @@ def ensure_sqlite_schema(engine):
         if not _has_column(conn, "medical_reports", "appointment_id"):
             _add_column(conn, "medical_reports", "appointment_id INTEGER")
 
+# -----------------------------------------------------------------------------
+# Index management (any backend; runs after the column migrations above)
+# -----------------------------------------------------------------------------
+def ensure_indexes(engine) -> List[str]:
+    """
+    Create model-declared indexes that are missing on already-existing tables
+    (create_all only indexes tables it creates). Idempotent; returns the names created.
+    """
+    insp = inspect(engine)
+    created: List[str] = []
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not insp.has_table(table.name):
+                continue
+            existing = {ix["name"] for ix in insp.get_indexes(table.name)}
+            for ix in table.indexes:
+                if ix.name in existing:
+                    continue
+                ix.create(bind=conn, checkfirst=True)
+                created.append(ix.name)
+    print(f"ENSURE_INDEXES: created={created or 'none'}")
+    return created
+
 # -----------------------------------------------------------------------------
 # Helpers
 # -----------------------------------------------------------------------------
@@ -494,61 +655,702 @@ def get_db():
     finally:
         db.close()
 
-def verify_password(plain, hashed): return pwd_context.verify(plain, hashed)
-def hash_password(pw: str) -> str: return pwd_context.hash(pw)
+def verify_password(plain, hashed): return passwords.verify_and_update(plain, hashed)[0]
+def hash_password(pw: str) -> str: return passwords.hash_password(pw)
+
+# ---- password hashing off the request threadpool ------------------------------
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", str(min(4, os.cpu_count() or 1))))  # 0 = in threadpool
+PASSWORD_MAX_PENDING = int(os.getenv("PASSWORD_MAX_PENDING", "64"))
+
+class PasswordPool:
+    """
+    Bounded process pool for pbkdf2 work, so a login burst burns CPU in worker
+    processes instead of holding the GIL the event loop and threadpool share.
+    At most `max_pending` jobs run or wait; further callers get 503 instead of
+    queueing without limit (which also caps threadpool threads parked on a hash).
+    """
+    def __init__(self, workers: int, max_pending: int):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.peak_pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.rehashed = 0
+        self._busy_seconds = 0.0
+
+    def _pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context("spawn"))
+            return self._executor
+
+    def run(self, fn, *args):
+        """Run fn(*args) in the pool and block for the result; call it from sync endpoints
+        (FastAPI's threadpool), so the event loop never waits on the hash."""
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise HTTPException(503, "Too many sign-ins in progress, please retry")
+            self.pending += 1
+            self.peak_pending = max(self.peak_pending, self.pending)
+        t0 = time.monotonic()
+        try:
+            if self.workers <= 0:
+                return fn(*args)
+            try:
+                return self._pool().submit(fn, *args).result()
+            except BrokenProcessPool:
+                with self._lock:
+                    self._executor = None
+                raise
+        finally:
+            with self._lock:
+                self.pending -= 1
+                self.completed += 1
+                self._busy_seconds += time.monotonic() - t0
+
+    def shutdown(self) -> None:
+        with self._lock:
+            ex, self._executor = self._executor, None
+        if ex:
+            ex.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "max_pending": self.max_pending,
+                "pending": self.pending,
+                "peak_pending": self.peak_pending,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "rehashed": self.rehashed,
+                "avg_ms": round(1000 * self._busy_seconds / self.completed, 2) if self.completed else None,
+            }
+
+_password_pool = PasswordPool(PASSWORD_WORKERS, PASSWORD_MAX_PENDING)
+
+def hash_password_pooled(pw: str) -> str:
+    return _password_pool.run(passwords.hash_password, pw)
+
+def verify_password_pooled(plain: str, hashed: str) -> Tuple[bool, Optional[str]]:
+    """(matches, new_hash); new_hash is set when the stored hash uses an outdated work factor."""
+    return _password_pool.run(passwords.verify_and_update, plain, hashed)
 
 def create_access_token(data: dict, minutes: int = ACCESS_TOKEN_EXPIRE_MINUTES) -> str:
     to_encode = data.copy()
     to_encode["exp"] = datetime.utcnow() + timedelta(minutes=minutes)
     return jwt.encode(to_encode, JWT_SECRET, algorithm=JWT_ALG)
 
-def fcm_send_data_tokens(db: Session, tokens: List[str], data: dict, ttl_seconds: int = 60):
+# -----------------------------------------------------------------------------
+# Push notification outbox
+# -----------------------------------------------------------------------------
+PUSH_TRANSPORT = os.getenv("PUSH_TRANSPORT", "fcm")            # fcm | log
+OUTBOX_DISPATCHER = os.getenv("OUTBOX_DISPATCHER", "1") != "0"
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "2"))
+OUTBOX_BATCH_ROWS = int(os.getenv("OUTBOX_BATCH_ROWS", "100"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "6"))
+OUTBOX_BACKOFF_SECONDS = float(os.getenv("OUTBOX_BACKOFF_SECONDS", "5"))
+OUTBOX_RETENTION_DAYS = int(os.getenv("OUTBOX_RETENTION_DAYS", "7"))
+OUTBOX_CLAIM_TIMEOUT = 300   # seconds before a 'sending' row of a dead worker is retried
+FCM_BATCH_SIZE = 500         # send_each limit
+
+def _is_unregistered_error(err: str) -> bool:
+    return ("Unregistered" in err or "NotRegistered" in err or "not registered" in err
+            or "registration-token-not-registered" in err)
+
+DEVICE_TOKEN_CACHE_TTL = int(os.getenv("DEVICE_TOKEN_CACHE_TTL", "300"))
+
+class DeviceTokenCache:
+    """
+    In-process cache of each user's device tokens for notification fan-out.
+    Registration writes through (add), pruning drops tokens (forget); both happen
+    after commit. Entries expire after `ttl` seconds so changes made by other
+    workers or scripts are picked up. A per-user generation guards against storing
+    a load that raced with a write.
+    """
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self._items: Dict[int, Tuple[float, Tuple[str, ...]]] = {}
+        self._holders: Dict[str, set] = {}
+        self._gen: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get_many(self, db: Session, user_ids: Iterable[int]) -> Dict[int, List[str]]:
+        now = time.monotonic()
+        out: Dict[int, List[str]] = {}
+        missing: List[int] = []
+        with self._lock:
+            for u in dict.fromkeys(int(u) for u in user_ids if u):
+                item = self._items.get(u)
+                if item and item[0] > now:
+                    out[u] = list(item[1])
+                    self.hits += 1
+                else:
+                    missing.append(u)
+                    self.misses += 1
+            gens = {u: self._gen.get(u, 0) for u in missing}
+        if missing:
+            loaded: Dict[int, List[str]] = {u: [] for u in missing}
+            for user_id, token in (db.query(DeviceToken.user_id, DeviceToken.token)
+                                     .filter(DeviceToken.user_id.in_(missing))
+                                     .order_by(DeviceToken.id).all()):
+                if token and token not in loaded[user_id]:
+                    loaded[user_id].append(token)
+            with self._lock:
+                for u, toks in loaded.items():
+                    if self._gen.get(u, 0) != gens[u]:
+                        continue
+                    self._items[u] = (now + self.ttl, tuple(toks))
+                    for t in toks:
+                        self._holders.setdefault(t, set()).add(u)
+            out.update(loaded)
+        return out
+
+    def add(self, user_id: int, token: str) -> None:
+        """Token (re)registered to user_id; other cached holders are reloaded on next use."""
+        with self._lock:
+            for u in self._holders.pop(token, set()) - {user_id}:
+                self._drop(u)
+            self._holders[token] = {user_id}
+            self._gen[user_id] = self._gen.get(user_id, 0) + 1
+            item = self._items.get(user_id)
+            if item and token not in item[1]:
+                self._items[user_id] = (item[0], item[1] + (token,))
+
+    def forget(self, tokens: Iterable[str]) -> None:
+        """Tokens deleted from device_tokens."""
+        with self._lock:
+            for t in tokens:
+                for u in self._holders.pop(t, set()):
+                    self._gen[u] = self._gen.get(u, 0) + 1
+                    item = self._items.get(u)
+                    if item:
+                        self._items[u] = (item[0], tuple(x for x in item[1] if x != t))
+
+    def invalidate(self, user_id: Optional[int] = None) -> None:
+        with self._lock:
+            if user_id is None:
+                for u in list(self._items.keys()):
+                    self._drop(u)
+                self._holders.clear()
+            else:
+                self._drop(user_id)
+
+    def _drop(self, user_id: int) -> None:
+        self.invalidations += 1
+        self._gen[user_id] = self._gen.get(user_id, 0) + 1
+        self._items.pop(user_id, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._items),
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 4) if total else None,
+                "invalidations": self.invalidations,
+            }
+
+_device_tokens = DeviceTokenCache(DEVICE_TOKEN_CACHE_TTL)
+
+def get_tokens_for_users(db: Session, user_ids: Iterable[int]) -> Dict[int, List[str]]:
+    """Device tokens of many users ({user_id: [token]}), cache misses resolved in one query."""
+    return _device_tokens.get_many(db, user_ids)
+
+def _delete_device_tokens(db: Session, tokens: Iterable[str]) -> int:
     """
-    Send a data-only message to a list of device tokens.
-    Removes device tokens which return NotRegistered/Unregistered errors.
+    Drop dead device tokens in one DELETE (caller commits); returns how many rows it removed.
+    They leave the token cache when the transaction commits.
     """
+    tokens = set(tokens)
     if not tokens:
-        return
-    webpush_cfg = None
-    try:
-        webpush_cfg = messaging.WebpushConfig(headers={"Urgency": "high"})
-    except Exception:
-        webpush_cfg = None
-    android_cfg = messaging.AndroidConfig(priority="high", ttl=ttl_seconds)
+        return 0
+    deleted = db.query(DeviceToken).filter(DeviceToken.token.in_(tokens)).delete(synchronize_session=False)
+    db.info.setdefault("device_tokens_deleted", set()).update(tokens)
+    return deleted
+
+@event.listens_for(SessionLocal, "after_commit")
+def _device_tokens_forget_on_commit(session):
+    dropped = session.info.pop("device_tokens_deleted", None)
+    if dropped:
+        _device_tokens.forget(dropped)
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _device_tokens_keep_on_rollback(session):
+    session.info.pop("device_tokens_deleted", None)
+
+def enqueue_notification(db: Session, user_ids: Iterable[int], data: dict,
+                         title: Optional[str] = None, body: Optional[str] = None,
+                         options: Optional[dict] = None,
+                         exclude_user_ids: Iterable[int] = ()) -> "NotificationOutbox":
+    """
+    Queue a push to every device of `user_ids` in the caller's transaction.
+    The dispatcher is woken when that transaction commits; nothing is sent on rollback.
+    """
+    row = NotificationOutbox(
+        kind=str(data.get("type") or ""),
+        user_ids=json.dumps(sorted({int(u) for u in user_ids if u})),
+        exclude_user_ids=json.dumps(sorted({int(u) for u in exclude_user_ids if u})),
+        title=title,
+        body=body,
+        data=json.dumps({k: ("" if v is None else str(v)) for k, v in data.items()}),
+        options=json.dumps(options or {}),
+        status="pending",
+        attempts=0,
+        next_attempt_at=datetime.utcnow(),
+    )
+    db.add(row)
+    db.info["outbox_enqueued"] = True
+    return row
+
+@event.listens_for(SessionLocal, "after_commit")
+def _outbox_wake_on_commit(session):
+    if session.info.pop("outbox_enqueued", False):
+        _dispatcher.wake()
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _outbox_forget_on_rollback(session):
+    session.info.pop("outbox_enqueued", None)
+
+class FcmTransport:
+    """
+    Delivers pushes through firebase_admin send_each (up to 500 per call).
+    A transport takes [{token, title, body, data, options}] and returns one
+    error string (or None on success) per push.
+    """
+    def send(self, pushes: List[dict]) -> List[Optional[str]]:
+        if not ensure_firebase_initialized():
+            return ["firebase not initialized"] * len(pushes)
+        out: List[Optional[str]] = []
+        for i in range(0, len(pushes), FCM_BATCH_SIZE):
+            chunk = [self._message(p) for p in pushes[i:i + FCM_BATCH_SIZE]]
+            try:
+                res = messaging.send_each(chunk)
+                out.extend(None if r.success else str(r.exception or "unknown error") for r in res.responses)
+            except Exception as e:
+                out.extend([str(e)] * len(chunk))
+        return out
 
-    for t in list(set(tokens)):
+    @staticmethod
+    def _message(p: dict) -> "messaging.Message":
+        opts = p.get("options") or {}
+        ttl = int(opts.get("ttl", 60))
+        title, body = p.get("title"), p.get("body")
+        channel = opts.get("android_channel")
+        android_cfg = messaging.AndroidConfig(
+            priority="high",
+            ttl=ttl,
+            notification=(messaging.AndroidNotification(
+                channel_id=channel, sound="default", click_action="FLUTTER_NOTIFICATION_CLICK",
+            ) if (channel and title) else None),
+        )
+        apns_cfg = messaging.ApnsConfig(
+            headers={"apns-priority": "10"},
+            payload=messaging.ApnsPayload(aps=messaging.Aps(
+                alert={"title": title, "body": body or ""}, sound=opts.get("apns_sound", "default"))),
+        ) if title else None
+        webpush_cfg = messaging.WebpushConfig(
+            headers={"TTL": str(ttl), "Urgency": "high"},
+            notification=messaging.WebpushNotification(title=title, body=body or "") if title else None,
+        )
+        return messaging.Message(
+            token=p["token"],
+            data=p.get("data") or {},
+            notification=messaging.Notification(title=title, body=body or "") if title else None,
+            android=android_cfg,
+            apns=apns_cfg,
+            webpush=webpush_cfg,
+        )
+
+class LogTransport:
+    """Local fake FCM (PUSH_TRANSPORT=log): logs every push and reports success."""
+    def __init__(self):
+        self.sent: List[dict] = []
+
+    def send(self, pushes: List[dict]) -> List[Optional[str]]:
+        for p in pushes:
+            print(f"PUSH[log]: token={p['token'][:16]} type={(p.get('data') or {}).get('type')} title={p.get('title')!r}")
+        self.sent.extend(pushes)
+        return [None] * len(pushes)
+
+class NotificationDispatcher:
+    """
+    Background worker draining notification_outbox. Rows are claimed with a
+    conditional UPDATE (safe with several app workers), recipients' tokens are
+    resolved in one query, pushes go out in transport batches, transient failures
+    are retried with exponential backoff and unregistered tokens are pruned in one DELETE.
+    """
+    def __init__(self, transport, session_factory=SessionLocal):
+        self.transport = transport
+        self._session_factory = session_factory
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._worker_id = f"{os.getpid()}-{secrets.token_hex(4)}"
+        self._last_cleanup = 0.0
+        self.stats = {"batches": 0, "rows_sent": 0, "rows_failed": 0, "retries": 0,
+                      "pushes_ok": 0, "pushes_failed": 0, "tokens_pruned": 0}
+
+    def start(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="notification-dispatcher", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def wake(self) -> None:
+        self._wake.set()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                n = self.dispatch_once()
+            except Exception as e:
+                print("OUTBOX: dispatch error:", e)
+                n = 0
+            if n < OUTBOX_BATCH_ROWS:
+                self._wake.wait(OUTBOX_POLL_SECONDS)
+                self._wake.clear()
+
+    def dispatch_once(self) -> int:
+        """Claim and deliver one batch of due rows; returns the number of rows handled."""
+        db = self._session_factory()
         try:
-            msg = messaging.Message(
-                data={k: str(v) for k, v in data.items()},
-                token=t,
-                android=android_cfg,
-                webpush=webpush_cfg,
-            )
-            messaging.send(msg)
-        except Exception as e:
-            err = str(e)
-            # Remove tokens that are no longer valid
-            if "Unregistered" in err or "not registered" in err or "registration-token-not-registered" in err:
-                try:
-                    db.query(DeviceToken).filter(DeviceToken.token == t).delete()
-                    db.commit()
-                except Exception:
-                    db.rollback()
+            if time.time() - self._last_cleanup > 3600:
+                self._cleanup(db)
+            rows = self._claim(db)
+            if rows:
+                self._deliver(db, rows)
+            return len(rows)
+        finally:
+            db.close()
+
+    def _cleanup(self, db: Session) -> None:
+        self._last_cleanup = time.time()
+        cutoff = datetime.utcnow() - timedelta(days=OUTBOX_RETENTION_DAYS)
+        db.query(NotificationOutbox).filter(
+            NotificationOutbox.status.in_(["sent", "failed"]),
+            NotificationOutbox.created_at < cutoff,
+        ).delete(synchronize_session=False)
+        db.commit()
+
+    def _claim(self, db: Session) -> List["NotificationOutbox"]:
+        now = datetime.utcnow()
+        db.query(NotificationOutbox).filter(
+            NotificationOutbox.status == "sending",
+            NotificationOutbox.claimed_at < now - timedelta(seconds=OUTBOX_CLAIM_TIMEOUT),
+        ).update({"status": "pending"}, synchronize_session=False)
+        ids = [r[0] for r in (db.query(NotificationOutbox.id)
+                                .filter(NotificationOutbox.status == "pending",
+                                        NotificationOutbox.next_attempt_at <= now)
+                                .order_by(NotificationOutbox.id)
+                                .limit(OUTBOX_BATCH_ROWS)
+                                .all())]
+        if ids:
+            db.query(NotificationOutbox).filter(
+                NotificationOutbox.id.in_(ids), NotificationOutbox.status == "pending",
+            ).update({"status": "sending", "claimed_by": self._worker_id, "claimed_at": now},
+                     synchronize_session=False)
+        db.commit()
+        if not ids:
+            return []
+        return (db.query(NotificationOutbox)
+                  .filter(NotificationOutbox.id.in_(ids),
+                          NotificationOutbox.status == "sending",
+                          NotificationOutbox.claimed_by == self._worker_id)
+                  .order_by(NotificationOutbox.id)
+                  .all())
+
+    def _resolve_tokens(self, db: Session, rows: List["NotificationOutbox"]) -> None:
+        fresh = [r for r in rows if r.tokens is None]
+        if not fresh:
+            return
+        users: set = set()
+        for r in fresh:
+            users.update(json.loads(r.user_ids or "[]"))
+            users.update(json.loads(r.exclude_user_ids or "[]"))
+        by_user = get_tokens_for_users(db, users)
+        for r in fresh:
+            toks: set = set()
+            for u in json.loads(r.user_ids or "[]"):
+                toks.update(by_user.get(u, ()))
+            for u in json.loads(r.exclude_user_ids or "[]"):
+                toks.difference_update(by_user.get(u, ()))
+            r.tokens = json.dumps(sorted(toks))
+
+    def _deliver(self, db: Session, rows: List["NotificationOutbox"]) -> None:
+        self._resolve_tokens(db, rows)
+        pushes: List[dict] = []
+        owners: List[int] = []
+        for r in rows:
+            data = json.loads(r.data or "{}")
+            opts = json.loads(r.options or "{}")
+            for t in json.loads(r.tokens or "[]"):
+                pushes.append({"token": t, "title": r.title, "body": r.body, "data": data, "options": opts})
+                owners.append(r.id)
+
+        results = self.transport.send(pushes) if pushes else []
+        retry: Dict[int, List[str]] = {}
+        errors: Dict[int, str] = {}
+        dead: set = set()
+        for p, row_id, err in zip(pushes, owners, results):
+            if err is None:
+                self.stats["pushes_ok"] += 1
+                continue
+            self.stats["pushes_failed"] += 1
+            if _is_unregistered_error(err):
+                dead.add(p["token"])
             else:
-                # Log and continue; do not raise to avoid failing the whole call
-                print("FCM send error:", err)
+                retry.setdefault(row_id, []).append(p["token"])
+                errors[row_id] = err
+
+        now = datetime.utcnow()
+        for r in rows:
+            r.attempts = (r.attempts or 0) + 1
+            r.claimed_by = None
+            if r.id not in retry:
+                r.status, r.sent_at = "sent", now
+                self.stats["rows_sent"] += 1
+            elif r.attempts >= OUTBOX_MAX_ATTEMPTS:
+                r.status, r.last_error = "failed", errors[r.id][:1000]
+                self.stats["rows_failed"] += 1
+            else:
+                r.status, r.last_error = "pending", errors[r.id][:1000]
+                r.tokens = json.dumps(retry[r.id])
+                r.next_attempt_at = now + timedelta(seconds=OUTBOX_BACKOFF_SECONDS * (2 ** (r.attempts - 1)))
+                self.stats["retries"] += 1
+        pruned = _delete_device_tokens(db, dead)
+        self.stats["tokens_pruned"] += pruned
+        db.commit()
+        self.stats["batches"] += 1
+        print(f"OUTBOX: batch rows={len(rows)} pushes={len(pushes)} retry_rows={len(retry)} pruned={pruned}")
+
+_dispatcher = NotificationDispatcher(LogTransport() if PUSH_TRANSPORT == "log" else FcmTransport())
+
+# ---- authenticated principal cache -------------------------------------------
+PRINCIPAL_CACHE_TTL = int(os.getenv("PRINCIPAL_CACHE_TTL", "60"))
+PRINCIPAL_CACHE_MAX = 10000
+
+class Principal:
+    """Who is calling: enough to authorize without loading the User row."""
+    __slots__ = ("user_id", "role", "doctor_id", "patient_id", "token_version")
+
+    def __init__(self, user_id: int, role: UserRole, doctor_id: Optional[int], patient_id: Optional[int],
+                 token_version: Optional[int] = 0):
+        self.user_id = user_id
+        self.role = role
+        self.doctor_id = doctor_id
+        self.patient_id = patient_id
+        self.token_version = token_version or 0
+
+    @property
+    def id(self) -> int:
+        return self.user_id
+
+class PrincipalCache:
+    """
+    Verified bearer tokens -> Principal, keyed by sha256 of the token. Entries live
+    for `ttl` seconds (never past the JWT's exp) and are dropped when the user,
+    doctor or patient row of that user changes (see the session hooks below).
+    """
+    def __init__(self, ttl: int, max_size: int = PRINCIPAL_CACHE_MAX):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._items: Dict[str, Tuple[float, Principal]] = {}
+        self._by_user: Dict[int, set] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def key(token: str) -> str:
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[Principal]:
+        now = time.time()
+        with self._lock:
+            item = self._items.get(key)
+            if item and item[0] > now:
+                self.hits += 1
+                return item[1]
+            self.misses += 1
+            return None
+
+    def put(self, key: str, principal: Principal, token_exp: Optional[float]) -> None:
+        now = time.time()
+        expires = now + self.ttl
+        if token_exp is not None:
+            expires = min(expires, float(token_exp))
+        with self._lock:
+            if len(self._items) >= self.max_size:
+                self._evict(now)
+            self._items[key] = (expires, principal)
+            self._by_user.setdefault(principal.user_id, set()).add(key)
+
+    def invalidate_user(self, user_id: int) -> None:
+        with self._lock:
+            self.invalidations += 1
+            for key in self._by_user.pop(user_id, set()):
+                self._items.pop(key, None)
+
+    def _evict(self, now: float) -> None:
+        for key, (expires, p) in list(self._items.items()):
+            if expires <= now:
+                self._items.pop(key, None)
+                self._by_user.get(p.user_id, set()).discard(key)
+        while len(self._items) >= self.max_size:
+            key, (_, p) = next(iter(self._items.items()))
+            self._items.pop(key, None)
+            self._by_user.get(p.user_id, set()).discard(key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._items),
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 4) if total else None,
+                "invalidations": self.invalidations,
+            }
+
+_principals = PrincipalCache(PRINCIPAL_CACHE_TTL)
+
+@event.listens_for(SessionLocal, "after_flush")
+def _principals_track_changes(session, flush_context):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, User):
+            uid = obj.id
+        elif isinstance(obj, (Doctor, Patient)):
+            uid = obj.user_id
+        else:
+            continue
+        if uid:
+            session.info.setdefault("principals_changed", set()).add(uid)
 
+@event.listens_for(SessionLocal, "after_commit")
+def _principals_invalidate_on_commit(session):
+    for uid in session.info.pop("principals_changed", ()):
+        _principals.invalidate_user(uid)
 
-def get_current_user(db: Session = Depends(get_db), token: str = Depends(oauth2_scheme)) -> User:
+@event.listens_for(SessionLocal, "after_rollback")
+def _principals_forget_on_rollback(session):
+    session.info.pop("principals_changed", None)
+
+def get_current_principal(db: Session = Depends(get_db), token: str = Depends(oauth2_scheme)) -> Principal:
+    """
+    Authenticate the bearer token. A cache miss checks the user against the DB
+    (one query), so a deleted user or changed role/profile takes effect as soon as
+    the cache entry is dropped; a warm token costs no DB query.
+    """
+    return _authenticate_token(db, token)
+
+def _authenticate_token(db: Session, token: str) -> Principal:
     exc = HTTPException(status_code=401, detail="Could not validate credentials",
                         headers={"WWW-Authenticate": "Bearer"})
+    key = PrincipalCache.key(token)
+    principal = _principals.get(key)
+    if principal:
+        return principal
     try:
         payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALG])
         uid = int(payload.get("sub"))
     except Exception:
         raise exc
-    user = db.get(User, uid)
-    if not user: raise exc
+    # the DB row, not the token's claims, is authoritative: a deleted user or a changed
+    # role/profile must not live on in tokens issued before the change
+    principal = _load_principal(db, uid)
+    if not principal: raise exc
+    if payload.get("typ") == "access" and int(payload.get("tv") or 0) != principal.token_version:
+        raise exc   # issued before a password change
+    _principals.put(key, principal, payload.get("exp"))
+    return principal
+
+def _load_principal(db: Session, user_id: int) -> Optional[Principal]:
+    row = (db.query(User.id, User.role, Doctor.id, Patient.id, User.token_version)
+             .outerjoin(Doctor, Doctor.user_id == User.id)
+             .outerjoin(Patient, Patient.user_id == User.id)
+             .filter(User.id == user_id)
+             .first())
+    return Principal(*row) if row else None
+
+# ---- access / refresh tokens ---------------------------------------------------
+def _access_token_for(principal: Principal) -> str:
+    return create_access_token({
+        "sub": str(principal.user_id),
+        "typ": "access",
+        "role": principal.role.value,
+        "doctor_id": principal.doctor_id,
+        "patient_id": principal.patient_id,
+        "tv": principal.token_version,
+    })
+
+def _new_refresh_token(db: Session, user_id: int, family: Optional[str] = None) -> str:
+    raw = secrets.token_urlsafe(32)
+    now = datetime.utcnow()
+    db.add(RefreshToken(
+        user_id=user_id,
+        family=family or secrets.token_hex(16),
+        token_hash=hashlib.sha256(raw.encode()).hexdigest(),
+        created_at=now,
+        expires_at=now + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS),
+    ))
+    return raw
+
+def _issue_tokens(db: Session, principal: Principal, family: Optional[str] = None) -> "Token":
+    """Short-lived access token plus a refresh token (new family on login); commits."""
+    refresh = _new_refresh_token(db, principal.user_id, family)
+    db.query(RefreshToken).filter(RefreshToken.user_id == principal.user_id,
+                                  RefreshToken.expires_at < datetime.utcnow()).delete(synchronize_session=False)
+    db.commit()
+    return Token(access_token=_access_token_for(principal), refresh_token=refresh,
+                 expires_in=ACCESS_TOKEN_EXPIRE_MINUTES * 60)
+
+def _revoke_refresh_tokens(db: Session, user_id: Optional[int] = None, family: Optional[str] = None) -> int:
+    """Revoke a whole family, or every live refresh token of a user (caller commits)."""
+    q = db.query(RefreshToken).filter(RefreshToken.revoked_at.is_(None))
+    q = q.filter(RefreshToken.family == family) if family else q.filter(RefreshToken.user_id == user_id)
+    return q.update({"revoked_at": datetime.utcnow()}, synchronize_session=False)
+
+def require_principal(*roles: UserRole):
+    def _dep(curr: Principal = Depends(get_current_principal)):
+        if curr.role not in roles:
+            raise HTTPException(403, "Insufficient permissions")
+        return curr
+    return _dep
+
+def _principal_on_appt(curr: Principal, appt: "Appointment") -> bool:
+    """Admin, or the doctor/patient of the appointment (compares profile ids, no lazy loads)."""
+    return (
+        curr.role == UserRole.admin
+        or (curr.role == UserRole.doctor and curr.doctor_id is not None and appt.doctor_id == curr.doctor_id)
+        or (curr.role == UserRole.patient and curr.patient_id is not None and appt.patient_id == curr.patient_id)
+    )
+
+def get_current_user(db: Session = Depends(get_db), principal: Principal = Depends(get_current_principal)) -> User:
+    user = db.get(User, principal.user_id)
+    if not user:
+        _principals.invalidate_user(principal.user_id)
+        raise HTTPException(status_code=401, detail="Could not validate credentials",
+                            headers={"WWW-Authenticate": "Bearer"})
     return user
 
 def require_role(*roles: UserRole):
@@ -560,137 +1362,203 @@ def require_role(*roles: UserRole):
 
 def hour_range(start: int, end: int) -> Iterable[int]: return range(start, end)
 
-def _active_rule_for(db: Session, doctor_id: int, day_dt: datetime, start_h: int, end_h: int) -> Optional[dict]:
+# ---- compiled schedule cache -------------------------------------------------
+SCHEDULE_CACHE_TTL = int(os.getenv("SCHEDULE_CACHE_TTL", "300"))
+
+def _load_schedules(db: Session, doctor_ids: List[int],
+                    start_d: Optional[dt_date] = None, end_d: Optional[dt_date] = None) -> Dict[int, dict]:
+    """
+    Compile active rules for many doctors in two grouped queries.
+    Returns {doctor_id: {"weekly": {dow_sun0: [rule]}, "dated": {date: [rule]}}} where
+    rule = (id, start_hour, end_hour, max_patients, mode), lists ordered by start_hour.
+    Dated rules can be limited to [start_d, end_d].
+    """
+    out: Dict[int, dict] = {d: {"weekly": {}, "dated": {}} for d in doctor_ids}
+    if not doctor_ids:
+        return out
+    avs = (db.query(Availability)
+             .filter(Availability.doctor_id.in_(doctor_ids), Availability.active == True)
+             .order_by(Availability.start_hour, Availability.id)
+             .all())
+    for a in avs:
+        out[a.doctor_id]["weekly"].setdefault(int(a.day_of_week), []).append(
+            (a.id, int(a.start_hour), int(a.end_hour), int(a.max_patients), a.mode))
+    q = db.query(DateRule).filter(DateRule.doctor_id.in_(doctor_ids), DateRule.active == True)
+    if start_d:
+        q = q.filter(DateRule.target_date >= start_d)
+    if end_d:
+        q = q.filter(DateRule.target_date <= end_d)
+    drs = q.order_by(DateRule.start_hour, DateRule.id).all()
+    for r in drs:
+        out[r.doctor_id]["dated"].setdefault(r.target_date, []).append(
+            (r.id, int(r.start_hour), int(r.end_hour), int(r.max_patients), r.mode))
+    return out
+
+def _schedule_windows_for(sched: dict, day: dt_date) -> list:
+    """Rule windows for a day: dated rules for that date, else the weekly rules."""
+    return sched["dated"].get(day) or sched["weekly"].get((day.weekday() + 1) % 7, [])
+
+def _schedule_rule_for(sched: dict, day: dt_date, start_h: int, end_h: int) -> Optional[tuple]:
+    """Covering DateRule first, then covering weekly rule (lowest id wins)."""
+    for rules in (sched["dated"].get(day, []), sched["weekly"].get((day.weekday() + 1) % 7, [])):
+        covering = [r for r in rules if r[1] <= start_h and r[2] >= end_h]
+        if covering:
+            return min(covering)  # lowest id, like .first()
+    return None
+
+class ScheduleCache:
+    """
+    In-process cache of compiled per-doctor schedules (see _load_schedules).
+    Each read first fetches the doctors' schedule_version (one indexed query) and
+    only uses entries stored under the same version, so a rule edit committed on
+    any worker takes effect everywhere at once; `ttl` is just a backstop. Writers
+    call _schedule_touch before commit and invalidate(doctor_id) after it. A
+    per-doctor generation guards against storing a load that raced with an
+    invalidation.
+    """
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self._items: Dict[int, Tuple[float, int, dict]] = {}   # doctor -> (expires, version, schedule)
+        self._gen: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.invalidations = 0
+
+    def get_many(self, db: Session, doctor_ids: List[int]) -> Dict[int, dict]:
+        now = time.monotonic()
+        out: Dict[int, dict] = {}
+        if not doctor_ids:
+            return out
+        versions = {d: v or 0 for d, v in db.query(Doctor.id, Doctor.schedule_version)
+                                              .filter(Doctor.id.in_(doctor_ids)).all()}
+        missing: List[int] = []
+        with self._lock:
+            for d in doctor_ids:
+                item = self._items.get(d)
+                if item and item[0] > now and item[1] == versions.get(d, 0):
+                    out[d] = item[2]
+                    self.hits += 1
+                else:
+                    if item and item[0] > now:
+                        self.stale += 1
+                    missing.append(d)
+                    self.misses += 1
+            gens = {d: self._gen.get(d, 0) for d in missing}
+        if missing:
+            loaded = _load_schedules(db, missing)
+            with self._lock:
+                for d, sched in loaded.items():
+                    if self._gen.get(d, 0) == gens[d]:
+                        self._items[d] = (now + self.ttl, versions.get(d, 0), sched)
+            out.update(loaded)
+        return out
+
+    def get(self, db: Session, doctor_id: int) -> dict:
+        return self.get_many(db, [doctor_id])[doctor_id]
+
+    def invalidate(self, doctor_id: Optional[int] = None) -> None:
+        with self._lock:
+            self.invalidations += 1
+            if doctor_id is None:
+                for d in list(self._items.keys()):
+                    self._gen[d] = self._gen.get(d, 0) + 1
+                self._items.clear()
+            else:
+                self._gen[doctor_id] = self._gen.get(doctor_id, 0) + 1
+                self._items.pop(doctor_id, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._items),
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 4) if total else None,
+                "stale": self.stale,
+                "invalidations": self.invalidations,
+            }
+
+_schedule_cache = ScheduleCache(SCHEDULE_CACHE_TTL)
+
+def _schedule_touch(db: Session, doctor_id: int) -> None:
+    """
+    Give the doctor a new schedule_version in the caller's transaction, so every
+    worker's ScheduleCache drops its copy once this commits. Random rather than +1:
+    a version from a rolled-back edit is never reused for different rules.
+    """
+    db.query(Doctor).filter(Doctor.id == doctor_id).update(
+        {"schedule_version": secrets.randbits(31)}, synchronize_session=False)
+
+def _resolve_schedule_window(db: Session, doctor_id: int, start: datetime,
+                             end: Optional[datetime] = None) -> Tuple[datetime, datetime, int]:
+    """
+    Schedule window (start, end, max_patients) an appointment belongs to, for serials:
+    covering DateRule of that date, else its first DateRule; then covering weekly rule,
+    else the first one (either weekday convention); else the appointment's own time.
+    """
+    sched = _schedule_cache.get(db, doctor_id)
+    day = start.date()
+    mon0 = start.weekday()
+    weekly = sched["weekly"].get(mon0, []) + sched["weekly"].get((mon0 + 1) % 7, [])
+    for rules in (sched["dated"].get(day, []), weekly):
+        if not rules:
+            continue
+        rules = sorted(rules)  # by id, i.e. query order
+        midnight = datetime(day.year, day.month, day.day)
+        pick = next((r for r in rules
+                     if midnight + timedelta(hours=r[1]) <= start < midnight + timedelta(hours=r[2])), rules[0])
+        return midnight + timedelta(hours=pick[1]), midnight + timedelta(hours=pick[2]), pick[3]
+    return start, (end or start + timedelta(hours=1)), 1
+
+def _active_rule_for(db: Session, doctor_id: int, day_dt: datetime, start_h: int, end_h: int,
+                     sched: Optional[dict] = None) -> Optional[dict]:
     """
     Returns a dict describing capacity window for this hour slot if active.
     Preference: DateRule for that exact date; otherwise Availability rule.
+    Served from the compiled schedule cache unless `sched` is supplied.
     """
-    dr = (db.query(DateRule)
-            .filter(DateRule.doctor_id == doctor_id,
-                    DateRule.target_date == dt_date(day_dt.year, day_dt.month, day_dt.day),
-                    DateRule.active == True,
-                    DateRule.start_hour <= start_h,
-                    DateRule.end_hour >= end_h)
-            .first())
-    if dr:
-        return {"max_patients": dr.max_patients, "mode": dr.mode}
-
-    dow = day_dt.weekday()  # 0=Mon..6=Sun
-    dow_sun0 = (dow + 1) % 7
-    av = (db.query(Availability)
-            .filter(Availability.doctor_id == doctor_id,
-                    Availability.day_of_week == dow_sun0,
-                    Availability.active == True,
-                    Availability.start_hour <= start_h,
-                    Availability.end_hour >= end_h)
-            .first())
-    if av:
-        return {"max_patients": av.max_patients, "mode": av.mode}
+    if sched is None:
+        sched = _schedule_cache.get(db, doctor_id)
+    rule = _schedule_rule_for(sched, dt_date(day_dt.year, day_dt.month, day_dt.day), start_h, end_h)
+    if rule:
+        return {"max_patients": rule[3], "mode": rule[4]}
     return None
 
-def slot_capacity_left(db: Session, doctor_id: int, start: datetime, end: datetime) -> int:
-    rule = _active_rule_for(db, doctor_id, start, start.hour, end.hour if end.minute == 0 else end.hour + 1)
+def slot_capacity_left(db: Session, doctor_id: int, start: datetime, end: datetime,
+                       sched: Optional[dict] = None) -> int:
+    rule = _active_rule_for(db, doctor_id, start, start.hour, end.hour if end.minute == 0 else end.hour + 1, sched)
     if not rule: return 0
-    count = (db.query(Appointment)
-               .filter(Appointment.doctor_id == doctor_id,
-                       Appointment.start_time == start,
-                       Appointment.end_time == end,
-                       Appointment.status.in_([AppointmentStatus.requested, AppointmentStatus.approved]))
-               .count())
+    count = _booking_index(db, doctor_id, start.date()).exact_count(start, end)
     return max(0, int(rule["max_patients"]) - count)
 
 def gen_slots_for_date(db: Session, doctor_id: int, day: dt_date) -> List[datetime]:
-    drs = (db.query(DateRule)
-             .filter(DateRule.doctor_id == doctor_id,
-                     DateRule.target_date == day,
-                     DateRule.active == True)
-             .all())
+    sched = _schedule_cache.get(db, doctor_id)
     out: List[datetime] = []
-    def _append_by_hours(start_h: int, end_h: int):
+    for (_, start_h, end_h, _, _) in _schedule_windows_for(sched, day):
         for h in hour_range(start_h, end_h):
             st = datetime(day.year, day.month, day.day, h)
             en = st + timedelta(hours=1)
-            if slot_capacity_left(db, doctor_id, st, en) > 0:
+            if slot_capacity_left(db, doctor_id, st, en, sched) > 0:
                 out.append(st)
-
-    if drs:
-        for r in drs:
-            _append_by_hours(r.start_hour, r.end_hour)
-        return out
-
-    dow_mon0 = dt_date.weekday(day)  # 0=Mon..6=Sun
-    dow_sun0 = (dow_mon0 + 1) % 7
-    avails = (db.query(Availability)
-                .filter(Availability.doctor_id == doctor_id,
-                        Availability.day_of_week == dow_sun0,
-                        Availability.active == True)
-                .all())
-    for a in avails:
-        _append_by_hours(a.start_hour, a.end_hour)
     return out
 
 # ---------- <<CALL_TIMEOUT_AND_INTERNAL_END>> ----------
-def _notify_end_call_tokens(db: Session, tokens: List[str], appt_id: int, cl: Optional[CallLog], title: str, body: str):
-    """Notify tokens with a standardized video_end payload."""
-    try:
-        if not tokens:
-            return
-        payload = {"type": "video_end", "appointment_id": str(appt_id)}
-        if cl:
-            payload["call_log_id"] = str(cl.id)
-            payload["message_id"] = f"call_{cl.id}_end"
-        multicast = messaging.MulticastMessage(
-            notification=messaging.Notification(title=title, body=body),
-            data={k: str(v) for k, v in payload.items()},
-            tokens=list(set(tokens)),
-        )
-        res = messaging.send_multicast(multicast)
-        print(f"_notify_end_call_tokens: sent success={res.success_count} failed={res.failure_count}")
-    except Exception as e:
-        print("_notify_end_call_tokens: error:", e)
-
-def _notify_chat_message(db: Session, appointment: Appointment, message_row: Message):
-    """
-    Send a data-only FCM message to the other party for the given message.
-    Payload contains message_id, appointment_id, sender_id, body and type=chat_message.
-    """
-    try:
-        # find recipient: if message_row.recipient_user_id provided use it,
-        # else compute as the other user on the appointment
-        recipient_id = message_row.recipient_user_id
-        if not recipient_id:
-            # appointment.patient.user_id and appointment.doctor.user_id exist
-            if appointment.patient and appointment.patient.user_id == message_row.sender_user_id:
-                recipient_id = appointment.doctor.user_id
-            elif appointment.doctor and appointment.doctor.user_id == message_row.sender_user_id:
-                recipient_id = appointment.patient.user_id
-            else:
-                # As fallback, send to both
-                recipient_id = None
-
-        tokens = []
-        if recipient_id:
-            tokens_q = db.query(DeviceToken).filter(DeviceToken.user_id == recipient_id).all()
-            tokens = [t.token for t in tokens_q if t and t.token]
-        else:
-            # fallback: notify both sides
-            dr = db.query(DeviceToken).filter(DeviceToken.user_id == appointment.patient.user_id).all()
-            pr = db.query(DeviceToken).filter(DeviceToken.user_id == appointment.doctor.user_id).all()
-            tokens = [t.token for t in (dr + pr) if t and t.token]
-
-        if not tokens:
-            return
-
-        data_payload = {
-            "type": "chat_message",
-            "appointment_id": str(appointment.id),
-            "message_id": str(message_row.id),
-            "sender_id": str(message_row.sender_user_id),
-            "body": (message_row.body or "")[:1000],  # keep small
-        }
-        fcm_send_data_tokens(db, tokens, data_payload, ttl_seconds=3600)
-    except Exception as e:
-        print("_notify_chat_message error:", e)
+def _notify_end_call(db: Session, appt: Appointment, cl: Optional[CallLog], title: str, body: str):
+    """Queue a standardized video_end push to both doctor and patient."""
+    user_ids = [appt.doctor.user_id if appt.doctor else None, appt.patient.user_id if appt.patient else None]
+    _enqueue_video_end(db, appt.id, cl.id if cl else None, user_ids, title, body)
+
+def _enqueue_video_end(db: Session, appointment_id: int, call_log_id: Optional[int],
+                       user_ids: List[Optional[int]], title: str, body: str):
+    payload = {"type": "video_end", "appointment_id": str(appointment_id)}
+    if call_log_id:
+        payload["call_log_id"] = str(call_log_id)
+        payload["message_id"] = f"call_{call_log_id}_end"
+    enqueue_notification(db, user_ids, payload, title=title, body=body)
 
 def _end_call_internal(db: Session, appointment_id: int, call_log_id: Optional[int] = None, reason: str = "ended", by: Optional[str] = None):
     """
@@ -719,6 +1587,7 @@ def _end_call_internal(db: Session, appointment_id: int, call_log_id: Optional[i
             )
 
         if cl:
+            cl.timeout_at = None
             if not cl.ended_at:
                 cl.ended_at = datetime.utcnow()
                 cl.status = "missed" if reason == "missed" else "ended"
@@ -728,26 +1597,15 @@ def _end_call_internal(db: Session, appointment_id: int, call_log_id: Optional[i
                         cl.duration = int((cl.ended_at - cl.answered_at).total_seconds())
                 except Exception:
                     pass
-                db.commit()
         else:
-            # no call log found: nothing to update in DB, but we still notify tokens
+            # no call log found: nothing to update in DB, but we still notify both sides
             pass
 
-        # Notify doctor and patient tokens
-        try:
-            dr_tokens_q = db.query(DeviceToken).filter(DeviceToken.user_id == appt.doctor.user_id).all()
-            dr_tokens = [t.token for t in dr_tokens_q if t and t.token]
-            _notify_end_call_tokens(db, dr_tokens, appointment_id, cl, "Call ended", f"Call ended for appointment #{appointment_id}")
-        except Exception as e:
-            print("_end_call_internal: failed to notify doctor tokens:", e)
-
-        try:
-            p_tokens_q = db.query(DeviceToken).filter(DeviceToken.user_id == appt.patient.user_id).all()
-            p_tokens = [t.token for t in p_tokens_q if t and t.token]
-            _notify_end_call_tokens(db, p_tokens, appointment_id, cl, "Call ended", f"Call ended for appointment #{appointment_id}")
-        except Exception as e:
-            print("_end_call_internal: failed to notify patient tokens:", e)
-
+        # Queue video_end for doctor and patient together with the CallLog update
+        _notify_end_call(db, appt, cl, "Call ended", f"Call ended for appointment #{appointment_id}")
+        db.commit()
+        if cl:
+            _call_timeouts.cancel(cl.id)
         return True
     except Exception as e:
         print("_end_call_internal error:", e)
@@ -755,40 +1613,195 @@ def _end_call_internal(db: Session, appointment_id: int, call_log_id: Optional[i
         return False
 
 
-def schedule_call_timeout(appointment_id: int, call_log_id: int, timeout_seconds: int = 60):
+CALL_RING_TIMEOUT = int(os.getenv("CALL_RING_TIMEOUT", "60"))
+CALL_REAPER_SECONDS = float(os.getenv("CALL_REAPER_SECONDS", "30"))
+
+def reap_missed_calls(db: Session, now: Optional[datetime] = None) -> List[int]:
     """
-    Schedule a background Timer to auto-end the call if it remains ringing for timeout_seconds.
-    This uses a separate DB session per timer.
+    Mark every CallLog still ringing after CALL_RING_TIMEOUT as missed in one UPDATE
+    and queue their video_end pushes in the same commit (as _end_call_internal does
+    for a single call). Safe to run from several workers: rows are claimed by
+    stamping ended_at, so each call is reaped once. Returns the reaped call_log ids.
     """
-    def _worker(appt_id: int, cl_id: int, tsec: int):
+    now = now or datetime.utcnow()
+    cutoff = now - timedelta(seconds=CALL_RING_TIMEOUT)
+    ringing = [r[0] for r in (db.query(CallLog.id)
+                                .filter(CallLog.status == "ringing",
+                                        CallLog.started_at < cutoff,
+                                        CallLog.answered_at.is_(None),
+                                        CallLog.ended_at.is_(None))
+                                .all())]
+    if not ringing:
+        return []
+    db.query(CallLog).filter(
+        CallLog.id.in_(ringing),
+        CallLog.status == "ringing",
+        CallLog.answered_at.is_(None),
+        CallLog.ended_at.is_(None),
+    ).update({"status": "missed", "ended_at": now, "timeout_at": None}, synchronize_session=False)
+    reaped = (db.query(CallLog.id, CallLog.appointment_id, Doctor.user_id, Patient.user_id)
+                .join(Appointment, Appointment.id == CallLog.appointment_id)
+                .outerjoin(Doctor, Doctor.id == Appointment.doctor_id)
+                .outerjoin(Patient, Patient.id == Appointment.patient_id)
+                .filter(CallLog.id.in_(ringing), CallLog.status == "missed", CallLog.ended_at == now)
+                .all())
+    for cl_id, appt_id, doctor_uid, patient_uid in reaped:
+        _enqueue_video_end(db, appt_id, cl_id, [doctor_uid, patient_uid],
+                           "Call ended", f"Call ended for appointment #{appt_id}")
+    db.commit()
+    ids = [r[0] for r in reaped]
+    if ids:
+        print(f"CALL_REAPER: marked {len(ids)} ringing call(s) missed")
+    return ids
+
+class CallTimeoutScheduler:
+    """
+    One timer thread for every ringing call. Deadlines sit in a heap keyed by
+    CallLog.timeout_at (persisted, so ringing calls are recovered at startup);
+    cancel() drops a timer at once (lazy removal from the heap). Firing clears
+    timeout_at with a conditional UPDATE, so only one worker marks a call missed
+    and an answer/end that won the race is left alone. Every CALL_REAPER_SECONDS
+    the same thread sweeps up calls whose timer was lost (reap_missed_calls).
+    """
+    def __init__(self, session_factory=SessionLocal):
+        self._session_factory = session_factory
+        self._heap: List[Tuple[datetime, int, int]] = []   # (deadline, call_log_id, appointment_id)
+        self._pending: Dict[int, datetime] = {}
+        self._cond = threading.Condition()
+        self._stop = False
+        self._thread: Optional[threading.Thread] = None
+        self._next_sweep = time.monotonic() + CALL_REAPER_SECONDS
+        self.stats = {"scheduled": 0, "cancelled": 0, "fired": 0, "missed": 0, "recovered": 0,
+                      "sweeps": 0, "reaped": 0}
+
+    def start(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, name="call-timeouts", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def schedule(self, appointment_id: int, call_log_id: int, deadline: datetime) -> None:
+        with self._cond:
+            self._pending[call_log_id] = deadline
+            heappush(self._heap, (deadline, call_log_id, appointment_id))
+            self.stats["scheduled"] += 1
+            self._cond.notify()
+
+    def cancel(self, call_log_id: int) -> None:
+        with self._cond:
+            if self._pending.pop(call_log_id, None) is not None:
+                self.stats["cancelled"] += 1
+
+    def recover(self) -> int:
+        """Re-arm every persisted ringing call (run once at startup)."""
+        db = self._session_factory()
         try:
-            print(f"SCHEDULE_CALL_TIMEOUT: sleeping {tsec}s for appt={appt_id} cl={cl_id}")
-            time.sleep(tsec)
-            db = SessionLocal()
-            try:
-                cl = db.get(CallLog, cl_id)
-                if not cl:
-                    print(f"SCHEDULE_CALL_TIMEOUT: call_log {cl_id} missing (already ended?)")
-                    return
-                # Only end if still ringing (no answered_at and no ended_at)
-                if cl.ended_at:
-                    print(f"SCHEDULE_CALL_TIMEOUT: call_log {cl_id} already ended at {cl.ended_at}")
-                    return
-                # If already answered, do not mark missed
-                if cl.answered_at:
-                    print(f"SCHEDULE_CALL_TIMEOUT: call_log {cl_id} already answered at {cl.answered_at}")
+            rows = (db.query(CallLog.id, CallLog.appointment_id, CallLog.timeout_at)
+                      .filter(CallLog.timeout_at.isnot(None),
+                              CallLog.answered_at.is_(None),
+                              CallLog.ended_at.is_(None))
+                      .all())
+        finally:
+            db.close()
+        for cl_id, appt_id, deadline in rows:
+            self.schedule(appt_id, cl_id, deadline)
+        self.stats["recovered"] += len(rows)
+        print(f"CALL_TIMEOUTS: recovered {len(rows)} ringing call(s)")
+        return len(rows)
+
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._pending)
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                due: List[Tuple[int, int]] = []
+                sweep = False
+                while not self._stop:
+                    # discard cancelled / superseded entries at the top of the heap
+                    while self._heap and self._pending.get(self._heap[0][1]) != self._heap[0][0]:
+                        heappop(self._heap)
+                    now = datetime.utcnow()
+                    while self._heap and self._heap[0][0] <= now:
+                        deadline, cl_id, appt_id = heappop(self._heap)
+                        if self._pending.get(cl_id) == deadline:
+                            del self._pending[cl_id]
+                            due.append((appt_id, cl_id))
+                    sweep_in = self._next_sweep - time.monotonic()
+                    if due or sweep_in <= 0:
+                        sweep = sweep_in <= 0
+                        break
+                    wait = sweep_in
+                    if self._heap:
+                        wait = min(wait, (self._heap[0][0] - now).total_seconds())
+                    self._cond.wait(wait)
+                if self._stop:
                     return
-                # Mark as missed through internal end helper
-                print(f"SCHEDULE_CALL_TIMEOUT: auto-ending call_log {cl_id} (missed)")
-                _end_call_internal(db, appt_id, cl_id, reason="missed", by="system")
-            finally:
-                db.close()
+            for appt_id, cl_id in due:
+                try:
+                    self._fire(appt_id, cl_id)
+                except Exception as ex:
+                    print("CALL_TIMEOUTS: fire error:", ex)
+            if sweep:
+                self._next_sweep = time.monotonic() + CALL_REAPER_SECONDS
+                self.sweep()
+
+    def sweep(self) -> List[int]:
+        """Run reap_missed_calls and drop the timers of the calls it ended."""
+        db = self._session_factory()
+        try:
+            ids = reap_missed_calls(db)
         except Exception as ex:
-            print("SCHEDULE_CALL_TIMEOUT: worker error:", ex)
+            db.rollback()
+            print("CALL_REAPER: sweep error:", ex)
+            ids = []
+        finally:
+            db.close()
+        with self._cond:
+            for cl_id in ids:
+                self._pending.pop(cl_id, None)
+            self.stats["sweeps"] += 1
+            self.stats["reaped"] += len(ids)
+        return ids
+
+    def _fire(self, appointment_id: int, call_log_id: int) -> None:
+        self.stats["fired"] += 1
+        db = self._session_factory()
+        try:
+            claimed = (db.query(CallLog)
+                         .filter(CallLog.id == call_log_id,
+                                 CallLog.timeout_at.isnot(None),
+                                 CallLog.answered_at.is_(None),
+                                 CallLog.ended_at.is_(None))
+                         .update({"timeout_at": None}, synchronize_session=False))
+            if not claimed:
+                db.rollback()
+                return
+            print(f"CALL_TIMEOUTS: auto-ending call_log {call_log_id} (missed)")
+            if _end_call_internal(db, appointment_id, call_log_id, reason="missed", by="system"):
+                self.stats["missed"] += 1
+        finally:
+            db.close()
+
+_call_timeouts = CallTimeoutScheduler()
 
-    t = threading.Thread(target=_worker, args=(appointment_id, call_log_id, timeout_seconds), daemon=True)
-    t.start()
-    print(f"SCHEDULE_CALL_TIMEOUT: scheduled for appt={appointment_id} cl={call_log_id} in {timeout_seconds}s")
+def schedule_call_timeout(appointment_id: int, call_log_id: int, timeout_seconds: int = CALL_RING_TIMEOUT,
+                          deadline: Optional[datetime] = None):
+    """
+    Arm the auto-end timer for a ringing call. Callers persist the same deadline
+    in CallLog.timeout_at so it survives a restart.
+    """
+    deadline = deadline or (datetime.utcnow() + timedelta(seconds=timeout_seconds))
+    _call_timeouts.schedule(appointment_id, call_log_id, deadline)
 # ---------- <<END CALL_TIMEOUT_AND_INTERNAL>> ----------
 
 
@@ -796,70 +1809,315 @@ def schedule_call_timeout(appointment_id: int, call_log_id: int, timeout_seconds
 def _overlap(a_start: datetime, a_end: datetime, b_start: datetime, b_end: datetime) -> bool:
     return (a_start < b_end) and (b_start < a_end)
 
-def block_capacity_left(db: Session, doctor_id: int, start: datetime, end: datetime) -> int:
+# ---- booking interval index ---------------------------------------------------
+class BookingIndex:
+    """
+    Active (requested/approved) bookings of one doctor overlapping one day.
+    Sorted starts/ends give overlap counts by bisection; exact spans are counted directly.
+    """
+    __slots__ = ("starts", "ends", "spans")
+
+    def __init__(self, spans: Iterable[Tuple[datetime, datetime]] = ()):
+        spans = list(spans)
+        self.starts = sorted(st for st, _ in spans)
+        self.ends = sorted(en for _, en in spans)
+        self.spans = Counter(spans)
+
+    def overlapping(self, start: datetime, end: datetime) -> int:
+        """Bookings with start_time < end and end_time > start."""
+        # every booking ending at/before `start` also starts before `end`
+        return bisect_left(self.starts, end) - bisect_right(self.ends, start)
+
+    def exact_count(self, start: datetime, end: datetime) -> int:
+        return self.spans.get((start, end), 0)
+
+def _load_booking_indexes(db: Session, doctor_ids: List[int], start_d: dt_date, end_d: dt_date) -> Dict[int, Dict[dt_date, BookingIndex]]:
+    """One query for many doctors/days: {doctor_id: {date: BookingIndex}} (days without bookings omitted)."""
+    out: Dict[int, Dict[dt_date, BookingIndex]] = {d: {} for d in doctor_ids}
+    if not doctor_ids:
+        return out
+    win_st = datetime(start_d.year, start_d.month, start_d.day)
+    win_en = datetime(end_d.year, end_d.month, end_d.day) + timedelta(days=1)
+    rows = (db.query(Appointment.doctor_id, Appointment.start_time, Appointment.end_time)
+              .filter(Appointment.doctor_id.in_(doctor_ids),
+                      Appointment.status.in_([AppointmentStatus.requested, AppointmentStatus.approved]),
+                      Appointment.start_time < win_en,
+                      Appointment.end_time > win_st)
+              .all())
+    buckets: Dict[int, Dict[dt_date, list]] = {d: {} for d in doctor_ids}
+    for doctor_id, st, en in rows:
+        d = max(st.date(), start_d)
+        while d <= min(en.date(), end_d):
+            buckets[doctor_id].setdefault(d, []).append((st, en))
+            d += timedelta(days=1)
+    for doctor_id, days in buckets.items():
+        for d, spans in days.items():
+            out[doctor_id][d] = BookingIndex(spans)
+    return out
+
+def _prefetch_booking_index(db: Session, doctor_id: int, start_d: dt_date, end_d: dt_date) -> None:
+    """Load a day range into the session's index cache with a single query."""
+    cache = db.info.setdefault("booking_index", {})
+    loaded = _load_booking_indexes(db, [doctor_id], start_d, end_d)[doctor_id]
+    d = start_d
+    while d <= end_d:
+        cache[(doctor_id, d)] = loaded.get(d) or BookingIndex()
+        d += timedelta(days=1)
+
+def _booking_index(db: Session, doctor_id: int, day: dt_date) -> BookingIndex:
+    """
+    Per-session cached index for a doctor/day. Dropped on every flush and
+    transaction end, so writes in the same session are always seen.
+    """
+    cache = db.info.setdefault("booking_index", {})
+    idx = cache.get((doctor_id, day))
+    if idx is None:
+        idx = _load_booking_indexes(db, [doctor_id], day, day)[doctor_id].get(day) or BookingIndex()
+        cache[(doctor_id, day)] = idx
+    return idx
+
+@event.listens_for(SessionLocal, "after_flush")
+def _drop_booking_index_on_flush(session, flush_context):
+    session.info.pop("booking_index", None)
+
+@event.listens_for(SessionLocal, "after_transaction_end")
+def _drop_booking_index_on_tx_end(session, transaction):
+    session.info.pop("booking_index", None)
+
+def block_capacity_left(db: Session, doctor_id: int, start: datetime, end: datetime,
+                        sched: Optional[dict] = None) -> int:
     """Capacity left for the exact [start,end) window, counting ANY overlapping bookings."""
-    rule = _active_rule_for(db, doctor_id, start, start.hour, end.hour if end.minute == 0 else end.hour + 1)
+    rule = _active_rule_for(db, doctor_id, start, start.hour, end.hour if end.minute == 0 else end.hour + 1, sched)
     if not rule:
         return 0
-    taken = (
-        db.query(Appointment)
-          .filter(
-              Appointment.doctor_id == doctor_id,
-              Appointment.status.in_([AppointmentStatus.requested, AppointmentStatus.approved]),
-              Appointment.start_time < end,
-              Appointment.end_time > start,
-          ).count()
-    )
+    day = start.date()
+    if end <= datetime(day.year, day.month, day.day) + timedelta(days=1):
+        taken = _booking_index(db, doctor_id, day).overlapping(start, end)
+    else:
+        # window spills past midnight: not covered by a single day index
+        taken = (
+            db.query(Appointment)
+              .filter(
+                  Appointment.doctor_id == doctor_id,
+                  Appointment.status.in_([AppointmentStatus.requested, AppointmentStatus.approved]),
+                  Appointment.start_time < end,
+                  Appointment.end_time > start,
+              ).count()
+        )
     return max(0, int(rule["max_patients"]) - taken)
 
 def gen_blocks_for_date(
     db: Session, doctor_id: int, day: dt_date, mode: Optional[str] = None
 ) -> List[Tuple[datetime, datetime]]:
     """Return availability windows (not split by hour) for a day, honoring visit mode."""
+    sched = _schedule_cache.get(db, doctor_id)
     out: List[Tuple[datetime, datetime]] = []
+    for (_, start_h, end_h, _, r_mode) in _schedule_windows_for(sched, day):
+        if mode and r_mode != mode:
+            continue
+        st = datetime(day.year, day.month, day.day, start_h)
+        en = datetime(day.year, day.month, day.day, end_h)
+        if block_capacity_left(db, doctor_id, st, en, sched) > 0:
+            out.append((st, en))
+    return out
+
+# ---- availability calendar (materialized) ------------------------------------
+def _calendar_build_rows(db: Session, doctor_id: int, day: dt_date,
+                         sched: Optional[dict] = None) -> List[AvailabilityCalendar]:
+    """
+    Compute calendar rows for one doctor/day from the rules and live bookings.
+    Rows get persisted, so rules are read through `db`, never _schedule_cache: a
+    stale cached schedule would otherwise be stored until the next rule change.
+    """
+    if sched is None:
+        sched = _load_schedules(db, [doctor_id], day, day)[doctor_id]
+    rows: List[AvailabilityCalendar] = []
+    for (_, start_h, end_h, _, mode) in _schedule_windows_for(sched, day):
+        st = datetime(day.year, day.month, day.day, start_h)
+        en = datetime(day.year, day.month, day.day, end_h)
+        block_left = block_capacity_left(db, doctor_id, st, en, sched)
+        for h in hour_range(start_h, end_h):
+            h_st = datetime(day.year, day.month, day.day, h)
+            rows.append(AvailabilityCalendar(
+                doctor_id=doctor_id, day=day, hour=h, mode=mode,
+                block_start=start_h, block_end=end_h,
+                block_capacity_left=block_left,
+                slot_capacity_left=slot_capacity_left(db, doctor_id, h_st, h_st + timedelta(hours=1), sched),
+            ))
+    return rows
+
+def _calendar_day_rows(db: Session, doctor_id: int, day: dt_date) -> List[AvailabilityCalendar]:
+    """
+    Calendar rows for a doctor/day in block order (single indexed read once built).
+    Days are materialized lazily on first read; writers keep them fresh via _calendar_touch.
 
-    # Prefer date-specific rules
-    drs = (
-        db.query(DateRule)
-          .filter(
-              DateRule.doctor_id == doctor_id,
-              DateRule.target_date == day,
-              DateRule.active == True,
-          )
-          .order_by(DateRule.start_hour)
+    The day's marker is inserted (and flushed) before the rows are computed. Writers
+    claim the same unique marker, so a concurrent booking either waits for this
+    transaction and then rebuilds the day, or commits first and is seen by the build.
+    """
+    found = _calendar_read_day(db, doctor_id, day)
+    if found is not None:
+        return found
+
+    try:
+        db.add(AvailabilityCalendarDay(doctor_id=doctor_id, day=day))
+        db.flush()
+    except IntegrityError:
+        # a reader or writer claimed the day first; use what it committed
+        db.rollback()
+        found = _calendar_read_day(db, doctor_id, day)
+        if found is not None:
+            return found
+        return _calendar_build_rows(db, doctor_id, day)
+    rows = _calendar_build_rows(db, doctor_id, day)
+    db.add_all(rows)
+    db.commit()
+    return rows
+
+def _calendar_read_day(db: Session, doctor_id: int, day: dt_date) -> Optional[List[AvailabilityCalendar]]:
+    """Stored rows of a materialized day, None if the day has no marker yet."""
+    found = (
+        db.query(AvailabilityCalendarDay.id, AvailabilityCalendar)
+          .outerjoin(AvailabilityCalendar, and_(
+              AvailabilityCalendar.doctor_id == AvailabilityCalendarDay.doctor_id,
+              AvailabilityCalendar.day == AvailabilityCalendarDay.day,
+          ))
+          .filter(AvailabilityCalendarDay.doctor_id == doctor_id,
+                  AvailabilityCalendarDay.day == day)
+          .order_by(AvailabilityCalendar.id)
           .all()
     )
-    if drs:
-        for r in drs:
-            if mode and r.mode != mode:
-                continue
-            st = datetime(day.year, day.month, day.day, int(r.start_hour))
-            en = datetime(day.year, day.month, day.day, int(r.end_hour))
-            if block_capacity_left(db, doctor_id, st, en) > 0:
-                out.append((st, en))
-        return out
+    if not found:
+        return None
+    return [row for (_, row) in found if row is not None]
 
-    # Fallback weekly
-    dow_mon0 = dt_date.weekday(day)  # Mon=0..Sun=6
-    dow_sun0 = (dow_mon0 + 1) % 7
-    avs = (
-        db.query(Availability)
-          .filter(
-              Availability.doctor_id == doctor_id,
-              Availability.day_of_week == dow_sun0,
-              Availability.active == True,
-          )
-          .order_by(Availability.start_hour)
-          .all()
+def _calendar_touch(db: Session, doctor_id: int, *days) -> None:
+    """
+    (Re)build the calendar days a booking or dated-rule change affects.
+    Call before commit so the refresh lands in the same transaction as the write;
+    rules are read through this session (not the cache) so pending edits are seen.
+    Each day's marker is claimed first (insert-or-ignore), which waits for a reader
+    materializing that day concurrently, so its rows can't outlive this write.
+    """
+    db.flush()
+    wanted = {d.date() if isinstance(d, datetime) else d for d in days if d}
+    if not wanted:
+        return
+    for day in sorted(wanted):
+        _insert_ignore(db, AvailabilityCalendarDay, ["doctor_id", "day"],
+                       doctor_id=doctor_id, day=day, built_at=datetime.utcnow())
+    markers = (db.query(AvailabilityCalendarDay)
+                 .filter(AvailabilityCalendarDay.doctor_id == doctor_id,
+                         AvailabilityCalendarDay.day.in_(wanted))
+                 .all())
+    sched = _load_schedules(db, [doctor_id])[doctor_id]
+    # bookings of the whole span in one query; the rebuild below is then an in-memory
+    # sweep, and every day is computed before the first write flushes the index away
+    _prefetch_booking_index(db, doctor_id, min(m.day for m in markers), max(m.day for m in markers))
+    rebuilt = {m.day: _calendar_build_rows(db, doctor_id, m.day, sched) for m in markers}
+    db.query(AvailabilityCalendar).filter(
+        AvailabilityCalendar.doctor_id == doctor_id,
+        AvailabilityCalendar.day.in_(list(rebuilt)),
+    ).delete(synchronize_session=False)
+    now = datetime.utcnow()
+    for m in markers:
+        db.add_all(rebuilt[m.day])
+        m.built_at = now
+
+def _calendar_drop_doctor(db: Session, doctor_id: int) -> None:
+    """Forget every materialized day for a doctor (weekly rules affect unbounded dates)."""
+    db.query(AvailabilityCalendar).filter(AvailabilityCalendar.doctor_id == doctor_id).delete(synchronize_session=False)
+    db.query(AvailabilityCalendarDay).filter(AvailabilityCalendarDay.doctor_id == doctor_id).delete(synchronize_session=False)
+
+# ---- slot reservations (atomic booking) --------------------------------------
+ACTIVE_STATUSES = (AppointmentStatus.requested, AppointmentStatus.approved)
+
+def _insert_ignore(db: Session, model, conflict_cols: List[str], **values) -> None:
+    """INSERT that silently loses to a concurrent insert of the same unique key."""
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as _insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as _insert
+    else:
+        try:
+            with db.begin_nested():
+                db.add(model(**values))
+        except Exception:
+            pass
+        return
+    db.execute(_insert(model.__table__).values(**values).on_conflict_do_nothing(index_elements=conflict_cols))
+
+def _slot_key(doctor_id: int, start: datetime, end: datetime):
+    return and_(SlotReservation.doctor_id == doctor_id,
+                SlotReservation.start_time == start,
+                SlotReservation.end_time == end)
+
+def _reserve_slot(db: Session, doctor_id: int, start: datetime, end: datetime) -> bool:
+    """
+    Take one unit of capacity for an exact slot with a conditional
+    UPDATE ... WHERE remaining > 0, so concurrent bookings never oversubscribe.
+    The counter row is seeded from the rules and live bookings on first use.
+    """
+    for attempt in range(2):
+        res = db.execute(
+            update(SlotReservation)
+              .where(_slot_key(doctor_id, start, end), SlotReservation.remaining > 0)
+              .values(remaining=SlotReservation.remaining - 1, updated_at=datetime.utcnow())
+        )
+        if res.rowcount:
+            return True
+        if attempt or db.query(SlotReservation.id).filter(_slot_key(doctor_id, start, end)).first():
+            return False
+        # seed from committed rules, not the cache, so a counter never outlives a rule edit
+        sched = _load_schedules(db, [doctor_id])[doctor_id]
+        rule = _active_rule_for(db, doctor_id, start, start.hour, end.hour if end.minute == 0 else end.hour + 1, sched)
+        if not rule:
+            return False
+        taken = _booking_index(db, doctor_id, start.date()).exact_count(start, end)
+        _insert_ignore(db, SlotReservation, ["doctor_id", "start_time", "end_time"],
+                       doctor_id=doctor_id, start_time=start, end_time=end,
+                       remaining=int(rule["max_patients"]) - taken, updated_at=datetime.utcnow())
+    return False
+
+def _adjust_slot(db: Session, doctor_id: int, start: datetime, end: datetime, delta: int) -> None:
+    """Give back (+1) or force-take (-1) capacity when a booking changes state; no-op if not seeded."""
+    db.execute(
+        update(SlotReservation)
+          .where(_slot_key(doctor_id, start, end))
+          .values(remaining=SlotReservation.remaining + delta, updated_at=datetime.utcnow())
     )
-    for a in avs:
-        if mode and a.mode != mode:
-            continue
-        st = datetime(day.year, day.month, day.day, int(a.start_hour))
-        en = datetime(day.year, day.month, day.day, int(a.end_hour))
-        if block_capacity_left(db, doctor_id, st, en) > 0:
-            out.append((st, en))
-    return out
+
+def _reservations_drop_doctor(db: Session, doctor_id: int) -> None:
+    """Rule changes alter capacity; counters are re-seeded on the next booking."""
+    db.query(SlotReservation).filter(SlotReservation.doctor_id == doctor_id).delete(synchronize_session=False)
+
+# ---- serial sequences --------------------------------------------------------
+def _next_serial(db: Session, doctor_id: int, window_start: datetime, window_end: datetime,
+                 count: int = 1) -> int:
+    """
+    Atomically allocate `count` consecutive serials in a schedule window and return
+    the first. The UPDATE holds the row (or SQLite write) lock until commit, so
+    concurrent approvals never collide.
+    """
+    key = and_(SerialSequence.doctor_id == doctor_id, SerialSequence.window_start == window_start)
+    for _ in range(2):
+        res = db.execute(
+            update(SerialSequence).where(key)
+              .values(last_serial=SerialSequence.last_serial + count, updated_at=datetime.utcnow())
+        )
+        if res.rowcount:
+            return int(db.query(SerialSequence.last_serial).filter(key).scalar()) - count + 1
+        # first approval in this window: continue from serials already handed out
+        seed = db.query(func.max(Appointment.serial_number)).filter(
+            Appointment.doctor_id == doctor_id,
+            Appointment.start_time >= window_start,
+            Appointment.start_time < window_end,
+        ).scalar()
+        _insert_ignore(db, SerialSequence, ["doctor_id", "window_start"],
+                       doctor_id=doctor_id, window_start=window_start,
+                       last_serial=int(seed or 0), updated_at=datetime.utcnow())
+    raise RuntimeError("could not allocate serial")
 
 # -----------------------------------------------------------------------------
 # Schemas (Pydantic)
@@ -867,6 +2125,11 @@ def gen_blocks_for_date(
 class Token(BaseModel):
     access_token: str
     token_type: str = "bearer"
+    refresh_token: Optional[str] = None
+    expires_in: Optional[int] = None   # access token lifetime, seconds
+
+class RefreshIn(BaseModel):
+    refresh_token: str
 
 class UserOut(BaseModel):
     id: int
@@ -949,6 +2212,18 @@ class ApproveIn(BaseModel):
     # optional reason for rejection (admin can provide a note when rejecting)
     reason: Optional[str] = None
 
+class BulkPaymentIn(BaseModel):
+    appointment_id: int
+    method: str
+    transaction_id: Optional[str] = None
+    amount: Optional[float] = None
+
+class BulkApproveIn(BaseModel):
+    appointment_ids: List[int]
+    approve: bool = True
+    reason: Optional[str] = None                      # used when rejecting
+    payments: Optional[List[BulkPaymentIn]] = None    # optional, at most one per appointment
+
 
 class AvailabilityIn(BaseModel):
     day_of_week: int
@@ -976,6 +2251,8 @@ class ReportOut(BaseModel):
     original_name: str
     uploaded_at: datetime
     file_path: str
+    thumb_url: Optional[str] = None
+    preview_url: Optional[str] = None
     class Config: from_attributes = True
 
 class DoctorDocOut(BaseModel):
@@ -1084,10 +2361,526 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
+
+# --- upload storage ----------------------------------------------------------
+# Every UploadFile handler goes through store_upload/store_upload_async: the body
+# is streamed to a temp file in fixed-size chunks (never read whole), the size
+# limit is enforced while streaming and a sha256 is computed on the way. Files are
+# content-addressed: identical bytes are stored once as uploads/blobs/ab/cd/<sha256><ext>
+# and the path columns below share that file. upload_blobs counts the references;
+# BlobCollector deletes blobs nobody has referenced for BLOB_GC_GRACE seconds.
+# Older files (flat uploads/<name>, uploads/blobs/<sha256><ext>) are still served by
+# the /uploads mount as-is; migrate_uploads.py moves them into this layout.
+UPLOAD_DIR = "uploads"
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(25 * 1024 * 1024)))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+BLOB_DIR = os.path.join(UPLOAD_DIR, "blobs")
+BLOB_GC_INTERVAL = int(os.getenv("BLOB_GC_INTERVAL", "3600"))
+BLOB_GC_GRACE = int(os.getenv("BLOB_GC_GRACE", "3600"))
+
+class StoredUpload:
+    __slots__ = ("path", "size", "sha256", "original_name")
+
+    def __init__(self, path: str, size: int, sha256: str, original_name: Optional[str]):
+        self.path, self.size, self.sha256, self.original_name = path, size, sha256, original_name
+
+def _upload_too_large(max_bytes: int) -> HTTPException:
+    return HTTPException(413, f"File too large (max {max_bytes // (1024 * 1024)} MB)")
+
+def _blob_ext(filename: Optional[str]) -> str:
+    ext = os.path.splitext(os.path.basename((filename or "").replace("\\", "/")))[1].lower()
+    return ext if 1 < len(ext) <= 10 and ext[1:].isalnum() else ""
+
+def _blob_path(sha256: str, ext: str) -> str:
+    """uploads/blobs/ab/cd/abcd....ext: two hashed directory levels keep each directory small."""
+    return os.path.join(BLOB_DIR, sha256[:2], sha256[2:4], sha256 + ext)
+
+def _is_blob_path(path: Optional[str]) -> bool:
+    return bool(path) and os.path.abspath(path).startswith(os.path.abspath(BLOB_DIR) + os.sep)
+
+def _blob_register(db: Session, sha256: str, size: int, ext: str) -> str:
+    """Path of the blob for `sha256`, creating its index row (refcount 0) in db's transaction."""
+    now = datetime.utcnow()
+    _insert_ignore(db, UploadBlob, ["sha256"], sha256=sha256, path=_blob_path(sha256, ext),
+                   size=size, refcount=0, created_at=now, released_at=now)
+    # an unreferenced blob being reused gets a fresh grace period before GC could take it
+    db.execute(update(UploadBlob).where(UploadBlob.sha256 == sha256, UploadBlob.refcount <= 0)
+               .values(released_at=now).execution_options(synchronize_session=False))
+    return db.query(UploadBlob.path).filter(UploadBlob.sha256 == sha256).scalar()
+
+class _UploadSink:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        os.makedirs(BLOB_DIR, exist_ok=True)
+        self.tmp_path = os.path.join(UPLOAD_DIR, f".{secrets.token_hex(8)}.part")
+        self.fh = open(self.tmp_path, "wb")
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, chunk: bytes) -> None:
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            raise _upload_too_large(self.max_bytes)
+        self.hash.update(chunk)
+        self.fh.write(chunk)
+
+    def commit(self, db: Session, original_name: Optional[str]) -> StoredUpload:
+        self.fh.close()
+        digest = self.hash.hexdigest()
+        path = _blob_register(db, digest, self.size, _blob_ext(original_name))
+        # replace even if present: same bytes, and it undoes a concurrent GC of the old copy
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(self.tmp_path, path)
+        _derivatives.submit(path)
+        return StoredUpload(path, self.size, digest, original_name)
+
+    def abort(self) -> None:
+        try:
+            self.fh.close()
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
+
+def store_upload(db: Session, file: UploadFile, max_bytes: int = UPLOAD_MAX_BYTES) -> StoredUpload:
+    """
+    Stream `file` into the blob store and register it in db's transaction; the
+    referencing row written in the same transaction takes the reference.
+    For sync (threadpool) handlers.
+    """
+    if file.size is not None and file.size > max_bytes:
+        raise _upload_too_large(max_bytes)
+    sink = _UploadSink(max_bytes)
+    try:
+        while True:
+            chunk = file.file.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            sink.write(chunk)
+        return sink.commit(db, file.filename)
+    except BaseException:
+        sink.abort()
+        raise
+
+async def store_upload_async(db: Session, file: UploadFile, max_bytes: int = UPLOAD_MAX_BYTES) -> StoredUpload:
+    """store_upload for async handlers: disk reads/writes run in the threadpool."""
+    if file.size is not None and file.size > max_bytes:
+        raise _upload_too_large(max_bytes)
+    sink = await run_in_threadpool(_UploadSink, max_bytes)
+    try:
+        while True:
+            chunk = await file.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            await run_in_threadpool(sink.write, chunk)
+        return await run_in_threadpool(sink.commit, db, file.filename)
+    except BaseException:
+        sink.abort()
+        raise
+
+def _discard_upload(path: Optional[str]) -> None:
+    """
+    Forget a file whose row is being deleted/cleared. Blobs are shared, so they are
+    only released (the flush hook drops the reference); legacy per-upload files are removed.
+    """
+    if not path or _is_blob_path(path):
+        return
+    try:
+        if os.path.exists(path):
+            os.remove(path)
+    except Exception:
+        pass
+
+# model -> columns holding upload paths (AppointmentMessage registers itself below)
+_BLOB_REF_COLUMNS: Dict[type, Tuple[str, ...]] = {
+    User: ("photo_path",),
+    Appointment: ("disease_photo_path",),
+    Prescription: ("file_path",),
+    MedicalReport: ("file_path",),
+    DoctorDocument: ("file_path",),
+}
+
+@event.listens_for(SessionLocal, "after_flush")
+def _blob_refs_track(session, flush_context):
+    delta: Counter = Counter()
+    for objs, sign in ((session.new, 1), (session.deleted, -1)):
+        for obj in objs:
+            state = inspect(obj)
+            for col in _BLOB_REF_COLUMNS.get(type(obj), ()):
+                path = state.dict.get(col)
+                if _is_blob_path(path):
+                    delta[path] += sign
+    for obj in session.dirty:
+        cols = _BLOB_REF_COLUMNS.get(type(obj))
+        if not cols:
+            continue
+        state = inspect(obj)
+        for col in cols:
+            hist = state.attrs[col].history
+            for path in hist.added or ():
+                if _is_blob_path(path):
+                    delta[path] += 1
+            for path in hist.deleted or ():
+                if _is_blob_path(path):
+                    delta[path] -= 1
+    if not any(delta.values()):
+        return
+    conn, now = session.connection(), datetime.utcnow()
+    blobs = UploadBlob.__table__
+    for path, n in delta.items():
+        if n > 0:
+            conn.execute(blobs.update().where(blobs.c.path == path).values(refcount=blobs.c.refcount + n))
+        elif n < 0:
+            conn.execute(blobs.update().where(blobs.c.path == path)
+                         .values(refcount=blobs.c.refcount + n, released_at=now))
+
+class BlobCollector:
+    """
+    Background sweep of the blob store. A blob is deleted once its refcount has
+    been <= 0 for BLOB_GC_GRACE seconds and no path column still names it (guards
+    against refcount drift from bulk SQL). The file is moved aside before the
+    conditional DELETE, and put back if an upload revived the blob meanwhile, so
+    it is safe with several workers; its thumbnails go with it. Files in blobs/
+    without an index row and stale .part temp files are removed after the same
+    grace period.
+    """
+    def __init__(self, session_factory=SessionLocal, interval: int = BLOB_GC_INTERVAL, grace: int = BLOB_GC_GRACE):
+        self._session_factory = session_factory
+        self.interval, self.grace = interval, grace
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.stats = {"runs": 0, "blobs_deleted": 0, "bytes_freed": 0, "orphans_deleted": 0, "last_run": None}
+
+    def start(self) -> None:
+        if self.interval <= 0 or (self._thread and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="blob-gc", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.collect()
+            except Exception as e:
+                print("BLOB_GC: error:", e)
+
+    def _count_references(self, db: Session, path: str) -> int:
+        return sum(db.query(func.count()).filter(getattr(model, col) == path).scalar()
+                   for model, cols in _BLOB_REF_COLUMNS.items() for col in cols)
+
+    def collect(self, now: Optional[datetime] = None) -> dict:
+        now = now or datetime.utcnow()
+        cutoff = now - timedelta(seconds=self.grace)
+        deleted = freed = orphans = 0
+        db = self._session_factory()
+        try:
+            candidates = (db.query(UploadBlob.sha256, UploadBlob.path, UploadBlob.size)
+                            .filter(UploadBlob.refcount <= 0, UploadBlob.released_at < cutoff)
+                            .limit(1000).all())
+            db.rollback()
+            for sha, path, size in candidates:
+                refs = self._count_references(db, path)
+                if refs:
+                    db.query(UploadBlob).filter(UploadBlob.sha256 == sha).update(
+                        {"refcount": refs}, synchronize_session=False)
+                    db.commit()
+                    print(f"BLOB_GC: {path} still referenced; refcount repaired to {refs}")
+                    continue
+                aside = f"{path}.gc-{secrets.token_hex(4)}"
+                try:
+                    os.replace(path, aside)
+                except FileNotFoundError:
+                    aside = None
+                try:
+                    gone = (db.query(UploadBlob)
+                              .filter(UploadBlob.sha256 == sha, UploadBlob.refcount <= 0, UploadBlob.released_at < cutoff)
+                              .delete(synchronize_session=False))
+                    db.commit()
+                except Exception:
+                    # row still there (locked DB, lost connection): put the file back before giving up
+                    db.rollback()
+                    if aside is not None:
+                        os.replace(aside, path)
+                    raise
+                if aside is None:
+                    deleted += gone
+                elif gone:
+                    os.remove(aside)
+                    for kind in thumbnails.SIZES:
+                        try:
+                            os.remove(thumbnails.derivative_path(path, kind))
+                        except OSError:
+                            pass
+                    deleted += 1
+                    freed += size or 0
+                elif not os.path.exists(path):
+                    os.replace(aside, path)
+                else:
+                    os.remove(aside)
+
+            # files nobody registered (upload whose transaction rolled back) and stale temp files
+            limit_ts = cutoff.timestamp()
+            stale = [e.path for e in os.scandir(UPLOAD_DIR)
+                     if e.is_file() and e.name.endswith(".part") and e.stat().st_mtime < limit_ts]
+            known = None
+            for root, _dirs, files in os.walk(BLOB_DIR):
+                for name in files:
+                    path = os.path.join(root, name)
+                    try:
+                        if os.stat(path).st_mtime >= limit_ts:
+                            continue
+                    except OSError:
+                        continue
+                    if ".gc-" not in name and not name.endswith(".part"):
+                        # blobs and their derivatives all start with the blob's sha256
+                        if known is None:
+                            known = {sha for (sha,) in db.query(UploadBlob.sha256).all()}
+                            db.rollback()
+                        if name[:64] in known:
+                            continue
+                    stale.append(path)
+            for path in stale:
+                try:
+                    os.remove(path)
+                    orphans += 1
+                except OSError:
+                    pass
+        finally:
+            db.close()
+        self.stats["runs"] += 1
+        self.stats["blobs_deleted"] += deleted
+        self.stats["bytes_freed"] += freed
+        self.stats["orphans_deleted"] += orphans
+        self.stats["last_run"] = now.isoformat()
+        if deleted or orphans:
+            print(f"BLOB_GC: deleted {deleted} blob(s), {freed} bytes, {orphans} orphan file(s)")
+        return {"blobs_deleted": deleted, "bytes_freed": freed, "orphans_deleted": orphans}
+
+_blob_gc = BlobCollector()
+
+# --- image derivatives ---------------------------------------------------------
+THUMB_WORKERS = int(os.getenv("THUMB_WORKERS", "1"))          # 0 = one background thread
+THUMB_MAX_PENDING = int(os.getenv("THUMB_MAX_PENDING", "256"))
+
+class DerivativePipeline:
+    """
+    Fire-and-forget thumbnail/preview generation (thumbnails.py) for stored
+    images. Decoding multi-megapixel photos runs in worker processes, never in a
+    request; uploads return before their derivatives exist. Images without
+    derivatives (older uploads, a full queue) are submitted again when listed,
+    except ones that failed to decode: those are remembered for the life of the
+    process and keep being served as originals.
+    """
+    def __init__(self, workers: int, max_pending: int):
+        self.workers, self.max_pending = workers, max_pending
+        self._executor = None
+        self._lock = threading.Lock()
+        self._inflight: set = set()
+        self._failed: set = set()
+        self.stats = {"submitted": 0, "done": 0, "failed": 0, "skipped_full": 0}
+
+    def _pool(self):
+        if self._executor is None:
+            if self.workers > 0:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context("spawn"))
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="derivatives")
+        return self._executor
+
+    def enabled(self) -> bool:
+        return thumbnails.available()
+
+    def submit(self, path: Optional[str]) -> None:
+        if not path or not self.enabled() or not thumbnails.is_image(path):
+            return
+        with self._lock:
+            if path in self._inflight or path in self._failed:
+                return
+            if len(self._inflight) >= self.max_pending:
+                self.stats["skipped_full"] += 1
+                return
+            self._inflight.add(path)
+            self.stats["submitted"] += 1
+            try:
+                fut = self._pool().submit(thumbnails.make_derivatives, path)
+            except Exception as e:           # broken/shut-down pool: start fresh next time
+                self._inflight.discard(path)
+                self._executor = None
+                print("DERIVATIVES: submit failed:", e)
+                return
+        fut.add_done_callback(lambda f, path=path: self._done(path, f))
+
+    def _done(self, path: str, fut) -> None:
+        with self._lock:
+            self._inflight.discard(path)
+            if fut.cancelled() or fut.exception() is not None:
+                self.stats["failed"] += 1
+                err = None if fut.cancelled() else fut.exception()
+                if err is not None and not isinstance(err, BrokenProcessPool):
+                    # corrupt/unsupported image: don't decode it again on every listing
+                    if len(self._failed) >= 10000:
+                        self._failed.clear()
+                    self._failed.add(path)
+                    print(f"DERIVATIVES: {path}: {err}")
+            else:
+                self.stats["done"] += 1
+
+    def url(self, path: Optional[str], kind: str = "thumb") -> Optional[str]:
+        """Path of the derivative if it exists (same form as file_path); queues it otherwise."""
+        if not path or not self.enabled() or not thumbnails.is_image(path):
+            return None
+        dst = thumbnails.derivative_path(path, kind)
+        if os.path.exists(dst):
+            return dst.replace(os.sep, "/")
+        self.submit(path)
+        return None
+
+    def shutdown(self) -> None:
+        with self._lock:
+            ex, self._executor = self._executor, None
+        if ex:
+            ex.shutdown(wait=False, cancel_futures=True)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"enabled": self.enabled(), "workers": self.workers, "pending": len(self._inflight),
+                    "failed_paths": len(self._failed), **self.stats}
+
+_derivatives = DerivativePipeline(THUMB_WORKERS, THUMB_MAX_PENDING)
+
+# --- file serving ------------------------------------------------------------
+# Downloads and the /uploads mount share serve_file: a strong ETag (the blob's
+# sha256; size+mtime for files from before the blob store) plus Last-Modified,
+# 304 for If-None-Match / If-Modified-Since and single byte ranges (206) so large
+# PDFs and scans resume and repeat views cost no body.
+FILE_CHUNK_SIZE = 256 * 1024
+
+def _file_etag(path: str, st: os.stat_result) -> str:
+    if _is_blob_path(path):
+        return '"%s"' % os.path.splitext(os.path.basename(path))[0]
+    return 'W/"%x-%x"' % (st.st_size, int(st.st_mtime))
+
+def _etag_matches(header: str, etag: str) -> bool:
+    if header.strip() == "*":
+        return True
+    bare = etag[2:] if etag.startswith("W/") else etag
+    return any((t.strip()[2:] if t.strip().startswith("W/") else t.strip()) == bare for t in header.split(","))
+
+def _byte_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """(start, end) inclusive for a single 'bytes=' range; None = serve the whole file."""
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if first:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+        else:
+            start, end = max(size - int(last), 0), size - 1
+    except ValueError:
+        return None
+    if start >= size or start > end:
+        raise HTTPException(416, "Range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+
+class RangeFileResponse(Response):
+    """206 body for bytes start..end of a file, streamed in chunks."""
+    def __init__(self, path: str, start: int, end: int, size: int, headers: dict, media_type: Optional[str]):
+        headers = {**headers, "Content-Range": f"bytes {start}-{end}/{size}", "Content-Length": str(end - start + 1)}
+        super().__init__(status_code=206, headers=headers, media_type=media_type)
+        self.path, self.start, self.end = path, start, end
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if scope.get("method") == "HEAD":
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+        remaining = self.end - self.start + 1
+        async with await anyio.open_file(self.path, "rb") as fh:
+            await fh.seek(self.start)
+            while remaining > 0:
+                chunk = await fh.read(min(FILE_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+        if remaining > 0:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+def serve_file(request: Request, path: str, filename: Optional[str] = None,
+               media_type: Optional[str] = None, stat_result: Optional[os.stat_result] = None) -> Response:
+    """File response with validators, conditional GET and Range support."""
+    try:
+        st = stat_result or os.stat(path)
+    except OSError:
+        raise HTTPException(404, "File not found")
+    etag = _file_etag(path, st)
+    last_modified = formatdate(st.st_mtime, usegmt=True)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": last_modified,
+        "Accept-Ranges": "bytes",
+        # blobs never change under a given name; older files are revalidated (cheap 304s)
+        "Cache-Control": "private, max-age=31536000, immutable" if etag[0] == '"' else "private, no-cache",
+    }
+    if filename:
+        headers["Content-Disposition"] = f"attachment; filename*=utf-8''{quote(filename)}"
+
+    inm = request.headers.get("if-none-match")
+    ims = request.headers.get("if-modified-since")
+    if inm is not None:
+        if _etag_matches(inm, etag):
+            return Response(status_code=304, headers=headers)
+    elif ims:
+        try:
+            if int(st.st_mtime) <= parsedate_to_datetime(ims).timestamp():
+                return Response(status_code=304, headers=headers)
+        except (TypeError, ValueError):
+            pass
+
+    media_type = media_type or mimetypes.guess_type(filename or path)[0] or "application/octet-stream"
+    rng = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if rng and (not if_range or if_range.strip() in (etag, last_modified)):
+        span = _byte_range(rng, st.st_size)
+        if span:
+            return RangeFileResponse(path, span[0], span[1], st.st_size, headers, media_type)
+    return FileResponse(path, headers=headers, media_type=media_type, stat_result=st)
+
+class UploadFiles(StaticFiles):
+    """The public /uploads mount, answered by serve_file."""
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200) -> Response:
+        return serve_file(Request(scope), str(full_path), stat_result=stat_result)
+
+app.mount("/uploads", UploadFiles(directory="uploads"), name="uploads")
+
+@app.middleware("http")
+async def reject_oversized_uploads(request: Request, call_next):
+    """Refuse oversized multipart bodies from Content-Length, before they are spooled."""
+    if request.headers.get("content-type", "").startswith("multipart/"):
+        try:
+            length = int(request.headers.get("content-length") or 0)
+        except ValueError:
+            length = 0
+        if length > UPLOAD_MAX_BYTES + UPLOAD_CHUNK_SIZE:   # slack for form fields/boundaries
+            return JSONResponse({"detail": _upload_too_large(UPLOAD_MAX_BYTES).detail}, status_code=413)
+    return await call_next(request)
 
 @app.on_event("shutdown")
 def on_shutdown():
+    _dispatcher.stop()
+    _call_timeouts.stop()
+    _password_pool.shutdown()
+    _fanout.close()
+    _blob_gc.stop()
+    _derivatives.shutdown()
     try:
         engine.dispose()
     except Exception:
@@ -1098,6 +2891,12 @@ def on_startup():
     os.makedirs("uploads", exist_ok=True)
     create_db()
     ensure_sqlite_schema(engine)
+    ensure_indexes(engine)
+    if OUTBOX_DISPATCHER:
+        _dispatcher.start()
+    _call_timeouts.start()
+    _call_timeouts.recover()
+    _blob_gc.start()
 
     # Ensure Firebase is initialized in this process
     ok = ensure_firebase_initialized()
@@ -1125,7 +2924,7 @@ def register_patient(payload: RegisterPatientIn, db: Session = Depends(get_db)):
     if payload.phone and db.query(User).filter(User.phone == payload.phone).first():
         raise HTTPException(400, "Phone already registered")
     u = User(name=payload.name, email=payload.email, phone=payload.phone,
-             role=UserRole.patient, password_hash=hash_password(payload.password))
+             role=UserRole.patient, password_hash=hash_password_pooled(payload.password))
     db.add(u); db.flush()
     db.add(Patient(user_id=u.id))
     db.commit(); db.refresh(u)
@@ -1134,24 +2933,83 @@ def register_patient(payload: RegisterPatientIn, db: Session = Depends(get_db)):
 @app.post("/auth/login", response_model=Token)
 def login(form: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
     u = (db.query(User).filter(or_(User.email == form.username, User.phone == form.username)).first())
-    if not u or not verify_password(form.password, u.password_hash):
+    ok, new_hash = verify_password_pooled(form.password, u.password_hash) if u else (False, None)
+    if not ok:
         raise HTTPException(400, "Incorrect email/phone or password")
-    token = create_access_token({"sub": str(u.id), "role": u.role.value})
-    return Token(access_token=token)
+    if new_hash:
+        # stored hash predates the current PASSWORD_ROUNDS; upgrade it now that we know the password
+        u.password_hash = new_hash
+        db.commit()
+        _password_pool.rehashed += 1
+    return _issue_tokens(db, _load_principal(db, u.id))
+
+@app.post("/auth/refresh", response_model=Token)
+def refresh_access_token(payload: RefreshIn, db: Session = Depends(get_db)):
+    """
+    Trade a refresh token for a new access token and a new refresh token.
+    Each refresh token works once; presenting a used one revokes its whole family.
+    """
+    exc = HTTPException(status_code=401, detail="Invalid refresh token")
+    row = (db.query(RefreshToken)
+             .filter(RefreshToken.token_hash == hashlib.sha256(payload.refresh_token.encode()).hexdigest())
+             .first())
+    now = datetime.utcnow()
+    if not row or row.revoked_at or row.expires_at <= now:
+        raise exc
+    # conditional update: of two concurrent refreshes with the same token only one rotates it
+    claimed = (db.query(RefreshToken)
+                 .filter(RefreshToken.id == row.id, RefreshToken.used_at.is_(None))
+                 .update({"used_at": now}, synchronize_session=False))
+    if not claimed:
+        print(f"AUTH: refresh token reuse for user={row.user_id} family={row.family}; revoking family")
+        _revoke_refresh_tokens(db, family=row.family)
+        db.commit()
+        raise exc
+    principal = _load_principal(db, row.user_id)
+    if not principal:
+        db.rollback()
+        raise exc
+    return _issue_tokens(db, principal, family=row.family)
 
 @app.post("/auth/logout", response_model=dict)
-def logout():
+async def logout(request: Request, db: Session = Depends(get_db)):
+    """
+    Revokes the refresh token's family when one is given (JSON or form field
+    refresh_token); access tokens simply expire.
+    """
+    refresh_token = None
+    try:
+        body = await request.json()
+        if isinstance(body, dict):
+            refresh_token = body.get("refresh_token")
+    except Exception:
+        try:
+            refresh_token = (await request.form()).get("refresh_token")
+        except Exception:
+            refresh_token = None
+    if refresh_token:
+        row = (db.query(RefreshToken)
+                 .filter(RefreshToken.token_hash == hashlib.sha256(str(refresh_token).encode()).hexdigest())
+                 .first())
+        if row:
+            _revoke_refresh_tokens(db, family=row.family)
+            db.commit()
     return {"ok": True}
 
 @app.post("/auth/change_password", response_model=dict)
 def change_password(old: str = Form(...), new: str = Form(...),
                     current: User = Depends(get_current_user),
                     db: Session = Depends(get_db)):
-    if not verify_password(old, current.password_hash):
+    ok, _ = verify_password_pooled(old, current.password_hash)
+    if not ok:
         raise HTTPException(400, "Wrong current password")
-    current.password_hash = hash_password(new)
+    current.password_hash = hash_password_pooled(new)
+    # void every session: refresh tokens are revoked, access tokens fail the "tv" check;
+    # the caller gets a fresh pair so this device stays signed in
+    current.token_version = (current.token_version or 0) + 1
+    _revoke_refresh_tokens(db, user_id=current.id)
     db.commit()
-    return {"ok": True}
+    return {"ok": True, **_issue_tokens(db, _load_principal(db, current.id)).dict()}
 
 @app.post("/me/photo", response_model=dict)
 def upload_my_photo(
@@ -1159,10 +3017,7 @@ def upload_my_photo(
     current: User = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
-    fname = f"user_{current.id}_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}_{file.filename}"
-    path = os.path.join("uploads", fname)
-    with open(path, "wb") as f:
-        f.write(file.file.read())
+    path = store_upload(db, file).path
     current.photo_path = path
     db.commit()
     return {"ok": True, "photo_path": path}
@@ -1258,6 +3113,7 @@ async def register_device_token(request: Request, db: Session = Depends(get_db),
     else:
         db.add(DeviceToken(user_id=current.id, token=token, platform=platform))
     db.commit()
+    _device_tokens.add(current.id, token)
     return {"ok": True}
 
 # -----------------------------------------------------------------------------
@@ -1269,7 +3125,7 @@ def admin_create_doctor(payload: CreateDoctorIn, db: Session = Depends(get_db),
     if db.query(User).filter(User.email == payload.email).first():
         raise HTTPException(400, "Email already registered")
     u = User(name=payload.name, email=payload.email, phone=payload.phone,
-             role=UserRole.doctor, password_hash=hash_password(payload.password))
+             role=UserRole.doctor, password_hash=hash_password_pooled(payload.password))
     db.add(u); db.flush()
     d = Doctor(user_id=u.id, specialty=payload.specialty, category=payload.category or "General",
                keywords=payload.keywords or "", bio=payload.bio or "", background=payload.background or "", rating=5)
@@ -1288,12 +3144,88 @@ def admin_list_appointments(status_filter: Optional[AppointmentStatus] = None,
     if status_filter: q = q.filter(Appointment.status == status_filter)
     return q.order_by(Appointment.start_time.desc()).all()
 
+@app.get("/admin/metrics", response_model=dict)
+def admin_metrics(db: Session = Depends(get_db), curr: User = Depends(require_role(UserRole.admin))):
+    """In-process counters (per worker) plus the outbox backlog."""
+    backlog = dict(db.query(NotificationOutbox.status, func.count(NotificationOutbox.id))
+                     .group_by(NotificationOutbox.status).all())
+    return {
+        "schedule_cache": _schedule_cache.stats(),
+        "notification_outbox": {"by_status": backlog, "dispatcher": dict(_dispatcher.stats)},
+        "device_token_cache": _device_tokens.stats(),
+        "call_timeouts": {"pending": _call_timeouts.pending(), **_call_timeouts.stats},
+        "principal_cache": _principals.stats(),
+        "password_pool": _password_pool.stats(),
+        "chat_ws": _chat_hub.snapshot(),
+        "fanout_bus": type(_fanout).__name__,
+        "upload_blobs": {"count": db.query(func.count(UploadBlob.sha256)).scalar(),
+                         "bytes": db.query(func.coalesce(func.sum(UploadBlob.size), 0)).scalar(),
+                         "gc": dict(_blob_gc.stats)},
+        "derivatives": _derivatives.snapshot(),
+    }
+
 
 from datetime import datetime, timedelta
 
 from sqlalchemy import or_, func, text  # ensure func/or_ already imported near top
 
 
+# ---- approval helpers (shared by single and bulk approve) --------------------
+def _admin_payment(db: Session, appt: Appointment, method: Optional[str], tx: Optional[str],
+                   amount: Optional[float]) -> Optional[Payment]:
+    """Record a payment entered by the admin while approving; cash gets a generated transaction id."""
+    method = (method or "").strip()
+    tx = (tx or "").strip()
+    if not method:
+        return None
+    if method.lower() != "cash" and not tx:
+        raise HTTPException(status_code=422, detail="transaction_id is required for non-cash payments")
+    if method.lower() == "cash" and not tx:
+        tx = f"CASH-{secrets.token_urlsafe(8)}"
+    pay = Payment(
+        appointment_id=appt.id,
+        transaction_id=tx,
+        method=method,
+        amount=amount,
+        status=PaymentStatus.paid,
+        paid_at=datetime.utcnow(),
+        raw="(entered-by-admin)"
+    )
+    db.add(pay)
+    return pay
+
+def _window_slot_minutes(window_start: datetime, window_end: datetime, max_patients: Optional[int]) -> int:
+    """Minutes per patient in a schedule window: max(1, window_minutes // max_patients)."""
+    try:
+        window_minutes = max(1, int((window_end - window_start).total_seconds() // 60))
+    except Exception:
+        window_minutes = 60
+    try:
+        max_patients = int(max_patients or 1)
+    except Exception:
+        max_patients = 1
+    if max_patients <= 0:
+        max_patients = 1
+    return max(1, window_minutes // max_patients)
+
+def _estimate_visit(window_start: datetime, slot_minutes: int, serial: int) -> datetime:
+    return window_start + timedelta(minutes=(serial - 1) * slot_minutes)
+
+def _approval_notice(appt: Appointment) -> Tuple[str, str, dict]:
+    """(title, body, data) of the patient's 'appointment approved' push."""
+    title = "Appointment Approved"
+    serial_disp = appt.serial_number or ""
+    when_disp = (appt.estimated_visit_time.strftime("%Y-%m-%d %I:%M %p") if appt.estimated_visit_time else "")
+    body_text = f"Your appointment #{appt.id} has been approved. Serial: {serial_disp}. Est: {when_disp}"
+    data_payload = {
+        "type": "appointment_approved",
+        "appointment_id": str(appt.id),
+        "serial_number": str(serial_disp),
+        "estimated_visit_time": appt.estimated_visit_time.isoformat() if appt.estimated_visit_time else "",
+        "message": body_text,
+    }
+    return title, body_text, data_payload
+
 @app.patch("/admin/appointments/{appointment_id}/approve", response_model=dict)
 def approve_appointment(appointment_id: int, body: ApproveIn, db: Session = Depends(get_db),
                         curr: User = Depends(require_role(UserRole.admin))):
@@ -1303,8 +3235,8 @@ def approve_appointment(appointment_id: int, body: ApproveIn, db: Session = Depe
     Important: serial_number is assigned per *schedule window* (DateRule or Availability).
     - Find the best matching DateRule (exact date) or weekly Availability (weekday) whose
       window covers the appointment start_time.
-    - Compute serial by counting existing appointments for the same doctor within that
-      exact window (schedule_start .. schedule_end) and taking max(serial) + 1 (or 1 if none).
+    - Take the next serial from the window's sequence row (seeded from max(serial) in
+      schedule_start .. schedule_end), so concurrent approvals never share a serial.
     - Compute estimated_visit_time = schedule_start + (serial - 1) * slot_minutes
       where slot_minutes = max(1, floor(window_minutes / max_patients)).
     """
@@ -1317,177 +3249,30 @@ def approve_appointment(appointment_id: int, body: ApproveIn, db: Session = Depe
     # Allow re-approve only if you want; here we continue with normal flow.
 
     created_payment = False
+    was_active = appt.status in ACTIVE_STATUSES
 
     if body.approve:
         # ---- handle optional payment creation first ----
-        method = (body.method or "").strip() if hasattr(body, "method") else ""
-        tx = (body.transaction_id or "").strip() if hasattr(body, "transaction_id") else ""
-        amt = getattr(body, "amount", None) if hasattr(body, "amount") else None
-
-        # If any payment info supplied, require method and handle cash specially
-        if method:
-            if method.lower() != "cash" and not tx:
-                raise HTTPException(status_code=422, detail="transaction_id is required for non-cash payments")
-
-            # If cash and tx empty, auto-generate one
-            if method.lower() == "cash" and not tx:
-                tx = f"CASH-{secrets.token_urlsafe(8)}"
-
-            # Create payment record (mark as paid)
-            try:
-                pay = Payment(
-                    appointment_id=appt.id,
-                    transaction_id=tx,
-                    method=method,
-                    amount=amt,
-                    status=PaymentStatus.paid,
-                    paid_at=datetime.utcnow(),
-                    raw="(entered-by-admin)"
-                )
-                db.add(pay)
-                db.flush()
-                created_payment = True
-            except Exception as e:
-                db.rollback()
-                raise HTTPException(status_code=500, detail=f"Failed to record payment: {e}")
+        try:
+            created_payment = _admin_payment(db, appt, body.method, body.transaction_id, body.amount) is not None
+            db.flush()
+        except HTTPException:
+            raise
+        except Exception as e:
+            db.rollback()
+            raise HTTPException(status_code=500, detail=f"Failed to record payment: {e}")
 
         # ---- compute serial_number and estimated_visit_time per schedule window ----
         # Only compute serial if appointment has a start_time (otherwise fallback to day-based)
         if appt.start_time:
-            appt_date = appt.start_time.date()
-            schedule_row = None
-            schedule_start_dt = None
-            schedule_end_dt = None
-            schedule_max_patients = None
+            schedule_start_dt, schedule_end_dt, schedule_max_patients = _resolve_schedule_window(
+                db, appt.doctor_id, appt.start_time, appt.end_time)
 
-            # 1) Prefer DateRule for that exact date that contains the appointment time
-            try:
-                drs = (db.query(DateRule)
-                         .filter(DateRule.doctor_id == appt.doctor_id,
-                                 DateRule.target_date == appt_date,
-                                 DateRule.active == True)
-                         .all())
-            except Exception:
-                drs = []
-
-            if drs:
-                # find a rule whose time window covers appointment.start_time
-                for r in drs:
-                    # some DateRule may store start_hour/end_hour; adapt to your schema
-                    start_hour = int(getattr(r, "start_hour", 0))
-                    start_minute = int(getattr(r, "start_minute", 0) or 0)
-                    end_hour = int(getattr(r, "end_hour", start_hour + 1))
-                    end_minute = int(getattr(r, "end_minute", 0) or 0)
-
-                    candidate_start = datetime(appt_date.year, appt_date.month, appt_date.day, start_hour, start_minute)
-                    candidate_end = datetime(appt_date.year, appt_date.month, appt_date.day, end_hour, end_minute)
-                    if candidate_start <= appt.start_time < candidate_end:
-                        schedule_row = r
-                        schedule_start_dt = candidate_start
-                        schedule_end_dt = candidate_end
-                        schedule_max_patients = getattr(r, "max_patients", None)
-                        break
-                if not schedule_row:
-                    # fallback to first date rule for that date
-                    r = drs[0]
-                    start_hour = int(getattr(r, "start_hour", 9))
-                    start_minute = int(getattr(r, "start_minute", 0) or 0)
-                    end_hour = int(getattr(r, "end_hour", start_hour + 1))
-                    end_minute = int(getattr(r, "end_minute", 0) or 0)
-                    schedule_row = r
-                    schedule_start_dt = datetime(appt_date.year, appt_date.month, appt_date.day, start_hour, start_minute)
-                    schedule_end_dt = datetime(appt_date.year, appt_date.month, appt_date.day, end_hour, end_minute)
-                    schedule_max_patients = getattr(r, "max_patients", None)
-
-            # 2) If no DateRule matched, fallback to weekly Availability for the weekday
-            if not schedule_row:
-                try:
-                    # Determine weekday index as you store it (this example tries Sun=0..Sat=6 if Availability uses that)
-                    # If Availability.day_of_week uses Mon=0..Sun=6 adjust accordingly
-                    weekday_mon0 = appt.start_time.weekday()  # Mon=0..Sun=6
-                    # Try both conventions: if stored as 0=Sun adjust mapping; adapt to your model.
-                    # We'll query both possibilities: day_of_week == weekday_mon0 and day_of_week == (weekday_mon0 + 1)%7
-                    dow_candidates = [weekday_mon0, (weekday_mon0 + 1) % 7]
-                    avs = (db.query(Availability)
-                             .filter(Availability.doctor_id == appt.doctor_id,
-                                     Availability.active == True,
-                                     Availability.day_of_week.in_(dow_candidates))
-                             .all())
-                except Exception:
-                    avs = []
-
-                if avs:
-                    # pick availability that covers appointment start_time
-                    for a in avs:
-                        start_hour = int(getattr(a, "start_hour", 9))
-                        start_minute = int(getattr(a, "start_minute", 0) or 0)
-                        end_hour = int(getattr(a, "end_hour", start_hour + 1))
-                        end_minute = int(getattr(a, "end_minute", 0) or 0)
-                        # build schedule_start for the appointment date (use the appointment date, not rule date)
-                        candidate_start = datetime(appt_date.year, appt_date.month, appt_date.day, start_hour, start_minute)
-                        candidate_end = datetime(appt_date.year, appt_date.month, appt_date.day, end_hour, end_minute)
-                        if candidate_start <= appt.start_time < candidate_end:
-                            schedule_row = a
-                            schedule_start_dt = candidate_start
-                            schedule_end_dt = candidate_end
-                            schedule_max_patients = getattr(a, "max_patients", None)
-                            break
-                    if not schedule_row:
-                        a = avs[0]
-                        start_hour = int(getattr(a, "start_hour", 9))
-                        start_minute = int(getattr(a, "start_minute", 0) or 0)
-                        end_hour = int(getattr(a, "end_hour", start_hour + 1))
-                        end_minute = int(getattr(a, "end_minute", 0) or 0)
-                        schedule_row = a
-                        schedule_start_dt = datetime(appt_date.year, appt_date.month, appt_date.day, start_hour, start_minute)
-                        schedule_end_dt = datetime(appt_date.year, appt_date.month, appt_date.day, end_hour, end_minute)
-                        schedule_max_patients = getattr(a, "max_patients", None)
-
-            # 3) If still not found, fallback to the appointment's own start_time and end_time as a window
-            if not schedule_row:
-                if appt.end_time:
-                    schedule_start_dt = appt.start_time
-                    schedule_end_dt = appt.end_time
-                else:
-                    # default to one-hour window from start
-                    schedule_start_dt = appt.start_time
-                    schedule_end_dt = appt.start_time + timedelta(hours=1)
-                schedule_max_patients = getattr(appt, "max_patients", None) or 1
+            slot_minutes = _window_slot_minutes(schedule_start_dt, schedule_end_dt, schedule_max_patients)
 
-            # Now compute slot_minutes
-            try:
-                window_minutes = max(1, int((schedule_end_dt - schedule_start_dt).total_seconds() // 60))
-            except Exception:
-                window_minutes = 60
-            try:
-                max_patients = int(schedule_max_patients or 1)
-            except Exception:
-                max_patients = 1
-            if max_patients <= 0:
-                max_patients = 1
-            slot_minutes = max(1, window_minutes // max_patients)
-
-            # Compute max serial inside this schedule window
-            try:
-                # Count appointments for same doctor whose start_time falls inside the schedule window
-                # We use appointments that already have a serial assigned in that window.
-                max_serial = db.query(func.max(Appointment.serial_number)).filter(
-                    Appointment.doctor_id == appt.doctor_id,
-                    Appointment.start_time >= schedule_start_dt,
-                    Appointment.start_time < schedule_end_dt
-                ).scalar()
-            except Exception:
-                max_serial = None
-
-            max_serial = int(max_serial or 0)
-            appt.serial_number = max_serial + 1
-
-            # Compute estimated_visit_time from schedule_start_dt
-            try:
-                offset_min = (appt.serial_number - 1) * slot_minutes
-                appt.estimated_visit_time = schedule_start_dt + timedelta(minutes=offset_min)
-            except Exception:
-                appt.estimated_visit_time = appt.start_time
+            # Next serial for this schedule window (atomic per-window sequence)
+            appt.serial_number = _next_serial(db, appt.doctor_id, schedule_start_dt, schedule_end_dt)
+            appt.estimated_visit_time = _estimate_visit(schedule_start_dt, slot_minutes, appt.serial_number)
         else:
             # No start_time, fallback: increment day-wide serial as before
             try:
@@ -1507,6 +3292,8 @@ def approve_appointment(appointment_id: int, body: ApproveIn, db: Session = Depe
 
         # Finally mark appointment approved and payment_status if payments exist
         appt.status = AppointmentStatus.approved
+        if not was_active:
+            _adjust_slot(db, appt.doctor_id, appt.start_time, appt.end_time, -1)
         try:
             existing_cnt = db.query(Payment).filter(Payment.appointment_id == appt.id).count()
             if existing_cnt > 0:
@@ -1517,56 +3304,31 @@ def approve_appointment(appointment_id: int, body: ApproveIn, db: Session = Depe
         appt.last_modified_by_user_id = curr.id
         appt.last_modified_at = datetime.utcnow()
 
-        # persist
-        try:
-            db.commit()
-            db.refresh(appt)
-        except Exception as e:
-            db.rollback()
-            raise HTTPException(status_code=500, detail=f"Failed to save appointment: {e}")
-
-        # Optionally notify patient (best-effort)
-        try:
-            patient_user_id = appt.patient.user_id if appt.patient else None
-            if patient_user_id:
-                tokens_q = db.query(DeviceToken).filter(DeviceToken.user_id == patient_user_id).all()
-                tokens = [t.token for t in tokens_q if t and t.token]
-                if tokens:
-                    title = "Appointment Approved"
-                    serial_disp = appt.serial_number or ""
-                    when_disp = (appt.estimated_visit_time.strftime("%Y-%m-%d %I:%M %p") if appt.estimated_visit_time else "")
-                    body_text = f"Your appointment #{appt.id} has been approved. Serial: {serial_disp}. Est: {when_disp}"
-                    data_payload = {
-                        "type": "appointment_approved",
-                        "appointment_id": str(appt.id),
-                        "serial_number": str(serial_disp),
-                        "estimated_visit_time": appt.estimated_visit_time.isoformat() if appt.estimated_visit_time else "",
-                        "message": body_text,
-                    }
-                    try:
-                        multicast = messaging.MulticastMessage(
-                            notification=messaging.Notification(title=title, body=body_text),
-                            data={k: str(v) for k, v in data_payload.items()},
-                            tokens=list(set(tokens)),
-                        )
-                        messaging.send_multicast(multicast)
-                    except Exception:
-                        try:
-                            fcm_send_data_tokens(db, tokens, data_payload, ttl_seconds=3600)
-                        except Exception:
-                            pass
-        except Exception:
-            pass
+        # persist (the patient's push is queued in the same transaction)
+        try:
+            if appt.patient and appt.patient.user_id:
+                title, body_text, data_payload = _approval_notice(appt)
+                enqueue_notification(db, [appt.patient.user_id], data_payload,
+                                     title=title, body=body_text, options={"ttl": 3600})
+            _calendar_touch(db, appt.doctor_id, appt.start_time, appt.end_time)
+            db.commit()
+            db.refresh(appt)
+        except Exception as e:
+            db.rollback()
+            raise HTTPException(status_code=500, detail=f"Failed to save appointment: {e}")
 
     else:
         # Reject flow
         reason = getattr(body, 'reason', None) if hasattr(body, 'reason') else None
         appt.status = AppointmentStatus.rejected
+        if was_active:
+            _adjust_slot(db, appt.doctor_id, appt.start_time, appt.end_time, +1)
         if reason:
             appt.notes = (appt.notes or "") + ("\n\nREJECTED: " + reason)
         appt.last_modified_by_user_id = curr.id
         appt.last_modified_at = datetime.utcnow()
         try:
+            _calendar_touch(db, appt.doctor_id, appt.start_time, appt.end_time)
             db.commit()
             db.refresh(appt)
         except Exception as e:
@@ -1632,6 +3394,110 @@ def approve_appointment(appointment_id: int, body: ApproveIn, db: Session = Depe
 
     return resp
 
+BULK_APPROVE_MAX = 500
+
+@app.post("/admin/appointments/bulk_approve", response_model=dict)
+def bulk_approve_appointments(body: BulkApproveIn, db: Session = Depends(get_db),
+                              curr: User = Depends(require_role(UserRole.admin))):
+    """
+    Approve (or reject) many appointments in one transaction.
+    Approvals are grouped by doctor and schedule window so each window's serials are
+    taken with a single sequence update; patient pushes are queued in the same transaction
+    and delivered in batches by the notification dispatcher.
+    Only `requested` appointments are approved and only requested/approved ones are
+    rejected; the rest are left untouched and listed under "skipped".
+    """
+    ids = list(dict.fromkeys(body.appointment_ids))
+    order = {appt_id: k for k, appt_id in enumerate(ids)}
+    if not ids:
+        raise HTTPException(400, "appointment_ids is empty")
+    if len(ids) > BULK_APPROVE_MAX:
+        raise HTTPException(400, f"At most {BULK_APPROVE_MAX} appointments per call")
+    pays = {p.appointment_id: p for p in (body.payments or [])}
+
+    rows = db.query(Appointment).filter(Appointment.id.in_(ids)).all()
+    found = {a.id for a in rows}
+    skipped = [{"id": i, "reason": "not found"} for i in ids if i not in found]
+    eligible = (AppointmentStatus.requested,) if body.approve else ACTIVE_STATUSES
+    appts = [a for a in rows if a.status in eligible]
+    skipped += [{"id": a.id, "reason": f"status is {a.status.value}"}
+                for a in rows if a.status not in eligible]
+    skipped.sort(key=lambda s: order[s["id"]])
+    found = {a.id for a in appts}
+    now = datetime.utcnow()
+    touched: Dict[int, set] = {}
+    queued = 0
+
+    try:
+        if body.approve:
+            for a in appts:
+                p = pays.get(a.id)
+                if p:
+                    _admin_payment(db, a, p.method, p.transaction_id, p.amount)
+            db.flush()
+            paid_ids = {r[0] for r in db.query(Payment.appointment_id)
+                                        .filter(Payment.appointment_id.in_(found)).distinct().all()}
+
+            groups: Dict[Tuple[int, datetime], list] = {}
+            for a in appts:
+                ws, we, mp = _resolve_schedule_window(db, a.doctor_id, a.start_time, a.end_time)
+                groups.setdefault((a.doctor_id, ws), []).append((we, mp, a))
+            for (doctor_id, ws), members in groups.items():
+                members.sort(key=lambda m: (m[2].start_time, m[2].id))
+                we, mp = members[0][0], members[0][1]
+                slot_minutes = _window_slot_minutes(ws, we, mp)
+                first = _next_serial(db, doctor_id, ws, we, count=len(members))
+                for k, (_, _, a) in enumerate(members):
+                    a.serial_number = first + k
+                    a.estimated_visit_time = _estimate_visit(ws, slot_minutes, a.serial_number)
+
+            for a in appts:
+                a.status = AppointmentStatus.approved
+                if a.id in paid_ids:
+                    a.payment_status = PaymentStatus.paid
+                a.last_modified_by_user_id = curr.id
+                a.last_modified_at = now
+                touched.setdefault(a.doctor_id, set()).update({a.start_time, a.end_time})
+                if a.patient and a.patient.user_id:
+                    title, body_text, data_payload = _approval_notice(a)
+                    enqueue_notification(db, [a.patient.user_id], data_payload,
+                                         title=title, body=body_text, options={"ttl": 3600})
+                    queued += 1
+        else:
+            for a in appts:
+                _adjust_slot(db, a.doctor_id, a.start_time, a.end_time, +1)
+                a.status = AppointmentStatus.rejected
+                if body.reason:
+                    a.notes = (a.notes or "") + ("\n\nREJECTED: " + body.reason)
+                a.last_modified_by_user_id = curr.id
+                a.last_modified_at = now
+                touched.setdefault(a.doctor_id, set()).update({a.start_time, a.end_time})
+
+        for doctor_id, days in touched.items():
+            _calendar_touch(db, doctor_id, *days)
+        db.commit()
+    except HTTPException:
+        db.rollback()
+        raise
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=f"Bulk update failed: {e}")
+
+    return {
+        "ok": True,
+        "status": "approved" if body.approve else "rejected",
+        "items": [{
+            "id": a.id,
+            "doctor_id": a.doctor_id,
+            "status": a.status.value,
+            "payment_status": a.payment_status.value if a.payment_status else None,
+            "serial_number": a.serial_number,
+            "estimated_visit_time": a.estimated_visit_time,
+        } for a in sorted(appts, key=lambda a: order[a.id])],
+        "skipped": skipped,
+        "notifications_queued": queued,
+    }
+
 # ------------------ New admin payments listing endpoint ------------------
 @app.get("/admin/payments", response_model=dict)
 def admin_list_payments(
@@ -1801,7 +3667,11 @@ def doctor_weekly_set(
             a.max_patients = payload.max_patients
             a.mode = payload.visit_mode
 
+    _calendar_drop_doctor(db, d.id)
+    _reservations_drop_doctor(db, d.id)
+    _schedule_touch(db, d.id)
     db.commit()
+    _schedule_cache.invalidate(d.id)
     return {"ok": True}
 
 @app.post("/doctor/schedule/date_rule", response_model=dict)
@@ -1926,7 +3796,11 @@ async def doctor_add_date_rule_flexible(
 
             created.append({"date": day.isoformat(), "start_hour": sh, "end_hour": eh})
 
+        _calendar_touch(db, d.id, *[dt_date.fromisoformat(c["date"]) for c in created])
+        _reservations_drop_doctor(db, d.id)
+        _schedule_touch(db, d.id)
         db.commit()
+        _schedule_cache.invalidate(d.id)
         return {"ok": True, "created": created}
     except Exception as e:
         db.rollback()
@@ -2007,7 +3881,11 @@ async def doctor_update_date_rule(
         val = str(data.get("active")).lower()
         r.active = val in ("true", "1", "yes", "on")
 
+    _calendar_touch(db, d.id, r.target_date)
+    _reservations_drop_doctor(db, d.id)
+    _schedule_touch(db, d.id)
     db.commit()
+    _schedule_cache.invalidate(d.id)
     return {"ok": True}
 
 @app.post("/doctor/schedule/toggle", response_model=dict)
@@ -2027,7 +3905,14 @@ def doctor_toggle_rule(
     if not row or getattr(row, "doctor_id", None) != d.id:
         raise HTTPException(404, "Rule not found")
     row.active = bool(active)
+    if kind == "weekly":
+        _calendar_drop_doctor(db, d.id)
+    else:
+        _calendar_touch(db, d.id, row.target_date)
+    _reservations_drop_doctor(db, d.id)
+    _schedule_touch(db, d.id)
     db.commit()
+    _schedule_cache.invalidate(d.id)
     return {"ok": True}
 
 @app.delete("/doctor/schedule/weekly/{availability_id}", response_model=dict)
@@ -2043,7 +3928,11 @@ def doctor_delete_weekly_rule(
     if not row or row.doctor_id != d.id:
         raise HTTPException(404, "Weekly rule not found")
     db.delete(row)
+    _calendar_drop_doctor(db, d.id)
+    _reservations_drop_doctor(db, d.id)
+    _schedule_touch(db, d.id)
     db.commit()
+    _schedule_cache.invalidate(d.id)
     return {"ok": True, "deleted": availability_id}
 
 @app.delete("/doctor/schedule/date_rule/{rule_id}", response_model=dict)
@@ -2059,7 +3948,11 @@ def doctor_delete_date_rule(
     if not row or row.doctor_id != d.id:
         raise HTTPException(404, "Date rule not found")
     db.delete(row)
+    _calendar_touch(db, d.id, row.target_date)
+    _reservations_drop_doctor(db, d.id)
+    _schedule_touch(db, d.id)
     db.commit()
+    _schedule_cache.invalidate(d.id)
     return {"ok": True, "deleted": rule_id}
 
 # -----------------------------------------------------------------------------
@@ -2088,7 +3981,12 @@ def doctor_set_availability(body: AvailabilityIn, current: User = Depends(requir
     a = Availability(doctor_id=doc.id, day_of_week=body.day_of_week,
                      start_hour=body.start_hour, end_hour=body.end_hour,
                      max_patients=body.max_patients, active=body.active, mode=body.mode or "offline")
-    db.add(a); db.commit(); db.refresh(a)
+    db.add(a)
+    _calendar_drop_doctor(db, doc.id)
+    _reservations_drop_doctor(db, doc.id)
+    _schedule_touch(db, doc.id)
+    db.commit(); db.refresh(a)
+    _schedule_cache.invalidate(doc.id)
     return {"ok": True, "id": a.id}
 
 @app.get("/doctor/appointments", response_model=List[AppointmentOut])
@@ -2188,7 +4086,8 @@ def doctor_patient_history(appointment_id: int,
     if not appt: raise HTTPException(404, "Appointment not found")
     if appt.doctor.user_id != current.id: raise HTTPException(403, "Not your appointment")
     p = appt.patient
-    reports = [{"id": r.id, "name": r.original_name, "uploaded_at": r.uploaded_at.isoformat(), "file_path": r.file_path}
+    reports = [{"id": r.id, "name": r.original_name, "uploaded_at": r.uploaded_at.isoformat(), "file_path": r.file_path,
+                "thumb_url": _derivatives.url(r.file_path)}
                for r in (p.reports if p else [])]
     presc = None
     if appt.prescription:
@@ -2261,7 +4160,7 @@ def browse_doctors(
     if specialty:
         qry = qry.filter(Doctor.specialty.ilike(f"%{specialty}%"))
 
-    docs: List[Doctor] = qry.all()
+    docs: List[Doctor] = qry.options(contains_eager(Doctor.user)).all()
 
     #  Window
     if day:
@@ -2272,12 +4171,14 @@ def browse_doctors(
         if end_d < start_d:
             start_d, end_d = end_d, start_d
 
+    # Earliest dates per mode for every doctor at once (grouped queries, in-memory scan)
+    firsts = _first_available_dates(db, [d.id for d in docs], start_d, end_d)
+
     # Build payload with earliest dates per mode 
     out: List[dict] = []
     for d in docs:
-        # earliest per mode
-        next_online = _first_available_date(db, d.id, start_d, end_d, "online")
-        next_offline = _first_available_date(db, d.id, start_d, end_d, "offline")
+        next_online = firsts[d.id]["online"]
+        next_offline = firsts[d.id]["offline"]
 
         # honor visit_mode + available_only
         if visit_mode == "online":
@@ -2333,18 +4234,50 @@ def list_doctor_education(doctor_id: int, db: Session = Depends(get_db)):
 # -----------------------------------------------------------------------------
 # Search helpers for public browse
 # -----------------------------------------------------------------------------
-def _first_available_date(db: Session, doctor_id: int, start_d: dt_date, end_d: dt_date, mode: Optional[str]) -> Optional[dt_date]:
+BROWSE_SCAN_DAYS = 120  # safety cap on days scanned per browse window
 
-    d = start_d
-    # safety
-    scans = 0
-    while d <= end_d and scans < 120:
-        scans += 1
-        blocks = gen_blocks_for_date(db, doctor_id, d, mode)
-        if blocks:
-            return d
-        d += timedelta(days=1)
-    return None
+def _first_available_dates(db: Session, doctor_ids: List[int], start_d: dt_date, end_d: dt_date) -> Dict[int, Dict[str, Optional[dt_date]]]:
+    """
+    Earliest day with a bookable block, per doctor and visit mode:
+      {doctor_id: {"online": date|None, "offline": date|None}}
+    Same semantics as gen_blocks_for_date + block_capacity_left, but rules and bookings
+    for every doctor are fetched up front and the day scan runs in memory.
+    """
+    scheds = _schedule_cache.get_many(db, doctor_ids)
+    last_d = min(end_d, start_d + timedelta(days=BROWSE_SCAN_DAYS - 1))
+    books = _load_booking_indexes(db, doctor_ids, start_d, last_d)
+
+    out: Dict[int, Dict[str, Optional[dt_date]]] = {}
+    for doctor_id in doctor_ids:
+        sched = scheds[doctor_id]
+        found: Dict[str, Optional[dt_date]] = {"online": None, "offline": None}
+        out[doctor_id] = found
+        if not sched["weekly"] and not sched["dated"]:
+            continue
+        day_books = books[doctor_id]
+        d = start_d
+        while d <= last_d and not (found["online"] and found["offline"]):
+            for (_, sh, eh, _, mode) in _schedule_windows_for(sched, d):
+                if mode not in found or found[mode]:
+                    continue
+                rule = _schedule_rule_for(sched, d, sh, eh)
+                if not rule:
+                    continue
+                st = datetime(d.year, d.month, d.day, sh)
+                en = datetime(d.year, d.month, d.day, eh)
+                idx = day_books.get(d)
+                taken = idx.overlapping(st, en) if idx else 0
+                if rule[3] - taken > 0:
+                    found[mode] = d
+            d += timedelta(days=1)
+    return out
+
+def _first_available_date(db: Session, doctor_id: int, start_d: dt_date, end_d: dt_date, mode: Optional[str]) -> Optional[dt_date]:
+    found = _first_available_dates(db, [doctor_id], start_d, end_d)[doctor_id]
+    if mode:
+        return found.get(mode)
+    days = [x for x in found.values() if x]
+    return min(days) if days else None
 
 @app.get("/doctors/{doctor_id}", response_model=DoctorOut)
 def doctor_profile(doctor_id: int, db: Session = Depends(get_db)):
@@ -2371,18 +4304,91 @@ def doctor_slots_for_date(
     if visit_mode not in (None, "online", "offline"):
         raise HTTPException(400, "visit_mode must be 'online' or 'offline'")
     out: List[str] = []
-    for (st, en) in gen_blocks_for_date(db, doctor_id, day, visit_mode):
-        h = st.hour
-        while True:
-            h_st = datetime(day.year, day.month, day.day, h)
-            h_en = h_st + timedelta(hours=1)
-            if h_en > en:
-                break
-            if slot_capacity_left(db, doctor_id, h_st, h_en) > 0:
-                out.append(h_st.isoformat())
-            h += 1
+    for r in _calendar_day_rows(db, doctor_id, day):
+        if visit_mode and r.mode != visit_mode:
+            continue
+        if r.block_capacity_left > 0 and r.slot_capacity_left > 0:
+            out.append(datetime(day.year, day.month, day.day, r.hour).isoformat())
     return out
 
+# ---- slot grid over a date range (calendar view) ------------------------------
+SLOT_GRID_MAX_DAYS = 62
+_GRID_MODES = ("online", "offline")
+
+def _slot_grid(db: Session, doctor_id: int, start_d: dt_date, end_d: dt_date, mode: Optional[str]) -> dict:
+    """
+    Days x hours grid of bookable capacity (min of slot and block capacity left,
+    same rule as /slots). Rules come from the schedule cache and bookings from one
+    range query; cells live in flat arrays indexed day*24 + hour, -1 = not scheduled.
+    """
+    n_days = (end_d - start_d).days + 1
+    sched = _schedule_cache.get(db, doctor_id)
+    books = _load_booking_indexes(db, [doctor_id], start_d, end_d)[doctor_id]
+
+    cap = array("h", [-1]) * (n_days * 24)
+    kind = array("b", [-1]) * (n_days * 24)
+    exact = array("h", [0]) * (n_days * 24)   # bookings of exactly one on-the-hour slot
+
+    for k in range(n_days):
+        day = start_d + timedelta(days=k)
+        idx = books.get(day)
+        if idx:
+            for (b_st, b_en), n in idx.spans.items():
+                if b_st.date() == day and b_st.minute == 0 and b_st.second == 0 and b_en - b_st == timedelta(hours=1):
+                    exact[k * 24 + b_st.hour] += n
+        midnight = datetime(day.year, day.month, day.day)
+        for (_, sh, eh, _, r_mode) in _schedule_windows_for(sched, day):
+            if (mode and r_mode != mode) or r_mode not in _GRID_MODES:
+                continue
+            rule = _schedule_rule_for(sched, day, sh, eh)
+            if not rule:
+                continue
+            taken = idx.overlapping(midnight + timedelta(hours=sh), midnight + timedelta(hours=eh)) if idx else 0
+            block_left = max(0, rule[3] - taken)
+            for h in range(sh, min(eh, 24)):
+                slot_rule = _schedule_rule_for(sched, day, h, h + 1)
+                slot_left = max(0, slot_rule[3] - exact[k * 24 + h]) if slot_rule else 0
+                i = k * 24 + h
+                left = min(block_left, slot_left)
+                if left > cap[i]:
+                    cap[i] = left
+                    kind[i] = _GRID_MODES.index(r_mode)
+
+    scheduled = [i % 24 for i in range(len(cap)) if cap[i] >= 0]
+    hours = list(range(min(scheduled), max(scheduled) + 1)) if scheduled else []
+    capacity, modes = [], []
+    for k in range(n_days):
+        row = cap[k * 24 + hours[0]: k * 24 + hours[-1] + 1] if hours else []
+        row_kind = kind[k * 24 + hours[0]: k * 24 + hours[-1] + 1] if hours else []
+        capacity.append([c if c >= 0 else None for c in row])
+        modes.append([_GRID_MODES[m] if m >= 0 else None for m in row_kind])
+    return {
+        "doctor_id": doctor_id,
+        "from": start_d.isoformat(),
+        "to": end_d.isoformat(),
+        "mode": mode,
+        "days": [(start_d + timedelta(days=k)).isoformat() for k in range(n_days)],
+        "hours": hours,
+        "capacity": capacity,   # capacity[day][hour]; null = not scheduled
+        "modes": modes,
+    }
+
+@app.get("/doctors/{doctor_id}/slots/range", response_model=dict)
+def doctor_slots_range(
+    doctor_id: int,
+    from_date: dt_date = Query(..., alias="from", description="YYYY-MM-DD"),
+    to_date: dt_date = Query(..., alias="to", description="YYYY-MM-DD"),
+    mode: Optional[str] = Query(None, pattern="^(online|offline)$"),
+    db: Session = Depends(get_db),
+):
+    """Columnar slot grid for a calendar: one call instead of one /slots call per day."""
+    if not db.get(Doctor, doctor_id): raise HTTPException(404, "Doctor not found")
+    if to_date < from_date:
+        raise HTTPException(400, "'to' must not be before 'from'")
+    if (to_date - from_date).days + 1 > SLOT_GRID_MAX_DAYS:
+        raise HTTPException(400, f"Range too large (max {SLOT_GRID_MAX_DAYS} days)")
+    return _slot_grid(db, doctor_id, from_date, to_date, mode)
+
 # raw blocks for the day (new)
 @app.get("/doctors/{doctor_id}/blocks", response_model=List[dict])
 def doctor_blocks_for_date(
@@ -2394,8 +4400,18 @@ def doctor_blocks_for_date(
     if not db.get(Doctor, doctor_id): raise HTTPException(404, "Doctor not found")
     if visit_mode not in (None, "online", "offline"):
         raise HTTPException(400, "visit_mode must be 'online' or 'offline'")
-    blocks = gen_blocks_for_date(db, doctor_id, day, visit_mode)
-    return [{"start": st.isoformat(), "end": en.isoformat()} for (st, en) in blocks]
+    out: List[dict] = []
+    for r in _calendar_day_rows(db, doctor_id, day):
+        # one entry per block: its rows start at block_start
+        if r.hour != r.block_start or r.block_capacity_left <= 0:
+            continue
+        if visit_mode and r.mode != visit_mode:
+            continue
+        out.append({
+            "start": datetime(day.year, day.month, day.day, r.block_start).isoformat(),
+            "end": datetime(day.year, day.month, day.day, r.block_end).isoformat(),
+        })
+    return out
 
 # book appointment (JSON)
 @app.post("/appointments", response_model=AppointmentOut)
@@ -2403,14 +4419,16 @@ def request_appointment(payload: AppointmentIn, db: Session = Depends(get_db),
                         current: User = Depends(require_role(UserRole.patient))):
     p = current.patient_profile
     if not p: raise HTTPException(400, "Patient profile missing")
-    if slot_capacity_left(db, payload.doctor_id, payload.start_time, payload.end_time) <= 0:
+    if not _reserve_slot(db, payload.doctor_id, payload.start_time, payload.end_time):
         raise HTTPException(400, "Selected slot is not available")
     appt = Appointment(patient_id=p.id, doctor_id=payload.doctor_id,
                        start_time=payload.start_time, end_time=payload.end_time,
                        status=AppointmentStatus.requested, payment_status=PaymentStatus.pending,
                        visit_mode=payload.visit_mode, patient_problem=payload.patient_problem or "",
                        last_modified_by_user_id=current.id, last_modified_at=datetime.utcnow())
-    db.add(appt); db.commit(); db.refresh(appt)
+    db.add(appt)
+    _calendar_touch(db, appt.doctor_id, appt.start_time, appt.end_time)
+    db.commit(); db.refresh(appt)
     return appt
 
 @app.post("/appointments/request_multipart", response_model=AppointmentOut)
@@ -2427,18 +4445,18 @@ def request_appointment_multipart(
     st, et = datetime.fromisoformat(start_time), datetime.fromisoformat(end_time)
     p = current.patient_profile
     if not p: raise HTTPException(400, "Patient profile missing")
-    if slot_capacity_left(db, doctor_id, st, et) <= 0:
+    if not _reserve_slot(db, doctor_id, st, et):
         raise HTTPException(400, "Selected slot is not available")
     path = None
     if disease_photo is not None:
-        fname = f"dis_{current.id}_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}_{disease_photo.filename}"
-        path = os.path.join("uploads", fname)
-        with open(path, "wb") as f: f.write(disease_photo.file.read())
+        path = store_upload(db, disease_photo).path
     appt = Appointment(patient_id=p.id, doctor_id=doctor_id, start_time=st, end_time=et,
                        status=AppointmentStatus.requested, payment_status=PaymentStatus.pending,
                        visit_mode=visit_mode, patient_problem=patient_problem or "", disease_photo_path=path,
                        last_modified_by_user_id=current.id, last_modified_at=datetime.utcnow())
-    db.add(appt); db.commit(); db.refresh(appt)
+    db.add(appt)
+    _calendar_touch(db, appt.doctor_id, appt.start_time, appt.end_time)
+    db.commit(); db.refresh(appt)
     return appt
 
 # appointment detail
@@ -2484,6 +4502,9 @@ def get_appointment(appointment_id: int, current: User = Depends(get_current_use
         "payment_status": a.payment_status.value,
         "visit_mode": a.visit_mode.value,
         "patient_problem": a.patient_problem,
+        "disease_photo_path": a.disease_photo_path,
+        "disease_photo_thumb_url": _derivatives.url(a.disease_photo_path),
+        "disease_photo_preview_url": _derivatives.url(a.disease_photo_path, "preview"),
         "notes": a.notes,
         "video_room": a.video_room,
         "progress": a.progress.value,
@@ -2644,6 +4665,7 @@ def me_device_token(payload: dict = Body(...),
             db.add(dt)
 
         db.commit()
+        _device_tokens.add(current_user.id, token)
         return {"ok": True}
     except Exception as e:
         db.rollback()
@@ -3317,18 +5339,13 @@ def create_video_room(appointment_id: int, current: User = Depends(get_current_u
 @app.post("/appointments/{appointment_id}/call/start")
 def start_call(appointment_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
     """
-    Doctor starts a call. Create a CallLog and send a doctor_call push to the patient.
+    Doctor starts a call. Create a CallLog and queue a doctor_call push to the patient.
     The push carries:
       - appointment_id
       - call_log_id
       - message_id (unique for this call instance)
       - doctor_name, room
     """
-    # Ensure firebase is initialized in this worker/process
-    if not ensure_firebase_initialized():
-        raise HTTPException(status_code=500, detail="Server firebase not initialized")
-
-    import traceback
     print(f"START_CALL: appointment_id={appointment_id} by user={getattr(current_user,'id',None)}")
 
     appt = db.query(Appointment).filter(Appointment.id == appointment_id).first()
@@ -3342,146 +5359,37 @@ def start_call(appointment_id: int, db: Session = Depends(get_db), current_user:
         raise HTTPException(status_code=400, detail="Appointment patient information missing")
 
     # Create call log record so we can trace/answer/end this call (idempotent per start)
+    now = datetime.utcnow()
     cl = CallLog(appointment_id=appointment_id,
                  started_by_user_id=current_user.id,
-                 started_at=datetime.utcnow(),
-                 status="ringing")
+                 started_at=now,
+                 status="ringing",
+                 timeout_at=now + timedelta(seconds=CALL_RING_TIMEOUT))
     db.add(cl)
-    db.commit()
-    db.refresh(cl)
+    db.flush()
 
     # message_id used for client dedupe
     message_id = f"call_{cl.id}_{secrets.token_urlsafe(6)}"
 
-    # Get patient tokens
-    tokens_q = db.query(DeviceToken).filter(DeviceToken.user_id == appt.patient.user_id).all()
-    tokens = list({t.token for t in tokens_q if t and t.token})
-    print(f"START_CALL: found {len(tokens)} tokens for patient_user_id={appt.patient.user_id}")
-    if not tokens:
-        return {"ok": True, "sent": 0, "failed": 0, "errors": [], "call_log_id": cl.id, "message_id": message_id}
-
-    title = f"{(appt.doctor.user.name if appt.doctor and appt.doctor.user else 'Doctor')} is calling"
-    body = "Tap to answer the call"
+    doctor_name = appt.doctor.user.name if appt.doctor and appt.doctor.user else "Doctor"
     data_payload = {
         "type": "doctor_call",
         "appointment_id": str(appt.id),
-        "doctor_name": (appt.doctor.user.name if appt.doctor and appt.doctor.user else "Doctor"),
+        "doctor_name": doctor_name,
         "room": (appt.video_room or f"room_{appt.id}"),
         "call_log_id": str(cl.id),
         "message_id": message_id,   # for client dedupe
     }
-
-    # Platform configs
-    android_cfg = None
-    try:
-        if hasattr(messaging, "AndroidConfig") and hasattr(messaging, "AndroidNotification"):
-            android_cfg = messaging.AndroidConfig(
-                priority="high",
-                ttl=60,
-                notification=messaging.AndroidNotification(
-                    channel_id="calls_channel",
-                    sound="default",
-                    click_action="FLUTTER_NOTIFICATION_CLICK",
-                ),
-            )
-    except Exception as e:
-        print("START_CALL: AndroidConfig skipped:", e)
-
-    apns_cfg = None
-    try:
-        if hasattr(messaging, "ApnsConfig") and hasattr(messaging, "ApnsPayload") and hasattr(messaging, "Aps"):
-            apns_cfg = messaging.ApnsConfig(
-                headers={"apns-priority": "10"},
-                payload=messaging.ApnsPayload(
-                    aps=messaging.Aps(alert={"title": title, "body": body}, sound="telehealth_incoming_ringtone.caf")
-                ),
-            )
-    except Exception as e:
-        print("START_CALL: ApnsConfig skipped:", e)
-
-    webpush_cfg = None
-    try:
-        if hasattr(messaging, "WebpushConfig") and hasattr(messaging, "WebpushNotification"):
-            webpush_cfg = messaging.WebpushConfig(
-                headers={"TTL": "60", "Urgency": "high"},
-                notification=messaging.WebpushNotification(title=title, body=body),
-            )
-    except Exception as e:
-        print("START_CALL: WebpushConfig skipped:", e)
-
-    notification_obj = None
-    if hasattr(messaging, "Notification"):
-        try:
-            notification_obj = messaging.Notification(title=title, body=body)
-        except Exception:
-            notification_obj = None
-
-    success = 0
-    failed = 0
-    errors = []
-
-    # Try multicast
-    if hasattr(messaging, "send_multicast") and hasattr(messaging, "MulticastMessage"):
-        try:
-            multicast = messaging.MulticastMessage(
-                notification=(notification_obj if notification_obj else None),
-                data={k: str(v) for k, v in data_payload.items()},
-                android=android_cfg,
-                apns=apns_cfg,
-                webpush=webpush_cfg,
-                tokens=tokens,
-            )
-            res = messaging.send_multicast(multicast)
-            success = int(res.success_count or 0)
-            failed = int(res.failure_count or 0)
-            print(f"START_CALL: send_multicast result: success={success}, failed={failed}")
-            for i, resp in enumerate(res.responses):
-                if not resp.success:
-                    err = str(resp.exception) if resp.exception else "unknown"
-                    errors.append({"token": multicast.tokens[i], "error": err})
-                    if "Unregistered" in err or "not registered" in err or "registration-token-not-registered" in err:
-                        try:
-                            db.query(DeviceToken).filter(DeviceToken.token == multicast.tokens[i]).delete()
-                            db.commit()
-                        except Exception:
-                            db.rollback()
-            return {"ok": True, "sent": success, "failed": failed, "errors": errors, "call_log_id": cl.id, "message_id": message_id}
-        except Exception as e:
-            print("START_CALL: send_multicast failed, falling back:", e)
-            traceback.print_exc()
-
-    # Fallback: per-token send
-    for t in tokens:
-        try:
-            msg_kwargs = {"data": {k: str(v) for k, v in data_payload.items()}, "token": t}
-            if notification_obj: msg_kwargs["notification"] = notification_obj
-            if android_cfg: msg_kwargs["android"] = android_cfg
-            if apns_cfg: msg_kwargs["apns"] = apns_cfg
-            if webpush_cfg: msg_kwargs["webpush"] = webpush_cfg
-
-            msg = messaging.Message(**msg_kwargs)
-            messaging.send(msg)
-            success += 1
-        except Exception as e:
-            failed += 1
-            err = str(e)
-            print(f"START_CALL: send to token failed token={t} error={err}")
-            errors.append({"token": t, "error": err})
-            if "Unregistered" in err or "not registered" in err or "registration-token-not-registered" in err:
-                try:
-                    db.query(DeviceToken).filter(DeviceToken.token == t).delete()
-                    db.commit()
-                except Exception:
-                    db.rollback()
-            continue
-
-    print(f"START_CALL: per-token send result: success={success}, failed={failed}")
-    return {"ok": True, "sent": success, "failed": failed, "errors": errors, "call_log_id": cl.id, "message_id": message_id}
-    # schedule server-side timeout to mark missed if nobody answers in 60s
-    try:
-        schedule_call_timeout(appt.id, cl.id, timeout_seconds=60)
-    except Exception as e:
-        print("START_CALL: schedule_call_timeout failed:", e)
+    note = enqueue_notification(
+        db, [appt.patient.user_id], data_payload,
+        title=f"{doctor_name} is calling", body="Tap to answer the call",
+        options={"ttl": 60, "android_channel": "calls_channel", "apns_sound": "telehealth_incoming_ringtone.caf"},
+    )
+    db.commit()
+    print(f"START_CALL: queued doctor_call notification={note.id} for patient_user_id={appt.patient.user_id}")
+    # server-side timeout marks the call missed if nobody answers in CALL_RING_TIMEOUT seconds
+    schedule_call_timeout(appt.id, cl.id, deadline=cl.timeout_at)
+    return {"ok": True, "queued": True, "notification_id": note.id, "call_log_id": cl.id, "message_id": message_id}
 
 # ---------- <<END START_CALL_PATCH>> ----------
 
@@ -3511,28 +5419,15 @@ def answer_call(
         db.commit()
         db.refresh(cl)
 
-    # Mark answered
+    # Mark answered and queue the doctor's "patient joined" push in the same commit
     cl.answered_at = datetime.utcnow()
     cl.status = "answered"
+    cl.timeout_at = None
+    data_payload = {"type": "participant_joined", "appointment_id": str(appt.id), "call_log_id": str(cl.id), "message_id": f"call_{cl.id}_joined"}
+    enqueue_notification(db, [appt.doctor.user_id], data_payload,
+                         title="Patient joined", body=f"Patient has answered appointment #{appt.id}")
     db.commit()
-
-    # Notify doctor's device tokens that patient has joined
-    try:
-        tokens_q = db.query(DeviceToken).filter(DeviceToken.user_id == appt.doctor.user_id).all()
-        tokens = [t.token for t in tokens_q if t and t.token]
-        if tokens:
-            title = f"Patient joined"
-            body = f"Patient has answered appointment #{appt.id}"
-            data_payload = {"type": "participant_joined", "appointment_id": str(appt.id), "call_log_id": str(cl.id), "message_id": f"call_{cl.id}_joined"}
-            multicast = messaging.MulticastMessage(
-                notification=messaging.Notification(title=title, body=body),
-                data={k: str(v) for k, v in data_payload.items()},
-                tokens=list(set(tokens)),
-            )
-            res = messaging.send_multicast(multicast)
-            print(f"ANSWER_CALL: notified doctor tokens success={res.success_count} failed={res.failure_count}")
-    except Exception as e:
-        print("ANSWER_CALL: failed to notify doctor:", e)
+    _call_timeouts.cancel(cl.id)
 
     return {"ok": True, "call_log_id": cl.id}
 # ---------- <<END ANSWER_CALL_PATCH>> ----------
@@ -3650,9 +5545,7 @@ def upsert_prescription(appointment_id: int, content: str = Form(""), file: Uplo
 
     file_path = None
     if file is not None:
-        fname = f"rx_{appointment_id}_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}_{file.filename}"
-        file_path = os.path.join("uploads", fname)
-        with open(file_path, "wb") as f: f.write(file.file.read())
+        file_path = store_upload(db, file).path
 
     if appt.prescription:
         if content:
@@ -3683,8 +5576,11 @@ def get_prescription(appointment_id: int, current: User = Depends(get_current_us
     if not appt.prescription: return {"ok": True, "content": "", "file_path": None}
     return {"ok": True, "content": appt.prescription.content, "file_path": appt.prescription.file_path}
 
+def _prescription_filename(appt: Appointment) -> str:
+    return f"prescription_{appt.id}{os.path.splitext(appt.prescription.file_path)[1]}"
+
 @app.get("/appointments/{appointment_id}/prescription/download")
-def download_prescription(appointment_id: int,
+def download_prescription(appointment_id: int, request: Request,
                           current: User = Depends(get_current_user),
                           db: Session = Depends(get_db)):
     appt = db.get(Appointment, appointment_id)
@@ -3696,8 +5592,8 @@ def download_prescription(appointment_id: int,
         (current.role == UserRole.admin)
     )
     if not allowed: raise HTTPException(403, "Forbidden")
-    fname = os.path.basename(appt.prescription.file_path)
-    return FileResponse(path=appt.prescription.file_path, filename=fname, media_type="application/octet-stream")
+    return serve_file(request, appt.prescription.file_path, filename=_prescription_filename(appt),
+                      media_type="application/octet-stream")
 
 @app.delete("/appointments/{appointment_id}/prescription", response_model=dict)
 def delete_prescription(appointment_id: int,
@@ -3712,11 +5608,7 @@ def delete_prescription(appointment_id: int,
     )
     if not allowed: raise HTTPException(403, "Forbidden")
     if appt.prescription:
-        try:
-            if appt.prescription.file_path and os.path.exists(appt.prescription.file_path):
-                os.remove(appt.prescription.file_path)
-        except Exception:
-            pass
+        _discard_upload(appt.prescription.file_path)
         db.delete(appt.prescription); db.commit()
     return {"ok": True}
 
@@ -3742,7 +5634,7 @@ def get_prescription_text(appointment_id: int,
 # Download only the file (alias; canonical is /prescription/download)
 @app.get("/appointments/{appointment_id}/prescription/file")
 @app.get("/appointments/{appointment_id}/prescriptions/file")
-def get_prescription_file(appointment_id: int,
+def get_prescription_file(appointment_id: int, request: Request,
                           current: User = Depends(get_current_user),
                           db: Session = Depends(get_db)):
     appt = db.get(Appointment, appointment_id)
@@ -3755,8 +5647,8 @@ def get_prescription_file(appointment_id: int,
     if not allowed: raise HTTPException(403, "Forbidden")
     if not appt.prescription or not appt.prescription.file_path or not os.path.exists(appt.prescription.file_path):
         raise HTTPException(404, "Prescription file not found")
-    fname = os.path.basename(appt.prescription.file_path)
-    return FileResponse(path=appt.prescription.file_path, filename=fname, media_type="application/octet-stream")
+    return serve_file(request, appt.prescription.file_path, filename=_prescription_filename(appt),
+                      media_type="application/octet-stream")
 
 # Delete only the file, keep the text
 @app.delete("/appointments/{appointment_id}/prescription/file", response_model=dict)
@@ -3774,11 +5666,7 @@ def delete_prescription_file(appointment_id: int,
     if not allowed: raise HTTPException(403, "Forbidden")
     if not appt.prescription or not appt.prescription.file_path:
         raise HTTPException(404, "No prescription file to delete")
-    try:
-        if os.path.exists(appt.prescription.file_path):
-            os.remove(appt.prescription.file_path)
-    except Exception:
-        pass
+    _discard_upload(appt.prescription.file_path)
     appt.prescription.file_path = None
     appt.last_modified_by_user_id = current.id
     appt.last_modified_at = datetime.utcnow()
@@ -3828,10 +5716,7 @@ def upload_report_for_appointment(
     if not allowed:
         raise HTTPException(403, "Forbidden")
 
-    fname = f"rep_appt_{appointment_id}_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}_{file.filename}"
-    path = os.path.join("uploads", fname)
-    with open(path, "wb") as f:
-        f.write(file.file.read())
+    path = store_upload(db, file).path
 
     r = MedicalReport(
         patient_id=appt.patient_id,
@@ -3844,6 +5729,10 @@ def upload_report_for_appointment(
     db.refresh(r)
     return {"ok": True, "id": r.id, "file_path": r.file_path, "original_name": r.original_name}
 
+def _report_out(r: MedicalReport) -> ReportOut:
+    return ReportOut(id=r.id, original_name=r.original_name, uploaded_at=r.uploaded_at, file_path=r.file_path,
+                     thumb_url=_derivatives.url(r.file_path), preview_url=_derivatives.url(r.file_path, "preview"))
+
 @app.get("/appointments/{appointment_id}/reports", response_model=List[ReportOut])
 def list_reports_for_appointment(
     appointment_id: int,
@@ -3866,7 +5755,7 @@ def list_reports_for_appointment(
           .order_by(MedicalReport.uploaded_at.desc())
           .all()
     )
-    return [ReportOut(id=i.id, original_name=i.original_name, uploaded_at=i.uploaded_at, file_path=i.file_path) for i in items]
+    return [_report_out(i) for i in items]
 
 @app.delete("/appointments/{appointment_id}/reports/{report_id}", response_model=dict)
 def delete_report_for_appointment(
@@ -3890,11 +5779,7 @@ def delete_report_for_appointment(
     if not allowed:
         raise HTTPException(403, "Forbidden")
 
-    try:
-        if row.file_path and os.path.exists(row.file_path):
-            os.remove(row.file_path)
-    except Exception:
-        pass
+    _discard_upload(row.file_path)
     db.delete(row)
     db.commit()
     return {"ok": True}
@@ -3920,12 +5805,8 @@ def patient_delete_report(
     elif current.role != UserRole.admin:
         raise HTTPException(403, "Forbidden")
 
-    # Remove file from disk if present
-    try:
-        if row.file_path and os.path.exists(row.file_path):
-            os.remove(row.file_path)
-    except Exception:
-        pass
+    # Remove file from disk if present (shared blobs are just released)
+    _discard_upload(row.file_path)
 
     db.delete(row)
     db.commit()
@@ -3951,18 +5832,15 @@ def upload_doctor_document(
 ):
     d = current.doctor_profile
     if not d: raise HTTPException(400, "Doctor profile missing")
-    fname = f"doc_{d.id}_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}_{file.filename}"
-    path = os.path.join("uploads", fname)
-    with open(path, "wb") as f: f.write(file.file.read())
+    path = store_upload(db, file).path
     row = DoctorDocument(doctor_id=d.id, title=title, doc_type=doc_type, file_path=path)
     db.add(row); db.commit(); db.refresh(row)
     return DoctorDocOut(id=row.id, title=row.title, doc_type=row.doc_type, file_path=row.file_path, uploaded_at=row.uploaded_at)
 
 @app.get("/doctor/documents", response_model=List[DoctorDocOut])
-def list_doctor_documents(current: User = Depends(require_role(UserRole.doctor)), db: Session = Depends(get_db)):
-    d = current.doctor_profile
-    if not d: raise HTTPException(400, "Doctor profile missing")
-    items = db.query(DoctorDocument).filter(DoctorDocument.doctor_id == d.id).order_by(DoctorDocument.uploaded_at.desc()).all()
+def list_doctor_documents(current: Principal = Depends(require_principal(UserRole.doctor)), db: Session = Depends(get_db)):
+    if not current.doctor_id: raise HTTPException(400, "Doctor profile missing")
+    items = db.query(DoctorDocument).filter(DoctorDocument.doctor_id == current.doctor_id).order_by(DoctorDocument.uploaded_at.desc()).all()
     return [DoctorDocOut(id=i.id, title=i.title, doc_type=i.doc_type, file_path=i.file_path, uploaded_at=i.uploaded_at) for i in items]
 
 @app.delete("/doctor/documents/{doc_id}", response_model=dict)
@@ -3971,11 +5849,7 @@ def delete_doctor_document(doc_id: int, current: User = Depends(require_role(Use
     if not d: raise HTTPException(400, "Doctor profile missing")
     row = db.get(DoctorDocument, doc_id)
     if not row or row.doctor_id != d.id: raise HTTPException(404, "Not found")
-    try:
-        if row.file_path and os.path.exists(row.file_path):
-            os.remove(row.file_path)
-    except Exception:
-        pass
+    _discard_upload(row.file_path)
     db.delete(row); db.commit()
     return {"ok": True}
 
@@ -3988,9 +5862,7 @@ def patient_upload_report(file: UploadFile = File(...),
                           db: Session = Depends(get_db)):
     p = current.patient_profile
     if not p: raise HTTPException(400, "Patient profile missing")
-    fname = f"rep_{p.id}_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}_{file.filename}"
-    path = os.path.join("uploads", fname)
-    with open(path, "wb") as f: f.write(file.file.read())
+    path = store_upload(db, file).path
     r = MedicalReport(patient_id=p.id, file_path=path, original_name=file.filename)
     db.add(r); db.commit(); db.refresh(r)
     return {"ok": True, "id": r.id, "name": r.original_name, "file_path": r.file_path}
@@ -4001,19 +5873,16 @@ def admin_upload_report_for_patient(patient_id: int, file: UploadFile = File(...
                                     db: Session = Depends(get_db)):
     p = db.get(Patient, patient_id)
     if not p: raise HTTPException(404, "Patient not found")
-    fname = f"rep_{p.id}_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}_{file.filename}"
-    path = os.path.join("uploads", fname)
-    with open(path, "wb") as f: f.write(file.file.read())
+    path = store_upload(db, file).path
     r = MedicalReport(patient_id=p.id, file_path=path, original_name=file.filename)
     db.add(r); db.commit(); db.refresh(r)
     return {"ok": True, "id": r.id, "name": r.original_name, "file_path": r.file_path}
 
 @app.get("/patients/reports", response_model=List[ReportOut])
-def list_my_reports(current: User = Depends(require_role(UserRole.patient)), db: Session = Depends(get_db)):
-    p = current.patient_profile
-    items = (db.query(MedicalReport).filter(MedicalReport.patient_id == p.id)
+def list_my_reports(current: Principal = Depends(require_principal(UserRole.patient)), db: Session = Depends(get_db)):
+    items = (db.query(MedicalReport).filter(MedicalReport.patient_id == current.patient_id)
              .order_by(MedicalReport.uploaded_at.desc()).all())
-    return [ReportOut(id=i.id, original_name=i.original_name, uploaded_at=i.uploaded_at, file_path=i.file_path) for i in items]
+    return [_report_out(i) for i in items]
 
 @app.get("/patients/{patient_id}", response_model=dict)
 def get_patient_by_id(patient_id: int, current: User = Depends(get_current_user), db: Session = Depends(get_db)):
@@ -4047,7 +5916,7 @@ def list_reports_for_patient(patient_id: int, current: User = Depends(get_curren
             raise HTTPException(403, "Forbidden")
     items = (db.query(MedicalReport).filter(MedicalReport.patient_id == p.id)
              .order_by(MedicalReport.uploaded_at.desc()).all())
-    return [ReportOut(id=i.id, original_name=i.original_name, uploaded_at=i.uploaded_at, file_path=i.file_path) for i in items]
+    return [_report_out(i) for i in items]
 
 @app.get("/patients/{patient_id}/prescriptions", response_model=List[dict])
 def list_patient_prescriptions(patient_id: int,
@@ -4100,7 +5969,8 @@ def get_patient_profile(current: User = Depends(require_role(UserRole.patient)),
         },
         "appointments": [{"id": a.id, "start_time": a.start_time, "end_time": a.end_time,
                           "status": a.status.value, "progress": a.progress.value} for a in appts],
-        "reports": [{"id": r.id, "name": r.original_name, "at": r.uploaded_at, "file_path": r.file_path} for r in reports],
+        "reports": [{"id": r.id, "name": r.original_name, "at": r.uploaded_at, "file_path": r.file_path,
+                     "thumb_url": _derivatives.url(r.file_path)} for r in reports],
         "prescriptions": prescs,
     }
 
@@ -4141,10 +6011,9 @@ def rate_doctor(appointment_id: int, body: RateIn, current: User = Depends(requi
     return row
 
 @app.get("/me/appointments", response_model=List[AppointmentOut])
-def my_appointments(current: User = Depends(require_role(UserRole.patient)), db: Session = Depends(get_db)):
-    p = current.patient_profile
+def my_appointments(current: Principal = Depends(require_principal(UserRole.patient)), db: Session = Depends(get_db)):
     rows = (db.query(Appointment)
-            .filter(Appointment.patient_id == p.id)
+            .filter(Appointment.patient_id == current.patient_id)
             .order_by(Appointment.start_time.desc())
             .all())
     return [
@@ -4186,7 +6055,11 @@ def reschedule_appointment(appointment_id: int, body: RescheduleIn,
     if not appt: raise HTTPException(404, "Appointment not found")
     if not _can_touch_appt(current, appt): raise HTTPException(403, "Forbidden")
 
-    if slot_capacity_left(db, appt.doctor_id, body.new_start_time, body.new_end_time) <= 0:
+    if appt.status in ACTIVE_STATUSES:
+        if not _reserve_slot(db, appt.doctor_id, body.new_start_time, body.new_end_time):
+            raise HTTPException(400, "New time not available")
+        _adjust_slot(db, appt.doctor_id, appt.start_time, appt.end_time, +1)
+    elif slot_capacity_left(db, appt.doctor_id, body.new_start_time, body.new_end_time) <= 0:
         raise HTTPException(400, "New time not available")
 
     db.add(AppointmentChangeLog(
@@ -4195,10 +6068,12 @@ def reschedule_appointment(appointment_id: int, body: RescheduleIn,
         new_start_time=body.new_start_time, new_end_time=body.new_end_time,
         reason=body.reason or ""
     ))
+    old_days = (appt.start_time, appt.end_time)
     appt.start_time = body.new_start_time
     appt.end_time = body.new_end_time
     appt.last_modified_by_user_id = current.id
     appt.last_modified_at = datetime.utcnow()
+    _calendar_touch(db, appt.doctor_id, *old_days, appt.start_time, appt.end_time)
     db.commit(); db.refresh(appt)
     return appt
 # ===== Prescription rendering (PDF + JPG) =====================================
@@ -4667,10 +6542,13 @@ def cancel_appointment(appointment_id: int, body: CancelIn,
         new_start_time=appt.start_time, new_end_time=appt.end_time,
         reason=f"CANCEL: {body.reason or ''}"
     ))
+    if appt.status in ACTIVE_STATUSES:
+        _adjust_slot(db, appt.doctor_id, appt.start_time, appt.end_time, +1)
     appt.status = AppointmentStatus.cancelled
     appt.cancel_reason = body.reason or ""
     appt.last_modified_by_user_id = current.id
     appt.last_modified_at = datetime.utcnow()
+    _calendar_touch(db, appt.doctor_id, appt.start_time, appt.end_time)
     db.commit(); db.refresh(appt)
     return appt
 
@@ -4707,14 +6585,14 @@ def delete_appointment(
         raise HTTPException(400, "Cannot delete a pending appointment. Cancel it first.")
 
     if appt.prescription:
-        try:
-            if appt.prescription.file_path and os.path.exists(appt.prescription.file_path):
-                os.remove(appt.prescription.file_path)
-        except Exception:
-            pass
+        _discard_upload(appt.prescription.file_path)
         db.delete(appt.prescription)
+    _discard_upload(appt.disease_photo_path)
 
+    if appt.status in ACTIVE_STATUSES:
+        _adjust_slot(db, appt.doctor_id, appt.start_time, appt.end_time, +1)
     db.delete(appt)
+    _calendar_touch(db, appt.doctor_id, appt.start_time, appt.end_time)
     db.commit()
     return {"ok": True}
 
@@ -4766,6 +6644,10 @@ class AppointmentMessage(Base):
     appointment = relationship("Appointment")
     sender = relationship("User")
 
+    __table_args__ = (Index("ix_appointment_messages_appt_id", "appointment_id", "id"),)
+
+_BLOB_REF_COLUMNS[AppointmentMessage] = ("file_path",)
+
 
 # SQLite auto-create helper for appointment_messages (idempotent)
 def _ensure_messages_table(conn):
@@ -4792,28 +6674,16 @@ except Exception:
     pass
 
 
-# --- small in-process dedupe cache to avoid rapid duplicate notifications ----
-_recent_notifications: Dict[str, float] = {}
+# --- notification dedupe, shared by all workers through the fan-out bus ----
+_fanout = fanout.get_bus()
 
 def _should_send_notification(key: str, window_seconds: float = 2.0) -> bool:
     """
-    Returns True if we should send (and records now). If the same key
-    was sent within the last `window_seconds`, returns False.
+    Returns True if we should send (and claims the key). If the same key
+    was claimed within the last `window_seconds` on any worker, returns False.
     """
     try:
-        now = time.time()
-        last = _recent_notifications.get(key)
-        if last is None or (now - last) > window_seconds:
-            _recent_notifications[key] = now
-            # prune occasional old entries to keep memory small
-            if len(_recent_notifications) > 5000:
-                cutoff = now - 60.0
-                for k in list(_recent_notifications.keys()):
-                    if _recent_notifications.get(k, 0) < cutoff:
-                        _recent_notifications.pop(k, None)
-            return True
-        else:
-            return False
+        return _fanout.claim_once(f"notify:{key}", window_seconds)
     except Exception:
         return True
 
@@ -4821,16 +6691,7 @@ def _should_send_notification(key: str, window_seconds: float = 2.0) -> bool:
 def _get_user_device_tokens(db: Session, user_id: int) -> List[str]:
     """Return list of tokens for user (deduped)."""
     try:
-        rows = db.query(DeviceToken).filter(DeviceToken.user_id == user_id).all()
-        tokens = [r.token for r in rows if r and r.token]
-        # dedupe while preserving order
-        out: List[str] = []
-        seen = set()
-        for t in tokens:
-            if t and t not in seen:
-                seen.add(t)
-                out.append(t)
-        return out
+        return get_tokens_for_users(db, [user_id]).get(user_id, [])
     except Exception:
         return []
 
@@ -4840,20 +6701,16 @@ def _prune_bad_tokens(db: Session, bad_tokens: List[str]):
     if not bad_tokens:
         return
     try:
-        for t in bad_tokens:
-            try:
-                db.query(DeviceToken).filter(DeviceToken.token == t).delete()
-                db.commit()
-            except Exception:
-                db.rollback()
+        _delete_device_tokens(db, bad_tokens)
+        db.commit()
     except Exception:
-        pass
+        db.rollback()
 
 
 def _notify_chat_message(db: Session, appt: Appointment, msg: AppointmentMessage):
     """
-    Send a visible notification + data to other participants (doctor/patient) for a chat message.
-    Aggregates tokens for all recipients and sends a single multicast so a token is notified once.
+    Queue a visible notification + data to the other participants (doctor/patient) for a
+    chat message. One outbox row covers all recipients, so each token is notified once.
     """
     try:
         # Build dedupe key to avoid rapid double-sends (same user action)
@@ -4882,28 +6739,11 @@ def _notify_chat_message(db: Session, appt: Appointment, msg: AppointmentMessage
         except Exception:
             pass
 
+        # participants watching the chat over a live socket already have it
+        recipients -= _chat_hub.online_users(msg.appointment_id)
         if not recipients:
             return
 
-        # Aggregate tokens for all recipients and dedupe globally
-        tokens_set: Set[str] = set()
-        for rid in recipients:
-            toks = _get_user_device_tokens(db, rid)
-            for t in toks:
-                if t:
-                    tokens_set.add(t)
-
-        # Remove sender's own tokens (don't notify sender)
-        try:
-            sender_tokens = set(_get_user_device_tokens(db, msg.sender_user_id))
-            tokens_set.difference_update(sender_tokens)
-        except Exception:
-            pass
-
-        tokens = list(tokens_set)
-        if not tokens:
-            return
-
         data_payload = {
             "type": "chat_message",
             "appointment_id": str(msg.appointment_id),
@@ -4915,113 +6755,51 @@ def _notify_chat_message(db: Session, appt: Appointment, msg: AppointmentMessage
             "created_at": str(msg.created_at),
         }
 
-        # Visible notification object (ensures OS shows a visible notification)
-        notification_obj = None
-        try:
-            notification_obj = messaging.Notification(title=title, body=body_text)
-        except Exception:
-            notification_obj = None
-
-        # Android config
-        android_cfg = None
-        try:
-            android_cfg = messaging.AndroidConfig(
-                priority="high",
-                ttl=60,
-                notification=messaging.AndroidNotification(
-                    channel_id="chat_channel",
-                    click_action="FLUTTER_NOTIFICATION_CLICK",
-                    sound="default",
-                ),
-            )
-        except Exception:
-            android_cfg = None
-
-        # APNs config (iOS)
-        apns_cfg = None
-        try:
-            apns_cfg = messaging.ApnsConfig(
-                headers={"apns-priority": "10"},
-                payload=messaging.ApnsPayload(
-                    aps=messaging.Aps(alert={"title": title, "body": body_text}, sound="default")
-                ),
-            )
-        except Exception:
-            apns_cfg = None
-
-        # Webpush config
-        webpush_cfg = None
-        try:
-            webpush_cfg = messaging.WebpushConfig(
-                headers={"TTL": "60", "Urgency": "high"},
-                notification=messaging.WebpushNotification(title=title, body=body_text),
-            )
-        except Exception:
-            webpush_cfg = None
-
-        # Send single multicast to all recipient tokens
-        multi = messaging.MulticastMessage(
-            notification=notification_obj,
-            data={k: (v or "") for k, v in data_payload.items()},
-            android=android_cfg,
-            apns=apns_cfg,
-            webpush=webpush_cfg,
-            tokens=tokens,
-        )
-
-        try:
-            resp = messaging.send_multicast(multi)
-            # If there are failures, prune NotRegistered tokens
-            bad = []
-            if hasattr(resp, "responses"):
-                for i, r in enumerate(resp.responses):
-                    if not getattr(r, "success", False):
-                        ex = getattr(r, "exception", None)
-                        errstr = str(ex) if ex else ""
-                        tok = tokens[i]
-                        if "NotRegistered" in errstr or "Unregistered" in errstr or "registration-token-not-registered" in errstr:
-                            bad.append(tok)
-                if bad:
-                    _prune_bad_tokens(db, bad)
-        except Exception as e:
-            # Fallback: try per-token send and prune invalid ones
-            bad_tokens = []
-            for t in tokens:
-                try:
-                    kwargs = {"data": {k: (v or "") for k, v in data_payload.items()}, "token": t}
-                    if notification_obj:
-                        kwargs["notification"] = notification_obj
-                    if android_cfg:
-                        kwargs["android"] = android_cfg
-                    if apns_cfg:
-                        kwargs["apns"] = apns_cfg
-                    if webpush_cfg:
-                        kwargs["webpush"] = webpush_cfg
-                    messaging.send(messaging.Message(**kwargs))
-                except Exception as ex2:
-                    err2 = str(ex2)
-                    if "NotRegistered" in err2 or "Unregistered" in err2 or "registration-token-not-registered" in err2:
-                        bad_tokens.append(t)
-            if bad_tokens:
-                _prune_bad_tokens(db, bad_tokens)
+        # One outbox row for all recipients; the sender's own devices are excluded
+        enqueue_notification(db, recipients, data_payload, title=title, body=body_text,
+                             options={"ttl": 60, "android_channel": "chat_channel"},
+                             exclude_user_ids=[msg.sender_user_id])
+        db.commit()
 
     except Exception as e:
+        db.rollback()
         print("_notify_chat_message error:", e)
 
 
+# ---------- chat history paging ----------
+def _keyset_page(query, id_col, limit: int, before_id: Optional[int] = None,
+                 after_id: Optional[int] = None) -> Tuple[list, bool]:
+    """
+    One page of a message query by primary key instead of OFFSET, served by an
+    (appointment_id, id) index. after_id -> the next `limit` newer rows;
+    before_id (or neither) -> the `limit` rows just older (newest first when neither).
+    Rows come back oldest first; the flag says whether more exist in that direction.
+    """
+    if after_id is not None:
+        rows = query.filter(id_col > after_id).order_by(id_col.asc()).limit(limit + 1).all()
+        return rows[:limit], len(rows) > limit
+    if before_id is not None:
+        query = query.filter(id_col < before_id)
+    rows = query.order_by(id_col.desc()).limit(limit + 1).all()
+    return list(reversed(rows[:limit])), len(rows) > limit
+
 # ---------- Text chat endpoints (legacy Message table) ----------
 @app.get("/appointments/{appointment_id}/messages", response_model=List[dict])
-def list_messages(appointment_id: int, page: int = 1, page_size: int = 50, db: Session = Depends(get_db), current: User = Depends(get_current_user)):
+def list_messages(appointment_id: int, page: int = 1, page_size: int = 50,
+                  before_id: Optional[int] = None, after_id: Optional[int] = None,
+                  db: Session = Depends(get_db), current: Principal = Depends(get_current_principal)):
+    """Oldest first. before_id/after_id page by message id (see _keyset_page); page is the legacy OFFSET mode."""
     appt = db.get(Appointment, appointment_id)
     if not appt:
         raise HTTPException(404, "Appointment not found")
     # Authorization: only patient/doctor/admin
-    if not ((current.role == UserRole.admin) or
-            (current.role == UserRole.doctor and appt.doctor.user_id == current.id) or
-            (current.role == UserRole.patient and appt.patient.user_id == current.id)):
+    if not _principal_on_appt(current, appt):
         raise HTTPException(403, "Forbidden")
-    q = db.query(Message).filter(Message.appointment_id == appointment_id).order_by(Message.created_at.asc())
-    items = q.offset((page - 1) * page_size).limit(page_size).all()
+    q = db.query(Message).filter(Message.appointment_id == appointment_id)
+    if before_id is not None or after_id is not None:
+        items, _ = _keyset_page(q, Message.id, page_size, before_id, after_id)
+    else:
+        items = q.order_by(Message.id.asc()).offset((page - 1) * page_size).limit(page_size).all()
     out = []
     for m in items:
         out.append({
@@ -5103,43 +6881,230 @@ def mark_messages_read(appointment_id: int, db: Session = Depends(get_db), curre
     return {"ok": True, "updated": int(updated)}
 
 
+# ---------- live chat (WebSocket) ----------
+CHAT_WS_SEND_TIMEOUT = float(os.getenv("CHAT_WS_SEND_TIMEOUT", "5"))
+
+class ChatHub:
+    """
+    Live chat sockets per appointment. Sockets live in the worker that accepted
+    them; messages and presence go through the fan-out bus (fanout.py), so a
+    message sent on any worker reaches every socket and a participant online on
+    any worker is skipped by the chat FCM push. Runs on the event loop.
+    """
+    def __init__(self, bus):
+        self.bus = bus
+        self._rooms: Dict[int, Dict[WebSocket, str]] = {}    # appt -> {ws: bus member}
+        self._subs: Dict[int, Optional[int]] = {}              # appt -> bus subscription
+        self._held: Dict[WebSocket, list] = {}                # ws -> events buffered until release()
+        self.stats = {"connections": 0, "published": 0, "delivered": 0, "dropped": 0}
+
+    @staticmethod
+    def _channel(appointment_id: int) -> str:
+        return f"chat:{appointment_id}"
+
+    async def join(self, appointment_id: int, ws: WebSocket, user_id: int, hold: bool = False) -> None:
+        """With hold=True events for `ws` are buffered until release(), so the caller
+        can read and send a backlog after joining without missing anything."""
+        member = f"{user_id}:{secrets.token_hex(6)}"
+        if hold:
+            self._held[ws] = []
+        self._rooms.setdefault(appointment_id, {})[ws] = member
+        await self.bus.ajoin(self._channel(appointment_id), member)
+        self.stats["connections"] += 1
+        if appointment_id not in self._subs:
+            self._subs[appointment_id] = None
+            sub = await self.bus.subscribe(self._channel(appointment_id),
+                                           lambda event: self._deliver(appointment_id, event))
+            if appointment_id in self._rooms:
+                self._subs[appointment_id] = sub
+            else:
+                self._subs.pop(appointment_id, None)
+                await self.bus.unsubscribe(sub)
+
+    async def release(self, ws: WebSocket, sent_ids=()) -> None:
+        """Send what was buffered since join(hold=True), minus messages in `sent_ids`, then go live."""
+        while self._held.get(ws):
+            events, self._held[ws] = self._held[ws], []
+            for event in events:
+                if (event.get("message") or {}).get("id") in sent_ids:
+                    continue
+                await ws.send_json(event)
+        self._held.pop(ws, None)
+
+    async def leave(self, appointment_id: int, ws: WebSocket) -> None:
+        self._held.pop(ws, None)
+        room = self._rooms.get(appointment_id)
+        if room is None or ws not in room:
+            return
+        await self.bus.aleave(self._channel(appointment_id), room.pop(ws))
+        if not room:
+            self._rooms.pop(appointment_id, None)
+            sub = self._subs.pop(appointment_id, None)
+            if sub is not None:
+                await self.bus.unsubscribe(sub)
+
+    def online_users(self, appointment_id: int) -> set:
+        """User ids with an open chat socket on any worker."""
+        users = set()
+        for member in self.bus.members(self._channel(appointment_id)):
+            try:
+                users.add(int(member.split(":", 1)[0]))
+            except ValueError:
+                pass
+        return users
+
+    async def publish(self, appointment_id: int, event: dict) -> None:
+        """Fan `event` out to the appointment's sockets on every worker."""
+        self.stats["published"] += 1
+        await self.bus.apublish(self._channel(appointment_id), jsonable_encoder(event))
+
+    async def _deliver(self, appointment_id: int, event: dict) -> None:
+        room = self._rooms.get(appointment_id)
+        if not room:
+            return
+        sockets = []
+        for ws in room:
+            if ws in self._held:
+                self._held[ws].append(event)
+            else:
+                sockets.append(ws)
+        if not sockets:
+            return
+
+        async def _send(ws: WebSocket) -> bool:
+            try:
+                await asyncio.wait_for(ws.send_json(event), CHAT_WS_SEND_TIMEOUT)
+                return True
+            except Exception:
+                return False
+
+        results = await asyncio.gather(*(_send(ws) for ws in sockets))
+        for ws, ok in zip(sockets, results):
+            if not ok:
+                await self.leave(appointment_id, ws)
+                self.stats["dropped"] += 1
+        self.stats["delivered"] += sum(results)
+
+    def snapshot(self) -> dict:
+        return {"rooms": len(self._rooms), "sockets": sum(len(r) for r in self._rooms.values()), **self.stats}
+
+_chat_hub = ChatHub(_fanout)
+
+def _chat_message_out(m: "AppointmentMessage") -> dict:
+    return {
+        "id": m.id,
+        "appointment_id": m.appointment_id,
+        "sender_user_id": m.sender_user_id,
+        "body": m.body,
+        "file_path": m.file_path,
+        "thumb_url": _derivatives.url(m.file_path),
+        "preview_url": _derivatives.url(m.file_path, "preview"),
+        "created_at": m.created_at,
+    }
+
+def _chat_backlog(appointment_id: int, after_id: int) -> List[dict]:
+    db = SessionLocal()
+    try:
+        base = db.query(AppointmentMessage).filter(AppointmentMessage.appointment_id == appointment_id)
+        backlog, _ = _keyset_page(base, AppointmentMessage.id, 500, after_id=after_id)
+        return [_chat_message_out(m) for m in backlog]
+    finally:
+        db.close()
+
+@app.websocket("/appointments/{appointment_id}/chat/ws")
+async def chat_ws(ws: WebSocket, appointment_id: int, token: Optional[str] = None,
+                  after_id: Optional[int] = None):
+    """
+    Live chat for one appointment. Authenticate with ?token=<access token> (or an
+    Authorization: Bearer header). Server sends {"type": "chat_message", "message": {...}}
+    for every new message; with ?after_id=N the messages newer than N are sent first.
+    Client may send {"type": "ping"} and gets {"type": "pong"}.
+    """
+    if not token:
+        auth = ws.headers.get("authorization") or ""
+        token = auth[7:] if auth.lower().startswith("bearer ") else None
+    db = SessionLocal()
+    try:
+        try:
+            principal = _authenticate_token(db, token or "")
+        except HTTPException:
+            await ws.close(code=4401)
+            return
+        appt = db.get(Appointment, appointment_id)
+        if not appt or not _principal_on_appt(principal, appt):
+            await ws.close(code=4403)
+            return
+    finally:
+        db.close()
+
+    await ws.accept()
+    await _chat_hub.join(appointment_id, ws, principal.user_id, hold=after_id is not None)
+    try:
+        if after_id is not None:
+            # read the backlog only once joined: a message committed meanwhile is either
+            # in the backlog or buffered by the hub (or both, and then sent once)
+            backlog = await run_in_threadpool(_chat_backlog, appointment_id, after_id)
+            for out in backlog:
+                await ws.send_json(jsonable_encoder({"type": "chat_message", "message": out}))
+            await _chat_hub.release(ws, {out["id"] for out in backlog})
+        while True:
+            msg = await ws.receive_json()
+            if isinstance(msg, dict) and msg.get("type") == "ping":
+                await ws.send_json({"type": "pong"})
+    except (WebSocketDisconnect, ValueError, RuntimeError):
+        pass
+    finally:
+        await _chat_hub.leave(appointment_id, ws)
+
 # ---------- Appointment-scoped chat endpoints (with files) ----------
 @app.get("/appointments/{appointment_id}/chat", response_model=dict)
 def list_chat_messages(
     appointment_id: int,
-    page: int = Query(1, ge=1),
+    page: Optional[int] = Query(None, ge=1),
     page_size: int = Query(50, ge=1, le=500),
-    current: User = Depends(get_current_user),
+    before_id: Optional[int] = Query(None, ge=1),
+    after_id: Optional[int] = Query(None, ge=0),
+    include_total: Optional[bool] = None,
+    current: Principal = Depends(get_current_principal),
     db: Session = Depends(get_db),
 ):
+    """
+    Messages oldest first.
+      - after_id=N: next page newer than N (poll for new messages)
+      - before_id=N: page just older than N ("load older")
+      - neither cursor nor page: the newest page
+      - page=N: legacy OFFSET paging
+    next_before_id / next_after_id are the cursors for the following calls.
+    total is only counted on request (include_total=true), or in legacy page mode.
+    """
     appt = db.get(Appointment, appointment_id)
     if not appt:
         raise HTTPException(404, "Appointment not found")
 
     # permission: admin or doctor/patient on appt
-    allowed = (
-        current.role == UserRole.admin
-        or (current.role == UserRole.doctor and appt.doctor and appt.doctor.user_id == current.id)
-        or (current.role == UserRole.patient and appt.patient and appt.patient.user_id == current.id)
-    )
-    if not allowed:
+    if not _principal_on_appt(current, appt):
         raise HTTPException(403, "Forbidden")
 
     base = db.query(AppointmentMessage).filter(AppointmentMessage.appointment_id == appointment_id)
-    total = base.count()
-    items = base.order_by(AppointmentMessage.created_at.asc()).offset((page - 1) * page_size).limit(page_size).all()
-
-    out = []
-    for m in items:
-        out.append({
-            "id": m.id,
-            "appointment_id": m.appointment_id,
-            "sender_user_id": m.sender_user_id,
-            "body": m.body,
-            "file_path": m.file_path,
-            "created_at": m.created_at,
+    keyset = page is None
+    if include_total is None:
+        include_total = not keyset
+    total = base.count() if include_total else None
+    has_more = None
+    if keyset:
+        items, has_more = _keyset_page(base, AppointmentMessage.id, page_size, before_id, after_id)
+    else:
+        items = base.order_by(AppointmentMessage.id.asc()).offset((page - 1) * page_size).limit(page_size).all()
+
+    out = [_chat_message_out(m) for m in items]
+    resp = {"ok": True, "page": page, "page_size": page_size, "total": total, "items": out}
+    if keyset:
+        resp.update({
+            "has_more": has_more,
+            "next_before_id": items[0].id if items else before_id,
+            "next_after_id": items[-1].id if items else after_id,
         })
-    return {"ok": True, "page": page, "page_size": page_size, "total": total, "items": out}
+    return resp
 
 
 @app.post("/appointments/{appointment_id}/chat/send", response_model=dict)
@@ -5193,11 +7158,9 @@ async def send_chat_message(
     file_path = None
     if file is not None:
         try:
-            fname = f"chat_{appointment_id}_{current.id}_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}_{file.filename}"
-            path = os.path.join("uploads", fname)
-            with open(path, "wb") as fh:
-                fh.write(file.file.read())
-            file_path = path
+            file_path = (await store_upload_async(db, file)).path
+        except HTTPException:
+            raise
         except Exception as e:
             print("chat upload error:", e)
             raise HTTPException(500, "Failed to save uploaded file")
@@ -5216,23 +7179,15 @@ async def send_chat_message(
     db.commit()
     db.refresh(msg)
 
-    # Notify the other participant(s)
+    # Live sockets first; FCM only for participants who have none
+    await _chat_hub.publish(appointment_id, {"type": "chat_message", "message": _chat_message_out(msg)})
     try:
-        _notify_chat_message(db, appt, msg)
+        # presence lookup and dedupe claim may be bus round-trips: keep them off the loop
+        await run_in_threadpool(_notify_chat_message, db, appt, msg)
     except Exception as e:
         print("notify_chat_message error:", e)
 
-    return {
-        "ok": True,
-        "message": {
-            "id": msg.id,
-            "appointment_id": msg.appointment_id,
-            "sender_user_id": msg.sender_user_id,
-            "body": msg.body,
-            "file_path": msg.file_path,
-            "created_at": msg.created_at,
-        },
-    }
+    return {"ok": True, "message": _chat_message_out(msg)}
 
 
 @app.post("/appointments/{appointment_id}/chat/upload", response_model=dict)
@@ -5257,11 +7212,9 @@ async def upload_chat_file_only(
         raise HTTPException(403, "Forbidden")
 
     try:
-        fname = f"chat_{appointment_id}_{current.id}_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}_{file.filename}"
-        path = os.path.join("uploads", fname)
-        with open(path, "wb") as fh:
-            fh.write(file.file.read())
-        file_path = path
+        file_path = (await store_upload_async(db, file)).path
+    except HTTPException:
+        raise
     except Exception as e:
         print("chat upload error:", e)
         raise HTTPException(500, "Failed to save uploaded file")
@@ -5278,23 +7231,15 @@ async def upload_chat_file_only(
     db.commit()
     db.refresh(msg)
 
-    # notify other participants
+    # notify other participants (live sockets, then FCM for the rest)
+    await _chat_hub.publish(appointment_id, {"type": "chat_message", "message": _chat_message_out(msg)})
     try:
-        _notify_chat_message(db, appt, msg)
+        # presence lookup and dedupe claim may be bus round-trips: keep them off the loop
+        await run_in_threadpool(_notify_chat_message, db, appt, msg)
     except Exception as e:
         print("notify_chat_message error:", e)
 
-    return {
-        "ok": True,
-        "message": {
-            "id": msg.id,
-            "appointment_id": msg.appointment_id,
-            "sender_user_id": msg.sender_user_id,
-            "body": msg.body,
-            "file_path": msg.file_path,
-            "created_at": msg.created_at,
-        },
-    }
+    return {"ok": True, "message": _chat_message_out(msg)}
 
 # ----------------------------------------------------------------------------- end chat
 
@@ -5306,7 +7251,7 @@ def bootstrap_admin(email: EmailStr, name: str = "Admin", password: str = "admin
                     db: Session = Depends(get_db)):
     if db.query(User).filter(User.email == email).first():
         raise HTTPException(400, "Email exists")
-    u = User(name=name, email=email, role=UserRole.admin, password_hash=hash_password(password))
+    u = User(name=name, email=email, role=UserRole.admin, password_hash=hash_password_pooled(password))
     db.add(u); db.commit(); db.refresh(u)
     return u
 
@@ -5388,9 +7333,7 @@ async def doctor_update_profile(
 def doctor_upload_photo(file: UploadFile = File(...),
                         current: User = Depends(require_role(UserRole.doctor)),
                         db: Session = Depends(get_db)):
-    fname = f"user_{current.id}_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}_{file.filename}"
-    path = os.path.join("uploads", fname)
-    with open(path, "wb") as f: f.write(file.file.read())
+    path = store_upload(db, file).path
     current.photo_path = path
     db.commit()
     return {"ok": True, "photo_path": path}
@@ -5401,9 +7344,7 @@ def doctor_upload_profile_document(file: UploadFile = File(...),
                                    db: Session = Depends(get_db)):
     d = current.doctor_profile
     if not d: raise HTTPException(400, "Doctor profile missing")
-    fname = f"doc_{d.id}_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}_{file.filename}"
-    path = os.path.join("uploads", fname)
-    with open(path, "wb") as f: f.write(file.file.read())
+    path = store_upload(db, file).path
     row = DoctorDocument(doctor_id=d.id, title="Document", doc_type="certificate", file_path=path)
     db.add(row); db.commit(); db.refresh(row)
     return {"ok": True, "id": row.id, "file_path": row.file_path}
@@ -193,6 +193,9 @@ def backfill_sqlite(db_path: str, dry_run: bool = False, reassign: bool = False)
                 WHERE id = ?
             """, (serial, est, appt_id))
             total_updates += 1
+        # the app caches the last serial per schedule window; let it re-seed from these values
+        if cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='serial_sequences'").fetchone():
+            cur.execute("DELETE FROM serial_sequences")
         con.commit()
         print(f"Committed: updated {total_updates} appointment rows.")
     except Exception as ex:
@@ -3,7 +3,7 @@ import os
 from datetime import datetime, timedelta
 from collections import defaultdict
 
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, inspect, text
 
 # Get DB URL from env or default to sqlite file used in app.py
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./smart_gateway.db")
@@ -126,6 +126,9 @@ def backfill():
                 conn.execute(upd, {"serial": serial, "est": est_iso, "id": appt_id})
                 total_updates += 1
 
+        # the app caches the last serial per schedule window; let it re-seed from these values
+        if inspect(conn).has_table("serial_sequences"):
+            conn.execute(text("DELETE FROM serial_sequences"))
         trans.commit()
         print(f"Backfilled {total_updates} appointments.")
     except Exception as ex:
@@ -0,0 +1,313 @@
+"""
+Fan-out bus shared by app workers: pub/sub message relay, room membership and
+short "only once" claims, so chat and call signaling work when peers sit on
+different uvicorn workers.
+
+Backends (FANOUT_BUS_URL):
+  memory://  (default) everything in this process; fine for a single worker
+  redis://host:6379/0  Redis pub/sub + sorted sets; needs the `redis` package
+
+MemoryBus instances created over one shared MemoryBroker behave like workers
+connected to one broker, which is what tests use in place of Redis.
+
+Messages are JSON-serializable dicts. publish/join/leave/members/claim_once/exists/
+release are plain calls for sync endpoints; coroutines use the a* variants (apublish,
+ajoin, ...), which keep a blocking backend's network round-trips off the event
+loop. subscribe/unsubscribe run on the event loop and callbacks are coroutines
+scheduled on the subscriber's loop.
+"""
+import asyncio
+import itertools
+import json
+import os
+import threading
+import time
+from typing import Awaitable, Callable, Dict, Optional, Set, Tuple
+
+FANOUT_BUS_URL = os.getenv("FANOUT_BUS_URL", "memory://")
+FANOUT_PREFIX = os.getenv("FANOUT_PREFIX", "rxmeet:")
+MEMBER_TTL = 90          # seconds a RedisBus membership lives without a heartbeat
+
+Callback = Callable[[dict], Awaitable[None]]
+
+
+def _schedule(loop: asyncio.AbstractEventLoop, cb: Callback, message: dict) -> None:
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        loop.create_task(cb(message))
+    elif not loop.is_closed():
+        asyncio.run_coroutine_threadsafe(cb(message), loop)
+
+
+class _AsyncCalls:
+    """a* variants of the plain calls; `blocking` backends run them in a thread."""
+    blocking = False
+
+    async def _off_loop(self, fn, *args):
+        if self.blocking:
+            return await asyncio.to_thread(fn, *args)
+        return fn(*args)
+
+    async def apublish(self, channel: str, message: dict) -> None:
+        await self._off_loop(self.publish, channel, message)
+
+    async def ajoin(self, room: str, member: str, ttl: float = MEMBER_TTL) -> None:
+        await self._off_loop(self.join, room, member, ttl)
+
+    async def aleave(self, room: str, member: str) -> None:
+        await self._off_loop(self.leave, room, member)
+
+    async def amembers(self, room: str) -> Set[str]:
+        return await self._off_loop(self.members, room)
+
+    async def aexists(self, key: str) -> bool:
+        return await self._off_loop(self.exists, key)
+
+    async def arelease(self, key: str) -> None:
+        await self._off_loop(self.release, key)
+
+
+class MemoryBroker:
+    """In-process stand-in for the broker; share one between MemoryBus instances."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers: Dict[str, Dict[int, Tuple[asyncio.AbstractEventLoop, Callback]]] = {}
+        self.members: Dict[str, Set[str]] = {}
+        self.keys: Dict[str, float] = {}
+
+
+class MemoryBus(_AsyncCalls):
+    """
+    Broker state lives in this process, so memberships need no expiry: they last
+    until leave() (the process dying takes them along), unlike RedisBus where a
+    heartbeat keeps them alive.
+    """
+    def __init__(self, broker: Optional[MemoryBroker] = None):
+        self.broker = broker or MemoryBroker()
+        self._ids = itertools.count(1)
+        self._subs: Dict[int, str] = {}
+
+    def publish(self, channel: str, message: dict) -> None:
+        data = json.dumps(message)
+        with self.broker.lock:
+            targets = list(self.broker.subscribers.get(channel, {}).values())
+        for loop, cb in targets:
+            _schedule(loop, cb, json.loads(data))
+
+    async def subscribe(self, channel: str, callback: Callback) -> int:
+        sub_id = next(self._ids)
+        with self.broker.lock:
+            self.broker.subscribers.setdefault(channel, {})[(id(self), sub_id)] = (asyncio.get_running_loop(), callback)
+        self._subs[sub_id] = channel
+        return sub_id
+
+    async def unsubscribe(self, sub_id: int) -> None:
+        channel = self._subs.pop(sub_id, None)
+        if channel is None:
+            return
+        with self.broker.lock:
+            subs = self.broker.subscribers.get(channel, {})
+            subs.pop((id(self), sub_id), None)
+            if not subs:
+                self.broker.subscribers.pop(channel, None)
+
+    def join(self, room: str, member: str, ttl: float = MEMBER_TTL) -> None:
+        with self.broker.lock:
+            self.broker.members.setdefault(room, set()).add(member)
+
+    def leave(self, room: str, member: str) -> None:
+        with self.broker.lock:
+            room_members = self.broker.members.get(room, set())
+            room_members.discard(member)
+            if not room_members:
+                self.broker.members.pop(room, None)
+
+    def members(self, room: str) -> Set[str]:
+        with self.broker.lock:
+            return set(self.broker.members.get(room, ()))
+
+    def claim_once(self, key: str, ttl: float) -> bool:
+        """True for the first caller within `ttl` seconds, False for the rest (any worker)."""
+        now = time.time()
+        with self.broker.lock:
+            if self.broker.keys.get(key, 0) > now:
+                return False
+            self.broker.keys[key] = now + ttl
+            if len(self.broker.keys) > 5000:
+                for k, exp in list(self.broker.keys.items()):
+                    if exp <= now:
+                        self.broker.keys.pop(k, None)
+            return True
+
+    def exists(self, key: str) -> bool:
+        with self.broker.lock:
+            return self.broker.keys.get(key, 0) > time.time()
+
+    def release(self, key: str) -> None:
+        """Drop a claim before its ttl runs out."""
+        with self.broker.lock:
+            self.broker.keys.pop(key, None)
+
+    def close(self) -> None:
+        pass
+
+
+class RedisBus(_AsyncCalls):
+    """
+    Redis backend: PUBLISH/SUBSCRIBE for relay (one pubsub connection per worker),
+    a sorted set per room scored by expiry for membership (refreshed by a heartbeat
+    thread, so members of a crashed worker age out) and SET NX PX for claims.
+    `client` / `async_client` can be injected (e.g. fakeredis) in tests.
+    The plain calls are blocking redis-py round-trips; coroutines use the a* variants.
+    """
+    blocking = True
+
+    def __init__(self, url: str, client=None, async_client=None, prefix: str = FANOUT_PREFIX):
+        try:
+            import redis
+            import redis.asyncio as aioredis
+        except ImportError as e:
+            raise RuntimeError("FANOUT_BUS_URL=redis://... needs the 'redis' package") from e
+        self.prefix = prefix
+        self._r = client or redis.Redis.from_url(url, decode_responses=True)
+        self._ar = async_client or aioredis.from_url(url, decode_responses=True)
+        self._ids = itertools.count(1)
+        self._subs: Dict[int, Tuple[str, asyncio.AbstractEventLoop, Callback]] = {}
+        self._by_channel: Dict[str, Set[int]] = {}
+        self._pubsub = None
+        self._listener: Optional[asyncio.Task] = None
+        self._sub_lock = asyncio.Lock()
+        self._local_members: Dict[Tuple[str, str], float] = {}
+        self._members_lock = threading.Lock()
+        self._heartbeat: Optional[threading.Thread] = None
+        self._closed = threading.Event()
+
+    def _k(self, name: str) -> str:
+        return self.prefix + name
+
+    def publish(self, channel: str, message: dict) -> None:
+        self._r.publish(self._k("ch:" + channel), json.dumps(message))
+
+    async def subscribe(self, channel: str, callback: Callback) -> int:
+        sub_id = next(self._ids)
+        async with self._sub_lock:
+            self._subs[sub_id] = (channel, asyncio.get_running_loop(), callback)
+            first = channel not in self._by_channel
+            self._by_channel.setdefault(channel, set()).add(sub_id)
+            if self._pubsub is None:
+                self._pubsub = self._ar.pubsub()
+            if first:
+                await self._pubsub.subscribe(self._k("ch:" + channel))
+            if self._listener is None or self._listener.done():
+                self._listener = asyncio.create_task(self._listen())
+        return sub_id
+
+    async def unsubscribe(self, sub_id: int) -> None:
+        async with self._sub_lock:
+            item = self._subs.pop(sub_id, None)
+            if item is None:
+                return
+            channel = item[0]
+            ids = self._by_channel.get(channel, set())
+            ids.discard(sub_id)
+            if not ids:
+                self._by_channel.pop(channel, None)
+                await self._pubsub.unsubscribe(self._k("ch:" + channel))
+
+    async def _listen(self) -> None:
+        skip = len(self._k("ch:"))
+        while True:
+            if not self._by_channel:
+                await asyncio.sleep(0.5)
+                continue
+            try:
+                msg = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print("FANOUT: redis listener error:", e)
+                await asyncio.sleep(1.0)
+                continue
+            if not msg or msg.get("type") != "message":
+                continue
+            channel = msg["channel"][skip:]
+            try:
+                data = json.loads(msg["data"])
+            except ValueError:
+                continue
+            for sub_id in list(self._by_channel.get(channel, ())):
+                item = self._subs.get(sub_id)
+                if item:
+                    _schedule(item[1], item[2], data)
+
+    def join(self, room: str, member: str, ttl: float = MEMBER_TTL) -> None:
+        self._r.zadd(self._k("room:" + room), {member: time.time() + ttl})
+        with self._members_lock:
+            self._local_members[(room, member)] = ttl
+            if self._heartbeat is None:
+                self._heartbeat = threading.Thread(target=self._beat, name="fanout-heartbeat", daemon=True)
+                self._heartbeat.start()
+
+    def leave(self, room: str, member: str) -> None:
+        with self._members_lock:
+            self._local_members.pop((room, member), None)
+        self._r.zrem(self._k("room:" + room), member)
+
+    def members(self, room: str) -> Set[str]:
+        key, now = self._k("room:" + room), time.time()
+        self._r.zremrangebyscore(key, "-inf", now)
+        return set(self._r.zrangebyscore(key, now, "+inf"))
+
+    def _beat(self) -> None:
+        while not self._closed.wait(MEMBER_TTL / 3):
+            with self._members_lock:
+                items = list(self._local_members.items())
+            try:
+                pipe = self._r.pipeline()
+                for (room, member), ttl in items:
+                    pipe.zadd(self._k("room:" + room), {member: time.time() + ttl})
+                pipe.execute()
+            except Exception as e:
+                print("FANOUT: heartbeat error:", e)
+
+    def claim_once(self, key: str, ttl: float) -> bool:
+        return bool(self._r.set(self._k("key:" + key), "1", nx=True, px=max(1, int(ttl * 1000))))
+
+    def exists(self, key: str) -> bool:
+        return bool(self._r.exists(self._k("key:" + key)))
+
+    def release(self, key: str) -> None:
+        self._r.delete(self._k("key:" + key))
+
+    def close(self) -> None:
+        self._closed.set()
+        with self._members_lock:
+            items = list(self._local_members)
+            self._local_members.clear()
+        try:
+            for room, member in items:
+                self._r.zrem(self._k("room:" + room), member)
+        except Exception:
+            pass
+
+
+def make_bus(url: str = FANOUT_BUS_URL):
+    if url.startswith("redis://") or url.startswith("rediss://"):
+        return RedisBus(url)
+    return MemoryBus()
+
+
+_bus = None
+_bus_lock = threading.Lock()
+
+
+def get_bus():
+    """Process-wide bus configured by FANOUT_BUS_URL."""
+    global _bus
+    with _bus_lock:
+        if _bus is None:
+            _bus = make_bus()
+        return _bus
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Move existing uploads into the sharded, content-addressed layout used for new
+writes (uploads/blobs/ab/cd/<sha256><ext>) and point the DB at them.
+
+Covers flat files (uploads/rep_3_2024..._lab.pdf) and unsharded blobs
+(uploads/blobs/<sha256><ext>) referenced from users.photo_path,
+appointments.disease_photo_path and the file_path columns. Run it with the API
+stopped. Each batch is: copy/link files into place -> one transaction that
+registers the blobs, rewrites the path columns and recounts references ->
+remove the old files. Interrupted runs can simply be re-run.
+
+Usage (from the directory the API runs in, next to uploads/):
+  python migrate_uploads.py                  # uses DATABASE_URL env or ./smart_gateway.db
+  python migrate_uploads.py --dry-run
+  python migrate_uploads.py --batch 200
+"""
+
+import argparse
+import hashlib
+import os
+import shutil
+import sys
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from sqlalchemy import func, select  # noqa: E402
+
+import app  # noqa: E402
+from app import BLOB_DIR, SessionLocal, UploadBlob, _BLOB_REF_COLUMNS, _blob_ext, _blob_path  # noqa: E402
+
+
+def is_sharded(path: str) -> bool:
+    parts = os.path.relpath(os.path.normpath(path), BLOB_DIR).split(os.sep)
+    return len(parts) == 3 and not parts[0].startswith("..")
+
+
+def file_sha256(path: str):
+    h, size = hashlib.sha256(), 0
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b""):
+            h.update(chunk)
+            size += len(chunk)
+    return h.hexdigest(), size
+
+
+def place(src: str, dst: str) -> None:
+    """Make dst hold src's bytes without touching src (hard link when possible)."""
+    if os.path.exists(dst):
+        return
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = dst + ".migrate"
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+
+
+def columns():
+    for model, cols in _BLOB_REF_COLUMNS.items():
+        for col in cols:
+            yield model.__table__, model.__table__.c[col]
+
+
+def pending_paths(db):
+    """Distinct referenced paths that are not in the sharded layout yet."""
+    found = set()
+    for table, col in columns():
+        for (p,) in db.execute(select(col).where(col.isnot(None), col != "").distinct()):
+            if not is_sharded(p):
+                found.add(p)
+    return sorted(found)
+
+
+def migrate_batch(db, batch, dry_run: bool):
+    mapping, missing = {}, []
+    blobs = {}                                       # sha -> (path, size)
+    for old in batch:
+        if not os.path.isfile(old):
+            missing.append(old)
+            continue
+        sha, size = file_sha256(old)
+        if sha in blobs:
+            dst = blobs[sha][0]
+        else:
+            known = db.execute(select(UploadBlob.path).where(UploadBlob.sha256 == sha)).scalar()
+            dst = known if known and is_sharded(known) else _blob_path(sha, _blob_ext(old))
+        if not dry_run:
+            place(old, dst)
+        mapping[old] = dst
+        blobs[sha] = (dst, size)
+    if dry_run or not mapping:
+        return mapping, missing
+
+    now = datetime.utcnow()
+    t = UploadBlob.__table__
+    for sha, (path, size) in blobs.items():
+        if db.execute(select(t.c.sha256).where(t.c.sha256 == sha)).first():
+            db.execute(t.update().where(t.c.sha256 == sha).values(path=path))
+        else:
+            db.execute(t.insert().values(sha256=sha, path=path, size=size, refcount=0,
+                                         created_at=now, released_at=now))
+    for table, col in columns():
+        for old, new in mapping.items():
+            db.execute(table.update().where(col == old).values({col.name: new}))
+    for path, _size in blobs.values():
+        refs = sum(db.execute(select(func.count()).select_from(table).where(col == path)).scalar()
+                   for table, col in columns())
+        db.execute(t.update().where(t.c.path == path).values(refcount=refs, released_at=None if refs else now))
+    db.commit()
+
+    for old, new in mapping.items():
+        if os.path.normpath(old) != os.path.normpath(new):
+            try:
+                os.remove(old)
+            except OSError as e:
+                print(f"  could not remove {old}: {e}")
+    return mapping, missing
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--dry-run", action="store_true", help="report what would move, change nothing")
+    ap.add_argument("--batch", type=int, default=500, help="paths per transaction")
+    args = ap.parse_args()
+
+    app.create_db()
+    app.ensure_sqlite_schema(app.engine)
+    app.ensure_indexes(app.engine)
+
+    db = SessionLocal()
+    try:
+        paths = pending_paths(db)
+        db.rollback()
+        print(f"{len(paths)} path(s) to migrate ({'dry run' if args.dry_run else 'batch ' + str(args.batch)})")
+        moved = missing = 0
+        for i in range(0, len(paths), args.batch):
+            mapping, gone = migrate_batch(db, paths[i:i + args.batch], args.dry_run)
+            moved += len(mapping)
+            missing += len(gone)
+            for p in gone:
+                print(f"  missing on disk, left as is: {p}")
+            print(f"  {min(i + args.batch, len(paths))}/{len(paths)} done")
+        print(f"migrated={moved} missing={missing}")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+"""
+Password hashing used by the API (app.py) and by its password worker processes.
+
+Kept free of app imports so a worker process only loads passlib.
+PASSWORD_ROUNDS pins the pbkdf2_sha256 work factor; hashes made with any other
+round count are flagged for rehash, which login performs transparently.
+"""
+import os
+from typing import Optional, Tuple
+
+from passlib.context import CryptContext
+
+PASSWORD_ROUNDS = int(os.getenv("PASSWORD_ROUNDS", "0"))   # 0 = passlib default
+
+
+def _make_context() -> CryptContext:
+    opts = {}
+    if PASSWORD_ROUNDS > 0:
+        opts = {
+            "pbkdf2_sha256__default_rounds": PASSWORD_ROUNDS,
+            "pbkdf2_sha256__min_rounds": PASSWORD_ROUNDS,
+            "pbkdf2_sha256__max_rounds": PASSWORD_ROUNDS,
+        }
+    return CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto", **opts)
+
+
+pwd_context = _make_context()
+
+
+def hash_password(pw: str) -> str:
+    return pwd_context.hash(pw)
+
+
+def verify_and_update(plain: str, hashed: str) -> Tuple[bool, Optional[str]]:
+    """(matches, new_hash); new_hash is set when the stored hash should be replaced."""
+    try:
+        return pwd_context.verify_and_update(plain, hashed)
+    except (ValueError, TypeError):
+        return False, None
@@ -1,12 +1,19 @@
 
+import asyncio
+
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, HTTPException
 from typing import Dict, Set
 from uuid import uuid4
 
+import fanout
+
 router = APIRouter(prefix="/calls", tags=["calls"])
 
-# In-memory rooms: { room_id: set(websocket) }
-rooms: Dict[str, Set[WebSocket]] = {}
+# Rooms live on the fan-out bus so peers on different workers meet:
+# a claimed key marks the room as existing (released when the last peer leaves),
+# the bus channel relays the frames.
+ROOM_TTL = 6 * 3600
+bus = fanout.get_bus()
 
 # (Optional) simple auth stub — plug your real auth later
 def get_current_user_id():
@@ -16,7 +23,7 @@ def get_current_user_id():
 @router.post("/create")
 def create_call_room():
     room_id = str(uuid4())
-    rooms.setdefault(room_id, set())
+    bus.claim_once(f"calls:room:{room_id}", ROOM_TTL)
     return {"room_id": room_id}
 
 @router.websocket("/ws/{room_id}")
@@ -24,29 +31,41 @@ async def call_ws(ws: WebSocket, room_id: str):
     await ws.accept()
 
     # Room must exist (created via /calls/create)
-    if room_id not in rooms:
+    if not await bus.aexists(f"calls:room:{room_id}"):
         await ws.close(code=4001)
         return
 
-    peers = rooms[room_id]
-    peers.add(ws)
+    conn_id = uuid4().hex
+    channel = f"calls:{room_id}"
+    # bus callbacks run as separate tasks; one writer per socket keeps SDP/ICE
+    # frames in publish order and never writes the socket concurrently
+    outgoing: asyncio.Queue = asyncio.Queue()
+
+    async def relay(frame: dict):
+        # Relay to all other peers in the same room
+        if frame.get("from") != conn_id:
+            outgoing.put_nowait(frame["text"])
+
+    async def writer():
+        while True:
+            text = await outgoing.get()
+            try:
+                await ws.send_text(text)
+            except Exception:
+                return
 
+    sub = await bus.subscribe(channel, relay)
+    await bus.ajoin(channel, conn_id)
+    sender = asyncio.create_task(writer())
     try:
         while True:
             msg = await ws.receive_text()
-            # Relay to all other peers in the same room
-            dead = []
-            for p in list(peers):
-                if p is not ws:
-                    try:
-                        await p.send_text(msg)
-                    except WebSocketDisconnect:
-                        dead.append(p)
-            for d in dead:
-                peers.discard(d)
+            await bus.apublish(channel, {"from": conn_id, "text": msg})
     except WebSocketDisconnect:
         pass
     finally:
-        peers.discard(ws)
-        if not peers:
-            rooms.pop(room_id, None)
+        sender.cancel()
+        await bus.aleave(channel, conn_id)
+        await bus.unsubscribe(sub)
+        if not await bus.amembers(channel):
+            await bus.arelease(f"calls:room:{room_id}")
@@ -263,7 +263,8 @@ class _ChatScreenState extends State<ChatScreen> {
       dynamic page;
       // prefer the chat listing endpoint
       try {
-        page = await Api.get('/appointments/${widget.apptId}/chat', query: {'page': 1, 'page_size': 200});
+        // no 'page' => newest 200 via id cursor (no OFFSET, no COUNT)
+        page = await Api.get('/appointments/${widget.apptId}/chat', query: {'page_size': 200});
       } catch (_) {
         page = await Api.getMessages(widget.apptId, page: 1, pageSize: 200);
       }
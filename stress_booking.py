@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Concurrent-booking stress test: many patients race for the same slot and the
+number of accepted bookings must never exceed the slot's max_patients.
+
+Runs against a live server (SQLite or Postgres backed):
+  uvicorn app:app --port 8000
+  python stress_booking.py --base http://127.0.0.1:8000 --admin-email a@x.com --admin-password pw
+
+Creates a throwaway doctor with a one-hour date rule and N patients, then fires
+all bookings at once. Exits 1 if the slot was oversubscribed.
+"""
+
+import argparse
+import json
+import secrets
+import sys
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+
+def call(base, method, path, token=None, json_body=None, form=None):
+    headers = {}
+    data = None
+    if json_body is not None:
+        data = json.dumps(json_body).encode()
+        headers["Content-Type"] = "application/json"
+    elif form is not None:
+        data = urllib.parse.urlencode(form).encode()
+        headers["Content-Type"] = "application/x-www-form-urlencoded"
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+    req = urllib.request.Request(base + path, data=data, headers=headers, method=method)
+    try:
+        with urllib.request.urlopen(req, timeout=60) as r:
+            return r.status, json.loads(r.read() or b"null")
+    except urllib.error.HTTPError as e:
+        return e.code, (e.read() or b"").decode(errors="replace")
+
+
+def login(base, username, password):
+    code, body = call(base, "POST", "/auth/login", form={"username": username, "password": password})
+    if code != 200:
+        raise SystemExit(f"login failed for {username}: {code} {body}")
+    return body["access_token"]
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--base", default="http://127.0.0.1:8000")
+    ap.add_argument("--admin-email", required=True)
+    ap.add_argument("--admin-password", required=True)
+    ap.add_argument("--patients", type=int, default=40)
+    ap.add_argument("--capacity", type=int, default=3)
+    ap.add_argument("--rounds", type=int, default=3)
+    args = ap.parse_args()
+
+    run = secrets.token_hex(4)
+    admin = login(args.base, args.admin_email, args.admin_password)
+
+    doc_email, pw = f"stress-doc-{run}@example.com", "stress-pw"
+    code, doc = call(args.base, "POST", "/admin/doctors", admin,
+                     {"name": f"Stress {run}", "email": doc_email, "password": pw, "specialty": "Stress"})
+    if code != 200:
+        raise SystemExit(f"create doctor failed: {code} {doc}")
+    doc_token = login(args.base, doc_email, pw)
+
+    day = date.today() + timedelta(days=7)
+    code, body = call(args.base, "POST", "/doctor/schedule/date_rule", doc_token,
+                      {"dates": [day.isoformat()], "start_hour": 9, "end_hour": 9 + args.rounds,
+                       "mode": "offline", "max_patients": args.capacity})
+    if code != 200:
+        raise SystemExit(f"date rule failed: {code} {body}")
+
+    print(f"registering {args.patients} patients ...")
+    tokens = []
+    for i in range(args.patients):
+        email = f"stress-pat-{run}-{i}@example.com"
+        code, body = call(args.base, "POST", "/auth/register", json_body={"name": f"P{i}", "email": email, "password": pw})
+        if code != 200:
+            raise SystemExit(f"register failed: {code} {body}")
+        tokens.append(login(args.base, email, pw))
+
+    failed = False
+    for rnd in range(args.rounds):
+        st = datetime(day.year, day.month, day.day, 9 + rnd)
+        payload = {"doctor_id": doc["id"], "start_time": st.isoformat(),
+                   "end_time": (st + timedelta(hours=1)).isoformat()}
+
+        with ThreadPoolExecutor(max_workers=len(tokens)) as ex:
+            results = list(ex.map(lambda t: call(args.base, "POST", "/appointments", t, payload), tokens))
+
+        codes = {}
+        for code, _ in results:
+            codes[code] = codes.get(code, 0) + 1
+        accepted = codes.get(200, 0)
+        status = "OK" if accepted <= args.capacity else "OVERSUBSCRIBED"
+        print(f"round {rnd + 1}: slot {st:%Y-%m-%d %H:%M} capacity={args.capacity} "
+              f"accepted={accepted} responses={codes} -> {status}")
+        if accepted > args.capacity:
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
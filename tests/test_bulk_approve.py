@@ -0,0 +1,74 @@
+"""
+Bulk approval against a throwaway SQLite database: only `requested` appointments
+are approved; approved/cancelled ones in the batch are skipped untouched.
+"""
+import os
+import sys
+import tempfile
+from datetime import date, datetime, timedelta
+
+_tmp = tempfile.mkdtemp(prefix="rxmeet-test-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{_tmp}/test.db")
+os.environ.setdefault("OUTBOX_DISPATCHER", "0")
+os.environ.setdefault("PASSWORD_WORKERS", "0")
+os.environ.setdefault("THUMB_WORKERS", "0")
+os.makedirs(os.path.join(_tmp, "uploads"))       # app mounts it at import
+os.chdir(_tmp)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+import app as A  # noqa: E402
+
+
+def _login(c, username):
+    tok = c.post("/auth/login", data={"username": username, "password": "pw"}).json()["access_token"]
+    return {"Authorization": "Bearer " + tok}
+
+
+def test_bulk_approve_skips_approved_and_cancelled():
+    with TestClient(A.app) as c:
+        c.post("/dev/bootstrap_admin", params={"email": "admin@x.com", "password": "pw"})
+        ha = _login(c, "admin@x.com")
+        doc_id = c.post("/admin/doctors", json={"name": "Doc", "email": "doc@x.com", "password": "pw",
+                                                "specialty": "GP"}, headers=ha).json()["id"]
+        c.post("/auth/register", json={"name": "Pat", "password": "pw", "email": "pat@x.com"})
+        hd, hp = _login(c, "doc@x.com"), _login(c, "pat@x.com")
+        day = date.today() + timedelta(days=3)
+        c.post("/doctor/schedule/date_rule", json={"dates": [day.isoformat()], "start_hour": 9, "end_hour": 12,
+                                                   "mode": "online", "max_patients": 6}, headers=hd)
+
+        ids = []
+        for h in (9, 10, 11):
+            st = datetime(day.year, day.month, day.day, h)
+            r = c.post("/appointments", json={"doctor_id": doc_id, "start_time": st.isoformat(),
+                                              "end_time": (st + timedelta(hours=1)).isoformat()}, headers=hp)
+            assert r.status_code == 200, r.text
+            ids.append(r.json()["id"])
+        approved_id, cancelled_id, requested_id = ids
+
+        first = c.post("/admin/appointments/bulk_approve",
+                       json={"appointment_ids": [approved_id], "approve": True}, headers=ha).json()
+        serial = first["items"][0]["serial_number"]
+        db = A.SessionLocal()
+        db.get(A.Appointment, cancelled_id).status = A.AppointmentStatus.cancelled
+        db.commit()
+        outbox_before = db.query(A.NotificationOutbox).count()
+        db.close()
+
+        r = c.post("/admin/appointments/bulk_approve",
+                   json={"appointment_ids": [approved_id, cancelled_id, requested_id, 999999], "approve": True},
+                   headers=ha)
+        assert r.status_code == 200, r.text
+        out = r.json()
+        assert [i["id"] for i in out["items"]] == [requested_id]
+        assert out["items"][0]["status"] == "approved"
+        assert [s["id"] for s in out["skipped"]] == [approved_id, cancelled_id, 999999]
+        assert out["notifications_queued"] == 1
+
+        db = A.SessionLocal()
+        assert db.get(A.Appointment, approved_id).serial_number == serial
+        assert db.get(A.Appointment, cancelled_id).status == A.AppointmentStatus.cancelled
+        assert db.query(A.NotificationOutbox).count() == outbox_before + 1
+        assert all(r.remaining >= 0 for r in db.query(A.SlotReservation).all())
+        db.close()
@@ -0,0 +1,95 @@
+"""
+Fan-out bus checks with the in-process stand-in: two MemoryBus instances over one
+MemoryBroker play two uvicorn workers sharing a broker.
+"""
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fanout  # noqa: E402
+
+
+def _workers():
+    broker = fanout.MemoryBroker()
+    return fanout.MemoryBus(broker), fanout.MemoryBus(broker)
+
+
+async def _wait_for(pred, timeout=2.0):
+    loop = asyncio.get_running_loop()
+    end = loop.time() + timeout
+    while not pred() and loop.time() < end:
+        await asyncio.sleep(0.01)
+
+
+def test_publish_reaches_subscriber_on_other_worker():
+    async def run():
+        w1, w2 = _workers()
+        got = []
+
+        async def on_msg(m):
+            got.append(m)
+
+        sub = await w2.subscribe("chat:1", on_msg)
+        await w1.apublish("chat:1", {"type": "chat_message", "id": 7})
+        await _wait_for(lambda: got)
+        assert got == [{"type": "chat_message", "id": 7}]
+
+        await w2.unsubscribe(sub)
+        w1.publish("chat:1", {"id": 8})
+        await asyncio.sleep(0.05)
+        assert got == [{"type": "chat_message", "id": 7}]
+
+    asyncio.run(run())
+
+
+def test_publish_from_worker_thread_is_delivered_on_subscriber_loop():
+    async def run():
+        w1, w2 = _workers()
+        got = []
+
+        async def on_msg(m):
+            got.append(m)
+
+        await w2.subscribe("calls:r", on_msg)
+        await asyncio.to_thread(w1.publish, "calls:r", {"text": "offer"})
+        await _wait_for(lambda: got)
+        assert got == [{"text": "offer"}]
+
+    asyncio.run(run())
+
+
+def test_membership_is_shared_and_outlives_member_ttl(monkeypatch):
+    w1, w2 = _workers()
+    w1.join("chat:1", "5:abc")
+    assert w2.members("chat:1") == {"5:abc"}
+
+    # a socket open longer than MEMBER_TTL must still count as online
+    real_time = fanout.time.time
+    monkeypatch.setattr(fanout.time, "time", lambda: real_time() + 10 * fanout.MEMBER_TTL)
+    assert w2.members("chat:1") == {"5:abc"}
+
+    w1.leave("chat:1", "5:abc")
+    assert w2.members("chat:1") == set()
+
+
+def test_claim_once_across_workers(monkeypatch):
+    w1, w2 = _workers()
+    assert w1.claim_once("notify:k", 2.0)
+    assert not w2.claim_once("notify:k", 2.0)
+    assert w2.exists("notify:k")
+
+    real_time = fanout.time.time
+    monkeypatch.setattr(fanout.time, "time", lambda: real_time() + 3.0)
+    assert not w2.exists("notify:k")
+    assert w2.claim_once("notify:k", 2.0)
+
+
+def test_release_frees_claim_on_every_worker():
+    w1, w2 = _workers()
+    assert w1.claim_once("calls:room:r1", 60)
+    assert w2.exists("calls:room:r1")
+    w2.release("calls:room:r1")
+    assert not w1.exists("calls:room:r1")
+    assert w1.claim_once("calls:room:r1", 60)
@@ -0,0 +1,63 @@
+"""
+Image derivatives for uploads: a small thumbnail (list screens, chat bubbles)
+and a preview (full-screen viewers), written as JPEGs next to the original:
+  uploads/blobs/ab/cd/<sha256>.png -> <sha256>.thumb.jpg, <sha256>.preview.jpg
+
+Runs in the app's derivative worker processes, so it is kept free of app
+imports. Pillow is listed in requirements.txt; if it is missing anyway,
+available() is False and the API just keeps serving originals.
+"""
+import os
+from typing import Dict
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:          # optional dependency
+    Image = ImageOps = None
+
+SIZES = {"thumb": int(os.getenv("THUMB_SIZE", "256")), "preview": int(os.getenv("PREVIEW_SIZE", "1024"))}
+IMAGE_EXTS = {".jpg", ".jpeg", ".png", ".webp", ".gif", ".bmp"}
+JPEG_QUALITY = 80
+
+
+def available() -> bool:
+    return Image is not None
+
+
+def is_image(path: str) -> bool:
+    return os.path.splitext(path)[1].lower() in IMAGE_EXTS
+
+
+def derivative_path(path: str, kind: str) -> str:
+    return f"{os.path.splitext(path)[0]}.{kind}.jpg"
+
+
+def make_derivatives(path: str) -> Dict[str, str]:
+    """Write the missing derivatives of `path` (each appears atomically); returns {kind: path}."""
+    out, todo = {}, {}
+    for kind, edge in SIZES.items():
+        dst = derivative_path(path, kind)
+        if os.path.exists(dst):
+            out[kind] = dst
+        else:
+            todo[kind] = edge
+    if not todo:
+        return out
+    with Image.open(path) as im:
+        im.draft("RGB", (max(todo.values()),) * 2)       # JPEG: decode at reduced scale
+        im = ImageOps.exif_transpose(im)
+        if im.mode in ("RGBA", "LA", "P"):
+            im = im.convert("RGBA")
+            flat = Image.new("RGB", im.size, (255, 255, 255))
+            flat.paste(im, mask=im.getchannel("A"))
+            im = flat
+        elif im.mode != "RGB":
+            im = im.convert("RGB")
+        for kind, edge in sorted(todo.items(), key=lambda kv: -kv[1]):
+            im.thumbnail((edge, edge), Image.LANCZOS)   # largest first; each step shrinks the last
+            dst = derivative_path(path, kind)
+            tmp = f"{dst}.{os.getpid()}.part"
+            im.save(tmp, "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+            os.replace(tmp, dst)
+            out[kind] = dst
+    return out